@@ -0,0 +1,84 @@
+"""
+Convert binary session logs (log.bin) to result.json, and optionally backup.bak.txt
+
+Usage: python -m code.analysis.binlog_convert results/ [--workers N] [--backup] [--force]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple
+
+from ..utils import binlog
+from ..utils.result_writer import ResultStreamWriter
+from . import recover, sessions
+
+class ConvertResult(NamedTuple):
+    session: str
+    converted: bool
+    entries: int
+    dangling: int
+    error: str | None
+
+def convert_session(session: str, backup: bool = False, force: bool = False) -> ConvertResult:
+    log_path = os.path.join(session, sessions.BINARY_FILE)
+    result = os.path.join(session, sessions.RESULT_FILE)
+    if not os.path.isfile(log_path):
+        return ConvertResult(session, False, 0, 0, None)
+    if not force and os.path.isfile(result) and os.path.getmtime(result) >= os.path.getmtime(log_path):
+        return ConvertResult(session, False, 0, 0, None)
+
+    tmp = result + ".convert.tmp"
+    writer = None
+    try:
+        writer = ResultStreamWriter(tmp)
+        lines, _, dangling = recover.replay(binlog.iter_backup_entries(log_path), writer, sessions.BINARY_FILE, False)
+        writer.close()
+        os.replace(tmp, result)
+
+        if backup:
+            backup_tmp = os.path.join(session, sessions.BACKUP_FILE + ".convert.tmp")
+            with open(backup_tmp, "w") as f:
+                for entry in binlog.iter_backup_entries(log_path):
+                    f.write(json.dumps(entry, indent=None))
+                    f.write("\n")
+            os.replace(backup_tmp, os.path.join(session, sessions.BACKUP_FILE))
+        return ConvertResult(session, True, lines, dangling, None)
+    except (OSError, ValueError) as e:
+        if writer is not None:
+            writer.file.close()
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        return ConvertResult(session, False, 0, 0, f"{type(e).__name__}: {e}")
+
+def convert_tree(root: str, workers: int | None = None, backup: bool = False, force: bool = False) -> List[ConvertResult]:
+    session_list = sessions.find_sessions(root)
+    n = len(session_list)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(convert_session, session_list, [backup] * n, [force] * n, chunksize=4))
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Binary log converter'
+    )
+    parser.add_argument('root')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backup', action='store_true', help="Also write backup.bak.txt")
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+
+    results = convert_tree(args.root, args.workers, args.backup, args.force)
+
+    for r in results:
+        if r.error is not None:
+            print(f"Error in {r.session}: {r.error}")
+        elif r.dangling:
+            print(f"{r.session}: log ended with {r.dangling} open traces")
+    converted = sum(1 for r in results if r.converted)
+    print(f"{len(results)} sessions, {converted} converted")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+"""
+Per session feature table of a results tree, cached column wise in an .npz file
+and only re-extracted for sessions whose log changed
+
+Usage: python -m code.analysis.campaign_aggregate results/ [--cache results/features.npz] [--workers N] [--csv out.csv]
+"""
+
+from __future__ import annotations
+
+import argparse
+import ast
+import csv
+import hashlib
+import math
+import os
+import struct
+import sys
+import time
+import zipfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from . import sessions
+from .campaign_db import TASK_DEPTH, TLS_TRACES, time_to_ns
+
+CACHE_FILE = "features.npz"
+
+#Columns identifying the cached row of a session
+KEY_COLUMNS = ["path", "hash", "size", "mtime"]
+#Columns present even if empty in every row
+BASE_COLUMNS = KEY_COLUMNS + ["source", "error"]
+
+#Negotiation outcome of a SUPPORTED_<conn>_<key> task, lower is better (AppProtocolCode plus Error)
+NEGOTIATION_OK = 0
+NEGOTIATION_OK_MINOR = 1
+NEGOTIATION_FAILED = 2
+NEGOTIATION_INVALID = 3
+NEGOTIATION_ERROR = 4
+
+NEGOTIATION_CODES = {
+    "OK_SuccessfulNegotiation": NEGOTIATION_OK,
+    "OK_SuccessfulNegotiationWithMinorDeviation": NEGOTIATION_OK_MINOR,
+}
+
+Value = float | str
+
+#
+# .npz files (a zip of .npy arrays), written and read without numpy so the cache works on any machine.
+# Only the two types the table needs: float64 (NaN for missing) and fixed width unicode.
+#
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+def npy_encode(values: List[Value]) -> bytes:
+    n = len(values)
+    if all(isinstance(v, float) for v in values):
+        descr = "<f8"
+        data = array("d", values)
+        if sys.byteorder != "little":
+            data.byteswap()
+        body = data.tobytes()
+    else:
+        width = max([1] + [len(v) for v in values])
+        descr = f"<U{width}"
+        body = b"".join(v.encode("utf-32-le").ljust(width * 4, b"\x00") for v in values)
+
+    header = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': ({n},), }}"
+    #Magic, length and header are padded to a multiple of 64, ending in a newline
+    pad = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header = header + " " * (pad % 64) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1") + body
+
+def npy_decode(data: bytes) -> List[Value]:
+    if data[:6] != NPY_MAGIC[:6]:
+        raise ValueError("Not an npy array")
+    if data[6] == 1:
+        (header_len,) = struct.unpack_from("<H", data, 8)
+        offset = 10
+    else:
+        (header_len,) = struct.unpack_from("<I", data, 8)
+        offset = 12
+    header = ast.literal_eval(data[offset:offset + header_len].decode("latin1"))
+    body = data[offset + header_len:]
+    descr = header["descr"]
+    (n,) = header["shape"]
+
+    if descr == "<f8":
+        values = array("d")
+        values.frombytes(body[:n * 8])
+        if sys.byteorder != "little":
+            values.byteswap()
+        return list(values)
+    if descr.startswith("<U"):
+        width = int(descr[2:]) * 4
+        return [body[i * width:(i + 1) * width].decode("utf-32-le").rstrip("\x00") for i in range(n)]
+    raise ValueError(f"Unsupported npy type {descr}")
+
+def write_npz(path: str, columns: Dict[str, List[Value]]):
+    tmp = path + ".tmp"
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, values in columns.items():
+            z.writestr(name + ".npy", npy_encode(values))
+    os.replace(tmp, path)
+
+def read_npz(path: str) -> Dict[str, List[Value]]:
+    columns = {}
+    with zipfile.ZipFile(path, "r") as z:
+        for name in z.namelist():
+            if name.endswith(".npy"):
+                columns[name[:-4]] = npy_decode(z.read(name))
+    return columns
+
+#
+# Feature extraction
+#
+
+def session_source(session: str) -> str:
+    """The log file iter_session_entries reads"""
+    for name in [sessions.BINARY_FILE, sessions.BACKUP_FILE, sessions.RESULT_FILE]:
+        path = os.path.join(session, name)
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f"No session log in {session}")
+
+def file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def seconds_between(start: str | None, end: str | None) -> float:
+    a = time_to_ns(start)
+    b = time_to_ns(end)
+    if a is None or b is None:
+        return math.nan
+    return (b - a) / 1e9
+
+def number(value: Any) -> float:
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    return math.nan
+
+class TaskRun():
+    name: str
+    start: str | None
+    end: str | None
+    result: str | None
+    tls: bool
+    #SUPPORTED tasks only
+    negotiation: int | None
+    chosen: str | None
+
+    def __init__(self, name: str, start: str | None):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.result = None
+        self.tls = False
+        self.negotiation = None
+        self.chosen = None
+
+def extract_features(session: str) -> Dict[str, Value]:
+    """
+    One row of features: session info, result and duration of every task, the negotiation
+    outcome per PROTO_TESTS_EV key, TLS handshakes, SLAC timings and CP levels
+    """
+    row: Dict[str, Value] = {}
+    runs: List[TaskRun] = []
+    open_runs: Dict[str, TaskRun] = {}
+    slac_prearm = None
+    tls_handshakes = 0
+    tls_certs = 0
+    tls_errors = 0
+    in_tls = False
+    tls_error_seen = False
+    #TRACE_LEAVE times are whole seconds, the entry before is more precise
+    last_time = None
+
+    for entry in sessions.iter_session_entries(session):
+        entry_type = entry.get("type")
+        trace = entry.get("trace") or []
+        time_str = entry.get("time")
+        data = entry.get("data")
+        run = open_runs.get(trace[TASK_DEPTH - 1]) if len(trace) >= TASK_DEPTH else None
+        if entry_type == "TRACE_LEAVE" and isinstance(time_str, str) and last_time is not None and last_time[:19] == time_str[:19]:
+            time_str = last_time
+        elif isinstance(time_str, str) and "." in time_str:
+            last_time = time_str
+
+        if entry_type == "TRACE_ENTER":
+            if len(trace) == 1 and "start" not in row:
+                row["start"] = number(time_to_ns(time_str)) / 1e9
+                row["start_time"] = time_str or ""
+            if len(trace) == TASK_DEPTH:
+                run = TaskRun(trace[-1], time_str)
+                runs.append(run)
+                open_runs[run.name] = run
+            if trace[-1] in TLS_TRACES:
+                tls_handshakes += 1
+                in_tls = True
+                tls_error_seen = False
+                if run is not None:
+                    run.tls = True
+            if trace[-1] == "supportedAppProtocolRes" and run is not None and run.negotiation is None:
+                #Failed_NoNegotiation logs no CHOSEN entry
+                run.negotiation = NEGOTIATION_FAILED
+        elif entry_type == "TRACE_LEAVE":
+            if len(trace) == 1:
+                row["duration"] = seconds_between(row.get("start_time"), time_str)  # type: ignore
+            if len(trace) == TASK_DEPTH and trace[-1] in open_runs:
+                open_runs.pop(trace[-1]).end = time_str
+            if trace[-1] in TLS_TRACES:
+                in_tls = False
+        elif entry_type == "INFO" and isinstance(data, dict) and len(trace) == 1:
+            gps = data.get("gps") or [None, None]
+            row["name"] = str(data.get("name") or "")
+            row["box"] = str(data.get("box") or "")
+            row["plug"] = str(data.get("plug") or "")
+            row["lat"] = number(gps[0])
+            row["lon"] = number(gps[1])
+        elif entry_type == "TASK" and isinstance(data, dict):
+            for r in reversed(runs):
+                if r.name == data.get("name"):
+                    r.result = data.get("result")
+                    #Logged right after the task trace closed
+                    r.end = time_str
+                    break
+        elif entry_type == "EXCEPTION":
+            if in_tls and not tls_error_seen:
+                tls_errors += 1
+                tls_error_seen = True
+            if run is not None and run.negotiation is not None and run.chosen is None:
+                run.negotiation = NEGOTIATION_ERROR
+        elif entry_type == "CERT":
+            if in_tls:
+                tls_certs += 1
+        elif entry_type == "CHOSEN" and isinstance(data, dict) and run is not None:
+            if "name" in data:
+                run.negotiation = NEGOTIATION_CODES.get(data.get("code"), NEGOTIATION_INVALID)
+                run.chosen = str(data["name"])
+            else:
+                run.negotiation = NEGOTIATION_INVALID
+        elif entry_type == "SLAC_PREARM":
+            slac_prearm = time_str
+        elif entry_type == "SLAC" and isinstance(data, dict):
+            row["slac_ok"] = float(data.get("NMK") is not None)
+            row["slac_prearm_to_result"] = seconds_between(slac_prearm, time_str)
+        elif entry_type == "NMK_SET" and isinstance(data, dict):
+            row["nmk_attempts"] = number(data.get("attempts"))
+            row["nmk_set_time"] = number(data.get("set_time"))
+            row["nmk_confirm_time"] = number(data.get("confirm_time"))
+            row["nmk_confirmed"] = number(data.get("confirmed"))
+        elif entry_type == "CP" and isinstance(data, dict):
+            phase = data.get("phase")
+            for key, column in [("h", "high"), ("l", "low"), ("d", "duty"), ("p", "pp"), ("s", "state")]:
+                row[f"cp_{phase}_{column}"] = number(data.get(key))
+        elif entry_type == "RECOVERED":
+            row["recovered"] = 1.0
+
+    #Task outcomes, the last run of each task counts
+    for r in runs:
+        row[f"task_{r.name}"] = r.result or ""
+        row[f"task_{r.name}_runs"] = number(row.get(f"task_{r.name}_runs", 0.0)) + 1
+        row[f"task_{r.name}_time"] = seconds_between(r.start, r.end)
+
+    #Negotiation outcome per PROTO_TESTS_EV key, over all connections
+    for r in runs:
+        if not r.name.startswith("SUPPORTED_"):
+            continue
+        if r.negotiation is None:
+            #Ended before the response was read
+            r.negotiation = NEGOTIATION_ERROR
+        key = r.name.rsplit("_", 1)[1]
+        best = row.get(f"supported_{key}")
+        if not isinstance(best, float) or r.negotiation < best:
+            row[f"supported_{key}"] = float(r.negotiation)
+        if r.negotiation in [NEGOTIATION_OK, NEGOTIATION_OK_MINOR]:
+            row[f"supported_{key}_ok"] = number(row.get(f"supported_{key}_ok", 0.0)) + 1
+            if f"chosen_{key}" not in row and r.chosen is not None:
+                row[f"chosen_{key}"] = r.chosen
+
+    tls_runs = [r for r in runs if r.tls]
+    row["tls_handshakes"] = float(tls_handshakes)
+    row["tls_certs"] = float(tls_certs)
+    row["tls_errors"] = float(tls_errors)
+    row["tls_tasks"] = float(len(tls_runs))
+    row["tls_tasks_ok"] = float(sum(1 for r in tls_runs if r.result == "Success"))
+
+    slac_runs = [r for r in runs if r.name == "SLAC"]
+    row["slac_runs"] = float(len(slac_runs))
+    if len(slac_runs):
+        row["slac_time"] = seconds_between(slac_runs[-1].start, slac_runs[-1].end)
+    return row
+
+class SessionFeatures(NamedTuple):
+    path: str
+    hash: str
+    size: float
+    mtime: float
+    #None if the content hash matched the cached one
+    row: Dict[str, Value] | None
+
+def process_session(session: str, known_hash: str) -> SessionFeatures:
+    source = session_source(session)
+    st = os.stat(source)
+    digest = file_hash(source)
+    if digest == known_hash:
+        return SessionFeatures(session, digest, float(st.st_size), st.st_mtime, None)
+    try:
+        row = extract_features(session)
+        row["source"] = os.path.basename(source)
+        row["error"] = ""
+    except (OSError, ValueError, KeyError) as e:
+        row = {"source": os.path.basename(source), "error": f"{type(e).__name__}: {e}"}
+    return SessionFeatures(session, digest, float(st.st_size), st.st_mtime, row)
+
+#
+# Cache
+#
+
+def columns_to_rows(columns: Dict[str, List[Value]]) -> List[Dict[str, Value]]:
+    names = list(columns.keys())
+    n = len(columns["path"]) if "path" in columns else 0
+    rows = []
+    for i in range(n):
+        row = {}
+        for name in names:
+            v = columns[name][i]
+            #Missing values are not kept, so a column can change type when rows are rebuilt
+            if not (isinstance(v, float) and math.isnan(v)) and v != "":
+                row[name] = v
+        rows.append(row)
+    return rows
+
+def rows_to_columns(rows: List[Dict[str, Value]]) -> Dict[str, List[Value]]:
+    names = list(BASE_COLUMNS)
+    seen = set(names)
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+
+    columns: Dict[str, List[Value]] = {}
+    for name in names:
+        text = any(isinstance(row.get(name), str) for row in rows)
+        missing: Value = "" if text else math.nan
+        if text:
+            columns[name] = [str(row[name]) if name in row else missing for row in rows]
+        else:
+            columns[name] = [row.get(name, missing) for row in rows]
+    return columns
+
+def load_cache(path: str) -> Dict[str, List[Value]]:
+    """Feature table by column. numpy.load(path) reads the same file as arrays."""
+    return read_npz(path)
+
+class AggregateResult(NamedTuple):
+    sessions: int
+    extracted: int
+    unchanged: int
+    removed: int
+    errors: List[Tuple[str, str]]
+    seconds: float
+
+def aggregate(root: str, cache_path: str | None = None, workers: int | None = None) -> Tuple[Dict[str, List[Value]], AggregateResult]:
+    """Update the feature cache of a results tree, returns the table and what was done"""
+    t_start = time.monotonic()
+    if cache_path is None:
+        cache_path = os.path.join(root, CACHE_FILE)
+
+    cached_columns: Dict[str, List[Value]] | None = None
+    cached: Dict[str, Dict[str, Value]] = {}
+    if os.path.isfile(cache_path):
+        try:
+            cached_columns = read_npz(cache_path)
+            cached = {str(row["path"]): row for row in columns_to_rows(cached_columns)}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f"Ignoring unreadable cache {cache_path}: {e}")
+
+    session_list = [os.path.relpath(p, root) for p in sessions.find_sessions(root)]
+    rows: Dict[str, Dict[str, Value]] = {}
+    #Size and mtime decide which sessions get hashed, the hash which get extracted
+    check: List[str] = []
+    for p in session_list:
+        old = cached.get(p)
+        try:
+            st = os.stat(session_source(os.path.join(root, p)))
+        except OSError:
+            continue
+        if old is not None and old.get("size") == float(st.st_size) and old.get("mtime") == st.st_mtime:
+            rows[p] = old
+        else:
+            check.append(p)
+
+    extracted = 0
+    errors = []
+    if len(check):
+        known = [str(cached[p].get("hash", "")) if p in cached else "" for p in check]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for p, res in zip(check, pool.map(process_session, [os.path.join(root, p) for p in check], known, chunksize=4)):
+                if res.row is None:
+                    row = dict(cached[p])
+                else:
+                    row = res.row
+                    extracted += 1
+                row.update({"path": p, "hash": res.hash, "size": res.size, "mtime": res.mtime})
+                rows[p] = row
+                if row.get("error"):
+                    errors.append((p, str(row["error"])))
+
+    removed = sum(1 for p in cached if p not in rows)
+    if cached_columns is not None and len(check) == 0 and removed == 0:
+        columns = cached_columns
+    else:
+        columns = rows_to_columns([rows[p] for p in session_list if p in rows])
+        write_npz(cache_path, columns)
+
+    res = AggregateResult(len(session_list), extracted, len(rows) - extracted, removed, errors, time.monotonic() - t_start)
+    return columns, res
+
+def write_csv(path: str, columns: Dict[str, List[Value]]):
+    names = list(columns.keys())
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(names)
+        for row in zip(*[columns[name] for name in names]):
+            w.writerow(["" if isinstance(v, float) and math.isnan(v) else v for v in row])
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Campaign aggregation'
+    )
+    parser.add_argument('root')
+    parser.add_argument('--cache', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--csv', default=None, help="Also write the table as CSV")
+    args = parser.parse_args()
+
+    columns, res = aggregate(args.root, args.cache, args.workers)
+    if args.csv is not None:
+        write_csv(args.csv, columns)
+
+    for path, error in res.errors:
+        print(f"Error in {path}: {error}")
+    print(f"{res.sessions} sessions, {res.extracted} extracted, {res.unchanged} cached, {res.removed} removed, "
+          f"{len(columns)} columns in {res.seconds:.2f}s")
+
+if __name__ == "__main__":
+    main()
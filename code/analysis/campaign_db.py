@@ -0,0 +1,402 @@
+"""
+SQLite index over all sessions of a results tree, updated incrementally by file mtime
+
+Usage: python -m code.analysis.campaign_db results/ [--db results/campaign.sqlite] [--workers N]
+       python -m code.analysis.campaign_db results/ --query "SELECT ..."
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from . import sessions, v2g_indexer
+
+DB_FILE = "campaign.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    source TEXT,
+    name TEXT,
+    box TEXT,
+    plug TEXT,
+    lat REAL,
+    lon REAL,
+    info_version INTEGER,
+    start_time TEXT,
+    end_time TEXT,
+    recovered INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    start_time TEXT,
+    end_time TEXT,
+    result TEXT,
+    exception TEXT
+);
+CREATE TABLE IF NOT EXISTS slac (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    task TEXT,
+    time TEXT,
+    nmk TEXT,
+    nid TEXT,
+    pev_mac TEXT,
+    evse_mac TEXT,
+    pev_id TEXT,
+    evse_id TEXT,
+    run_id TEXT,
+    aag TEXT
+);
+CREATE TABLE IF NOT EXISTS sdp (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    task TEXT,
+    time TEXT,
+    req_tls INTEGER,
+    req_tcp INTEGER,
+    ip TEXT,
+    port INTEGER,
+    tls INTEGER,
+    tcp INTEGER,
+    raw TEXT
+);
+CREATE TABLE IF NOT EXISTS protocols (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    task TEXT,
+    time TEXT,
+    code TEXT,
+    schema_id INTEGER,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS evse (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    task TEXT,
+    time TEXT,
+    evseid TEXT,
+    evse_timestamp TEXT,
+    datetime_now TEXT
+);
+CREATE TABLE IF NOT EXISTS tls (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    task TEXT,
+    mode TEXT,
+    start_time TEXT,
+    handshake_ok INTEGER,
+    error TEXT,
+    version TEXT,
+    suite TEXT
+);
+CREATE TABLE IF NOT EXISTS certs (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    task TEXT,
+    position INTEGER,
+    sha256 TEXT,
+    subject TEXT,
+    issuer TEXT,
+    not_after TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_session ON tasks(session_id);
+CREATE INDEX IF NOT EXISTS slac_session ON slac(session_id);
+CREATE INDEX IF NOT EXISTS sdp_session ON sdp(session_id);
+CREATE INDEX IF NOT EXISTS protocols_session ON protocols(session_id);
+CREATE INDEX IF NOT EXISTS evse_session ON evse(session_id);
+CREATE INDEX IF NOT EXISTS tls_session ON tls(session_id);
+CREATE INDEX IF NOT EXISTS certs_session ON certs(session_id);
+CREATE INDEX IF NOT EXISTS certs_sha256 ON certs(sha256);
+"""
+
+#Task traces sit directly below the CHARGER trace
+TASK_DEPTH = 2
+#Traces that wrap a TLS handshake
+TLS_TRACES = ["UTLS", "MTLS"]
+
+TLS_VERSION_NAMES = {0x0301: "TLSv1.0", 0x0302: "TLSv1.1", 0x0303: "TLSv1.2", 0x0304: "TLSv1.3"}
+
+def session_mtime(session: str) -> float:
+    """Newest mtime of the files the index is built from"""
+    res = 0.0
+    for name in [sessions.BACKUP_FILE, sessions.RESULT_FILE, sessions.BINARY_FILE, v2g_indexer.INDEX_FILE]:
+        path = os.path.join(session, name)
+        if os.path.isfile(path):
+            res = max(res, os.path.getmtime(path))
+    return res
+
+def time_to_ns(time_str: str | None) -> int | None:
+    if time_str is None:
+        return None
+    for fmt in ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]:
+        try:
+            t = datetime.datetime.strptime(time_str, fmt).replace(tzinfo=datetime.timezone.utc)
+            return int(t.timestamp()) * 1000000000 + t.microsecond * 1000
+        except ValueError:
+            pass
+    return None
+
+def parse_certs(pem: str) -> List[Tuple[str, str, str, str]]:
+    """(sha256, subject, issuer, not after) of each certificate of a PEM chain"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+
+    res = []
+    for block in pem.split("-----END CERTIFICATE-----"):
+        if "-----BEGIN CERTIFICATE-----" not in block:
+            continue
+        data = (block.strip() + "\n-----END CERTIFICATE-----\n").encode()
+        try:
+            cert = x509.load_pem_x509_certificate(data)
+        except ValueError:
+            res.append((hashlib.sha256(data).hexdigest(), "", "", ""))
+            continue
+        res.append((
+            cert.fingerprint(hashes.SHA256()).hex(),
+            cert.subject.rfc4514_string(),
+            cert.issuer.rfc4514_string(),
+            cert.not_valid_after_utc.isoformat(),
+        ))
+    return res
+
+class SessionRows(NamedTuple):
+    """Everything extracted from one session, ready to insert"""
+    path: str
+    mtime: float
+    session: Dict[str, Any]
+    tables: Dict[str, List[Tuple]]
+    error: str | None
+
+class OpenTls():
+    task: str | None
+    mode: str
+    start_time: str
+    cert: bool
+    error: str | None
+
+    def __init__(self, task: str | None, mode: str, start_time: str):
+        self.task = task
+        self.mode = mode
+        self.start_time = start_time
+        self.cert = False
+        self.error = None
+
+def extract_session(path: str) -> SessionRows:
+    mtime = session_mtime(path)
+    info: Dict[str, Any] = {"source": None, "recovered": 0}
+    tables: Dict[str, List[Tuple]] = {
+        "tasks": [], "slac": [], "sdp": [], "protocols": [], "evse": [], "tls": [], "certs": [],
+    }
+    if os.path.isfile(os.path.join(path, sessions.BINARY_FILE)):
+        info["source"] = "binary"
+    elif os.path.isfile(os.path.join(path, sessions.BACKUP_FILE)):
+        info["source"] = "backup"
+    else:
+        info["source"] = "result"
+
+    #Task runs [name, start, end, result, exception], and the open ones by name
+    tasks: List[List[Any]] = []
+    open_tasks: Dict[str, List[Any]] = {}
+    tls_open: List[OpenTls] = []
+    tls_done: List[OpenTls] = []
+
+    try:
+        for entry in sessions.iter_session_entries(path):
+            entry_type = entry.get("type")
+            trace = entry.get("trace") or []
+            time_str = entry.get("time")
+            data = entry.get("data")
+            task = trace[TASK_DEPTH - 1] if len(trace) >= TASK_DEPTH else None
+
+            if entry_type == "TRACE_ENTER":
+                if len(trace) == 1 and info.get("start_time") is None:
+                    info["start_time"] = time_str
+                if len(trace) == TASK_DEPTH:
+                    row = [trace[-1], time_str, None, None, None]
+                    tasks.append(row)
+                    open_tasks[trace[-1]] = row
+                if trace[-1] in TLS_TRACES:
+                    tls_open.append(OpenTls(task, trace[-1], time_str))
+            elif entry_type == "TRACE_LEAVE":
+                if len(trace) == 1:
+                    info["end_time"] = time_str
+                if len(trace) == TASK_DEPTH and trace[-1] in open_tasks:
+                    open_tasks.pop(trace[-1])[2] = time_str
+                if trace[-1] in TLS_TRACES and len(tls_open):
+                    tls_done.append(tls_open.pop())
+            elif entry_type == "INFO" and isinstance(data, dict) and len(trace) == 1:
+                gps = data.get("gps") or [None, None]
+                info.update({
+                    "name": data.get("name"),
+                    "box": data.get("box"),
+                    "plug": data.get("plug"),
+                    "lat": gps[0],
+                    "lon": gps[1],
+                    "info_version": data.get("v"),
+                })
+            elif entry_type == "TASK" and isinstance(data, dict):
+                #Final result of a task run, logged after its trace closed
+                for row in reversed(tasks):
+                    if row[0] == data.get("name"):
+                        row[3] = data.get("result")
+                        break
+            elif entry_type == "EXCEPTION" and isinstance(data, dict):
+                err = f"{data.get('type')}: {data.get('value')}"
+                if task is not None and task in open_tasks and open_tasks[task][4] is None:
+                    open_tasks[task][4] = err
+                if len(tls_open) and tls_open[-1].error is None:
+                    tls_open[-1].error = err
+            elif entry_type == "SLAC" and isinstance(data, dict):
+                tables["slac"].append((task, time_str, data.get("NMK"), data.get("NID"), data.get("PEV_MAC"), data.get("EVSE_MAC"),
+                                       data.get("PEV_ID"), data.get("EVSE_ID"), data.get("RUN_ID"), data.get("AAG")))
+            elif entry_type == "RES" and isinstance(data, dict) and "req" in data:
+                req = data.get("req") or {}
+                res = data.get("res") or {}
+                raw = data.get("raw") or {}
+                tables["sdp"].append((task, time_str, req.get("tls"), req.get("tcp"), res.get("ip"), res.get("port"),
+                                      res.get("tls"), res.get("tcp"), raw.get("data")))
+            elif entry_type == "CHOSEN" and isinstance(data, dict):
+                tables["protocols"].append((task, time_str, data.get("code"), data.get("id"), data.get("name")))
+            elif entry_type == "RESULT" and isinstance(data, dict) and "EVSEID" in data:
+                tables["evse"].append((task, time_str, data.get("EVSEID"), data.get("EVSETimeStamp"), data.get("DateTimeNow")))
+            elif entry_type == "CERT":
+                if len(tls_open):
+                    tls_open[-1].cert = True
+                if isinstance(data, str):
+                    for i, (sha, subject, issuer, not_after) in enumerate(parse_certs(data)):
+                        tables["certs"].append((task, i, sha, subject, issuer, not_after))
+            elif entry_type == "RECOVERED":
+                info["recovered"] = 1
+    except (OSError, ValueError, KeyError) as e:
+        return SessionRows(path, mtime, info, tables, f"{type(e).__name__}: {e}")
+
+    for row in tasks:
+        tables["tasks"].append((row[0], row[1], row[2], row[3], row[4]))
+
+    #Negotiated TLS versions and suites from the capture index, matched to handshakes by time
+    connections = []
+    try:
+        connections = [c for c in v2g_indexer.load_index(path)["connections"] if c.get("tls") is not None]
+    except (OSError, ValueError, KeyError):
+        pass
+    for tls in tls_done + tls_open:
+        version = None
+        suite = None
+        start = time_to_ns(tls.start_time)
+        if start is not None:
+            #Closest connection opened after the handshake trace started
+            after = [c for c in connections if c["start"] >= start - 1000000]
+            if len(after):
+                c = min(after, key=lambda c: c["start"])
+                connections.remove(c)
+                version = TLS_VERSION_NAMES.get(c["tls"]["version"], c["tls"]["version"])
+                suite = c["tls"]["suite"]
+        tables["tls"].append((tls.task, tls.mode, tls.start_time, int(tls.cert), tls.error, version, suite))
+
+    return SessionRows(path, mtime, info, tables, None)
+
+def open_db(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.executescript(SCHEMA)
+    return db
+
+def store_session(db: sqlite3.Connection, rows: SessionRows):
+    db.execute("DELETE FROM sessions WHERE path = ?", (rows.path,))
+    s = rows.session
+    cur = db.execute(
+        "INSERT INTO sessions (path, mtime, source, name, box, plug, lat, lon, info_version, start_time, end_time, recovered, error) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (rows.path, rows.mtime, s.get("source"), s.get("name"), s.get("box"), s.get("plug"), s.get("lat"), s.get("lon"),
+         s.get("info_version"), s.get("start_time"), s.get("end_time"), s.get("recovered", 0), rows.error)
+    )
+    session_id = cur.lastrowid
+    for table, table_rows in rows.tables.items():
+        if len(table_rows) == 0:
+            continue
+        placeholders = ", ".join(["?"] * (len(table_rows[0]) + 1))
+        db.executemany(f"INSERT INTO {table} VALUES ({placeholders})", [(session_id,) + r for r in table_rows])
+
+class UpdateResult(NamedTuple):
+    sessions: int
+    updated: int
+    removed: int
+    errors: List[Tuple[str, str]]
+
+def update_db(root: str, db_path: str | None = None, workers: int | None = None) -> UpdateResult:
+    """Re-extract the sessions that changed since they were indexed, and drop the ones that are gone"""
+    if db_path is None:
+        db_path = os.path.join(root, DB_FILE)
+    db = open_db(db_path)
+    try:
+        known = {path: mtime for path, mtime in db.execute("SELECT path, mtime FROM sessions")}
+        session_list = [os.path.relpath(p, root) for p in sessions.find_sessions(root)]
+        changed = [p for p in session_list if known.get(p) != session_mtime(os.path.join(root, p))]
+        present = set(session_list)
+        removed = [p for p in known if p not in present]
+
+        errors = []
+        if len(changed):
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for rows in pool.map(extract_session, [os.path.join(root, p) for p in changed], chunksize=4):
+                    rows = rows._replace(path=os.path.relpath(rows.path, root))
+                    store_session(db, rows)
+                    if rows.error is not None:
+                        errors.append((rows.path, rows.error))
+        for p in removed:
+            db.execute("DELETE FROM sessions WHERE path = ?", (p,))
+        db.commit()
+        return UpdateResult(len(session_list), len(changed), len(removed), errors)
+    finally:
+        db.close()
+
+#Most rows a query returns, the rest is reported as truncated
+QUERY_LIMIT_MAX = 10000
+
+def query_db(db_path: str, sql: str, params: Tuple = (), limit: int = 1000) -> Dict[str, Any]:
+    """Read only query, returns {"columns", "rows", "truncated"}"""
+    limit = max(0, min(limit, QUERY_LIMIT_MAX))
+    db = sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        db.execute("PRAGMA query_only = ON")
+        cur = db.execute(sql, params)
+        columns = [d[0] for d in cur.description] if cur.description is not None else []
+        rows = cur.fetchmany(limit + 1)
+        return {
+            "columns": columns,
+            "rows": [list(r) for r in rows[:limit]],
+            "truncated": len(rows) > limit,
+        }
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Campaign index'
+    )
+    parser.add_argument('root')
+    parser.add_argument('--db', default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--query', default=None, help="Run a query instead of updating")
+    args = parser.parse_args()
+
+    db_path = args.db if args.db is not None else os.path.join(args.root, DB_FILE)
+    if args.query is not None:
+        print(json.dumps(query_db(db_path, args.query), indent=2))
+        return
+
+    res = update_db(args.root, db_path, args.workers)
+    for path, error in res.errors:
+        print(f"Error in {path}: {error}")
+    print(f"{res.sessions} sessions, {res.updated} updated, {res.removed} removed")
+
+if __name__ == "__main__":
+    main()
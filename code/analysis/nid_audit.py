@@ -0,0 +1,90 @@
+"""
+Check the NMK/NID pairs of every SLAC log entry in a results tree
+
+Usage: python -m code.analysis.nid_audit results/ [--workers N] [--json out.json]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple
+
+from ..interface import nid
+from . import sessions
+
+class NidMismatch(NamedTuple):
+    session: str
+    trace: List[str]
+    time: str
+    nmk: str
+    nid: str
+    expected: str
+
+    def to_json(self):
+        return self._asdict()
+
+class SessionAudit(NamedTuple):
+    session: str
+    checked: int
+    mismatches: List[NidMismatch]
+    error: str | None
+
+def audit_session(session: str) -> SessionAudit:
+    checked = 0
+    mismatches: List[NidMismatch] = []
+    try:
+        for entry in sessions.iter_session_entries(session):
+            if entry.get("type") != "SLAC" or entry.get("data") is None:
+                continue
+            nmk_hex = entry["data"].get("NMK", None)
+            nid_hex = entry["data"].get("NID", None)
+            if nmk_hex is None or nid_hex is None:
+                continue
+
+            checked += 1
+            expected = nid.to_nid(bytes.fromhex(nmk_hex)).hex()
+            if expected != nid_hex.lower():
+                mismatches.append(NidMismatch(session, entry["trace"], entry["time"], nmk_hex, nid_hex, expected))
+    except (OSError, ValueError, KeyError) as e:
+        return SessionAudit(session, checked, mismatches, f"{type(e).__name__}: {e}")
+    return SessionAudit(session, checked, mismatches, None)
+
+def audit_tree(root: str, workers: int | None = None) -> List[SessionAudit]:
+    session_list = sessions.find_sessions(root)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(audit_session, session_list, chunksize=16))
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='NID audit'
+    )
+    parser.add_argument('root')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--json')
+    args = parser.parse_args()
+
+    results = audit_tree(args.root, args.workers)
+
+    checked = sum(r.checked for r in results)
+    mismatches = [m for r in results for m in r.mismatches]
+    for r in results:
+        if r.error is not None:
+            print(f"Error in {r.session}: {r.error}")
+    for m in mismatches:
+        print(f"{m.session} {'/'.join(m.trace)} NMK {m.nmk} NID {m.nid} expected {m.expected}")
+    print(f"{len(results)} sessions, {checked} SLAC entries, {len(mismatches)} inconsistent")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            out: Dict[str, Any] = {
+                "sessions": len(results),
+                "checked": checked,
+                "mismatches": [m.to_json() for m in mismatches],
+                "errors": {r.session: r.error for r in results if r.error is not None},
+            }
+            json.dump(out, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Streaming reader for the session captures: classic pcap (tcpdump backend),
+pcapng (ring backend) and gzip compressed / rotated segments listed in pcap.index.json
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import struct
+from typing import BinaryIO, Iterator, List, Tuple
+
+# (timestamp ns, frame)
+Frame = Tuple[int, bytes]
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_EPB = 0x00000006
+PCAPNG_SPB = 0x00000003
+
+class PcapError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+def read_exact(f: BinaryIO, n: int) -> bytes | None:
+    """Read n bytes, None at a clean end of file or a cut off record"""
+    b = f.read(n)
+    if len(b) < n:
+        return None
+    return b
+
+def iter_pcap(f: BinaryIO, header: bytes) -> Iterator[Frame]:
+    magic_le = struct.unpack("<I", header[0:4])[0]
+    if magic_le in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+        endian = "<"
+    else:
+        endian = ">"
+    magic = struct.unpack(endian + "I", header[0:4])[0]
+    ts_mul = 1 if magic == PCAP_MAGIC_NS else 1000
+
+    rec = struct.Struct(endian + "IIII")
+    while True:
+        h = read_exact(f, 16)
+        if h is None:
+            return
+        sec, frac, incl_len, _ = rec.unpack(h)
+        data = read_exact(f, incl_len)
+        if data is None:
+            return
+        yield (sec * 1000000000 + frac * ts_mul, data)
+
+def pcapng_ts_unit(options: bytes, endian: str) -> Tuple[int, int]:
+    """(numerator, denominator) converting timestamp units to ns, from the if_tsresol option"""
+    i = 0
+    while i + 4 <= len(options):
+        code, length = struct.unpack_from(endian + "HH", options, i)
+        if code == 0:
+            break
+        if code == 9 and length == 1:
+            res = options[i + 4]
+            if res & 0x80:
+                return (1000000000, 2 ** (res & 0x7F))
+            return (1000000000, 10 ** res)
+        i += 4 + length + (-length % 4)
+    #Default microseconds
+    return (1000, 1)
+
+def iter_pcapng(f: BinaryIO, first: bytes) -> Iterator[Frame]:
+    endian = "<"
+    units: List[Tuple[int, int]] = []
+    pending = first
+    while True:
+        if pending is not None:
+            h = pending
+            pending = None
+        else:
+            h = read_exact(f, 8)
+            if h is None:
+                return
+
+        block_type = struct.unpack("<I", h[0:4])[0]
+        if block_type == PCAPNG_SHB:
+            bom = read_exact(f, 4)
+            if bom is None:
+                return
+            endian = "<" if struct.unpack("<I", bom)[0] == 0x1A2B3C4D else ">"
+            total = struct.unpack(endian + "I", h[4:8])[0]
+            body = read_exact(f, total - 12)
+            if body is None:
+                return
+            units = []
+            continue
+
+        total = struct.unpack(endian + "I", h[4:8])[0]
+        body = read_exact(f, total - 8)
+        if body is None:
+            return
+        block_type = struct.unpack(endian + "I", h[0:4])[0]
+
+        if block_type == PCAPNG_IDB:
+            units.append(pcapng_ts_unit(body[8:-4], endian))
+        elif block_type == PCAPNG_EPB:
+            if_id, ts_high, ts_low, cap_len, _ = struct.unpack_from(endian + "IIIII", body, 0)
+            num, den = units[if_id] if if_id < len(units) else (1000, 1)
+            ts = (ts_high << 32) | ts_low
+            yield (ts * num // den, body[20:20 + cap_len])
+        elif block_type == PCAPNG_SPB:
+            yield (0, body[4:-4])
+
+def open_capture(path: str) -> BinaryIO:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb") #type: ignore
+    return open(path, "rb")
+
+def iter_capture_file(path: str) -> Iterator[Frame]:
+    with open_capture(path) as f:
+        header = read_exact(f, 8)
+        if header is None:
+            return
+        if struct.unpack("<I", header[0:4])[0] == PCAPNG_SHB:
+            yield from iter_pcapng(f, header)
+            return
+        rest = read_exact(f, 16)
+        if rest is None:
+            return
+        if struct.unpack("<I", header[0:4])[0] not in (PCAP_MAGIC_US, PCAP_MAGIC_NS) and \
+           struct.unpack(">I", header[0:4])[0] not in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            raise PcapError(f"Unknown capture format: {path}")
+        yield from iter_pcap(f, header + rest)
+
+def session_capture_files(session: str) -> List[str]:
+    """Capture files of a session in order, using the segment index if there is one"""
+    index = os.path.join(session, "pcap.index.json")
+    if os.path.isfile(index):
+        with open(index, "r") as f:
+            segments = json.load(f)["segments"]
+        res = []
+        for s in sorted(segments, key=lambda s: s["id"]):
+            path = os.path.join(session, s["file"])
+            #Segment may have been compressed after the index was read
+            for candidate in [path, path + ".gz"]:
+                if os.path.isfile(candidate):
+                    res.append(candidate)
+                    break
+        return res
+
+    res = []
+    for name in ["pcap.pcap", "pcap.pcapng", "pcap.pcapng.gz"]:
+        if os.path.isfile(os.path.join(session, name)):
+            res.append(os.path.join(session, name))
+    return res
+
+def iter_session_frames(session: str) -> Iterator[Frame]:
+    for path in session_capture_files(session):
+        yield from iter_capture_file(path)
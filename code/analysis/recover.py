@@ -0,0 +1,169 @@
+"""
+Rebuild result.json from backup.bak.txt for sessions that were killed before writing it
+
+Usage: python -m code.analysis.recover results/ [--workers N] [--force]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
+
+from ..utils.result_writer import ResultStreamWriter
+from . import sessions
+
+#Entry type added to the root trace of a rebuilt result
+RECOVERED_TYPE = "RECOVERED"
+
+class RecoverResult(NamedTuple):
+    session: str
+    recovered: bool
+    lines: int
+    skipped: int
+    dangling: int
+    error: str | None
+
+def json_complete(path: str, chunk_size: int = 1 << 16) -> bool:
+    """Whether the file holds one complete JSON value, checked by bracket depth without loading it"""
+    depth = 0
+    seen = False
+    in_string = False
+    escape = False
+    with open(path, "r", errors="replace") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            for c in chunk:
+                if in_string:
+                    if escape:
+                        escape = False
+                    elif c == "\\":
+                        escape = True
+                    elif c == '"':
+                        in_string = False
+                elif c == '"':
+                    in_string = True
+                elif c in "{[":
+                    depth += 1
+                    seen = True
+                elif c in "}]":
+                    depth -= 1
+    return seen and depth == 0 and not in_string
+
+def needs_recovery(session: str) -> bool:
+    result = os.path.join(session, sessions.RESULT_FILE)
+    if not os.path.isfile(os.path.join(session, sessions.BACKUP_FILE)):
+        return False
+    if not os.path.isfile(result):
+        return True
+    return not json_complete(result)
+
+def mark_recovered(writer: ResultStreamWriter, trace: List[str], time_str: str, source: str, lines: int, skipped: int, dangling: int):
+    """Last entry of the root trace of a rebuilt result"""
+    writer.log_entry(trace, time_str, RECOVERED_TYPE, {
+        "source": source,
+        "lines": lines,
+        "skipped": skipped,
+        "dangling": dangling,
+    })
+
+def replay(entries: Iterator[Dict[str, Any]], writer: ResultStreamWriter, source: str, mark_complete: bool) -> Tuple[int, int, int]:
+    """
+    Writes log entries in backup form to a result writer, returns (lines, skipped, dangling traces).
+    Results with dangling traces are always marked as recovered, complete ones only with mark_complete.
+    """
+    lines = 0
+    skipped = 0
+    stack: List[str] = []
+    last_time = None
+    for entry in entries:
+        lines += 1
+        entry_type = entry.get("type", None)
+        trace = entry.get("trace", None)
+        time_str = entry.get("time", None)
+        if not isinstance(trace, list) or not isinstance(time_str, str):
+            skipped += 1
+            continue
+        last_time = time_str
+
+        if entry_type == "TRACE_ENTER":
+            if trace[:-1] != stack:
+                skipped += 1
+                continue
+            stack.append(trace[-1])
+            writer.trace_enter(trace, time_str)
+        elif entry_type == "TRACE_LEAVE":
+            if trace != stack or len(stack) == 0:
+                skipped += 1
+                continue
+            if len(stack) == 1 and mark_complete:
+                mark_recovered(writer, stack, time_str, source, lines, skipped, 0)
+            stack.pop()
+            writer.trace_leave(time_str)
+        else:
+            if trace != stack or len(stack) == 0:
+                skipped += 1
+                continue
+            writer.log_entry(trace, time_str, entry_type, entry.get("data", None))
+
+    dangling = len(stack)
+    if dangling:
+        while len(stack) > 1:
+            stack.pop()
+            writer.trace_leave(None)
+        mark_recovered(writer, stack, last_time or "", source, lines, skipped, dangling)
+        stack.pop()
+        #The time of the last line is the best guess for when the session ended
+        writer.trace_leave(last_time[:19] if last_time is not None else None)
+    return lines, skipped, dangling
+
+def recover_session(session: str, force: bool = False) -> RecoverResult:
+    if not force and not needs_recovery(session):
+        return RecoverResult(session, False, 0, 0, 0, None)
+
+    result = os.path.join(session, sessions.RESULT_FILE)
+    tmp = result + ".recover.tmp"
+    writer = None
+    try:
+        writer = ResultStreamWriter(tmp)
+        entries = sessions.iter_backup_entries(os.path.join(session, sessions.BACKUP_FILE))
+        lines, skipped, dangling = replay(entries, writer, sessions.BACKUP_FILE, True)
+        writer.close()
+        os.replace(tmp, result)
+        return RecoverResult(session, True, lines, skipped, dangling, None)
+    except (OSError, ValueError) as e:
+        if writer is not None:
+            writer.file.close()
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        return RecoverResult(session, False, 0, 0, 0, f"{type(e).__name__}: {e}")
+
+def recover_tree(root: str, workers: int | None = None, force: bool = False) -> List[RecoverResult]:
+    session_list = sessions.find_sessions(root)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(recover_session, session_list, [force] * len(session_list), chunksize=4))
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Result recovery'
+    )
+    parser.add_argument('root')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help="Rebuild complete results too")
+    args = parser.parse_args()
+
+    results = recover_tree(args.root, args.workers, args.force)
+
+    for r in results:
+        if r.error is not None:
+            print(f"Error in {r.session}: {r.error}")
+        elif r.recovered:
+            print(f"Recovered {r.session}: {r.lines} lines, {r.skipped} skipped, {r.dangling} traces closed")
+    recovered = sum(1 for r in results if r.recovered)
+    print(f"{len(results)} sessions, {recovered} recovered")
+
+if __name__ == "__main__":
+    main()
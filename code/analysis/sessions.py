@@ -0,0 +1,63 @@
+"""
+Helpers to find and read sessions in a results tree
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, Dict, Iterator, List
+
+from ..utils import binlog
+
+BACKUP_FILE = "backup.bak.txt"
+RESULT_FILE = "result.json"
+BINARY_FILE = binlog.LOG_FILE
+
+def find_sessions(root: str) -> List[str]:
+    """All folders below root that contain a session log"""
+    res = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if BACKUP_FILE in filenames or RESULT_FILE in filenames or BINARY_FILE in filenames:
+            res.append(dirpath)
+    return res
+
+def iter_backup_entries(path: str) -> Iterator[Dict[str, Any]]:
+    """Stream the line by line backup log, skipping lines cut off by a crash"""
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                pass
+
+def iter_result_entries(node: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Walk a result.json tree, yielding entries in the same format as the backup log"""
+    if node["type"] == "TRACE":
+        yield {"version": node["version"], "type": "TRACE_ENTER", "trace": node["trace"], "time": node["start_time"], "data": None}
+        for child in node["data"]:
+            yield from iter_result_entries(child)
+        if node["end_time"] is not None:
+            yield {"version": node["version"], "type": "TRACE_LEAVE", "trace": node["trace"], "time": node["end_time"], "data": None}
+    else:
+        yield {
+            "version": node["version"],
+            "type": node["data_type"],
+            "trace": node["trace"],
+            "time": node["time"],
+            "data": node["data"],
+        }
+
+def iter_session_entries(session: str) -> Iterator[Dict[str, Any]]:
+    """Log entries of a session, from the backup log or binary log if present, else from result.json"""
+    binary = os.path.join(session, BINARY_FILE)
+    if os.path.isfile(binary):
+        yield from binlog.iter_backup_entries(binary)
+        return
+    backup = os.path.join(session, BACKUP_FILE)
+    if os.path.isfile(backup):
+        yield from iter_backup_entries(backup)
+        return
+    with open(os.path.join(session, RESULT_FILE), "r") as f:
+        yield from iter_result_entries(json.load(f))
@@ -0,0 +1,439 @@
+"""
+Passive TLS 1.0-1.3 decryption of reassembled TCP streams, using NSS key log lines
+as written by tls_set_keylog_callback
+"""
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+import struct
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESCCM, AESGCM, ChaCha20Poly1305
+from cryptography.exceptions import InvalidTag
+
+CONTENT_CCS = 20
+CONTENT_ALERT = 21
+CONTENT_HANDSHAKE = 22
+CONTENT_APPDATA = 23
+
+HS_CLIENT_HELLO = 1
+HS_SERVER_HELLO = 2
+HS_FINISHED = 20
+
+EXT_ENCRYPT_THEN_MAC = 22
+EXT_SUPPORTED_VERSIONS = 43
+
+TLS10 = 0x0301
+TLS12 = 0x0303
+TLS13 = 0x0304
+
+#ServerHello random of a HelloRetryRequest
+HRR_RANDOM = bytes.fromhex("CF21AD74E59A6111BE1D8C021E65B891C2A211167ABB8C5E079E09E2C8A8339C")
+
+class TlsError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+class CipherSuite(NamedTuple):
+    name: str
+    #"CBC", "GCM", "CCM", "CHACHA"
+    kind: str
+    key_len: int
+    #Fixed IV from the key block (TLS 1.2), 16 for CBC (only used by TLS 1.0)
+    iv_len: int
+    #MAC hash for CBC suites, None for AEAD
+    mac: str | None
+    #PRF hash for TLS 1.2, HKDF hash for TLS 1.3
+    prf: str
+    tag_len: int = 16
+
+CIPHER_SUITES: Dict[int, CipherSuite] = {
+    #TLS 1.3
+    0x1301: CipherSuite("TLS_AES_128_GCM_SHA256", "GCM", 16, 12, None, "sha256"),
+    0x1302: CipherSuite("TLS_AES_256_GCM_SHA384", "GCM", 32, 12, None, "sha384"),
+    0x1303: CipherSuite("TLS_CHACHA20_POLY1305_SHA256", "CHACHA", 32, 12, None, "sha256"),
+    0x1304: CipherSuite("TLS_AES_128_CCM_SHA256", "CCM", 16, 12, None, "sha256"),
+    0x1305: CipherSuite("TLS_AES_128_CCM_8_SHA256", "CCM", 16, 12, None, "sha256", 8),
+    #TLS 1.2 CBC
+    0xC023: CipherSuite("ECDHE-ECDSA-AES128-SHA256", "CBC", 16, 16, "sha256", "sha256"),
+    0xC025: CipherSuite("ECDH-ECDSA-AES128-SHA256", "CBC", 16, 16, "sha256", "sha256"),
+    0xC024: CipherSuite("ECDHE-ECDSA-AES256-SHA384", "CBC", 32, 16, "sha384", "sha384"),
+    0xC027: CipherSuite("ECDHE-RSA-AES128-SHA256", "CBC", 16, 16, "sha256", "sha256"),
+    0xC028: CipherSuite("ECDHE-RSA-AES256-SHA384", "CBC", 32, 16, "sha384", "sha384"),
+    0x0067: CipherSuite("DHE-RSA-AES128-SHA256", "CBC", 16, 16, "sha256", "sha256"),
+    0x006B: CipherSuite("DHE-RSA-AES256-SHA256", "CBC", 32, 16, "sha256", "sha256"),
+    0x003C: CipherSuite("AES128-SHA256", "CBC", 16, 16, "sha256", "sha256"),
+    0x003D: CipherSuite("AES256-SHA256", "CBC", 32, 16, "sha256", "sha256"),
+    0xC009: CipherSuite("ECDHE-ECDSA-AES128-SHA", "CBC", 16, 16, "sha1", "sha256"),
+    0xC00A: CipherSuite("ECDHE-ECDSA-AES256-SHA", "CBC", 32, 16, "sha1", "sha256"),
+    0xC013: CipherSuite("ECDHE-RSA-AES128-SHA", "CBC", 16, 16, "sha1", "sha256"),
+    0xC014: CipherSuite("ECDHE-RSA-AES256-SHA", "CBC", 32, 16, "sha1", "sha256"),
+    0x0033: CipherSuite("DHE-RSA-AES128-SHA", "CBC", 16, 16, "sha1", "sha256"),
+    0x0039: CipherSuite("DHE-RSA-AES256-SHA", "CBC", 32, 16, "sha1", "sha256"),
+    0x002F: CipherSuite("AES128-SHA", "CBC", 16, 16, "sha1", "sha256"),
+    0x0035: CipherSuite("AES256-SHA", "CBC", 32, 16, "sha1", "sha256"),
+    #TLS 1.2 AEAD
+    0xC02B: CipherSuite("ECDHE-ECDSA-AES128-GCM-SHA256", "GCM", 16, 4, None, "sha256"),
+    0xC02C: CipherSuite("ECDHE-ECDSA-AES256-GCM-SHA384", "GCM", 32, 4, None, "sha384"),
+    0xC02F: CipherSuite("ECDHE-RSA-AES128-GCM-SHA256", "GCM", 16, 4, None, "sha256"),
+    0xC030: CipherSuite("ECDHE-RSA-AES256-GCM-SHA384", "GCM", 32, 4, None, "sha384"),
+    0x009E: CipherSuite("DHE-RSA-AES128-GCM-SHA256", "GCM", 16, 4, None, "sha256"),
+    0x009F: CipherSuite("DHE-RSA-AES256-GCM-SHA384", "GCM", 32, 4, None, "sha384"),
+    0x009C: CipherSuite("AES128-GCM-SHA256", "GCM", 16, 4, None, "sha256"),
+    0x009D: CipherSuite("AES256-GCM-SHA384", "GCM", 32, 4, None, "sha384"),
+    0xC0AC: CipherSuite("ECDHE-ECDSA-AES128-CCM", "CCM", 16, 4, None, "sha256"),
+    0xC0AD: CipherSuite("ECDHE-ECDSA-AES256-CCM", "CCM", 32, 4, None, "sha256"),
+    0xC0AE: CipherSuite("ECDHE-ECDSA-AES128-CCM8", "CCM", 16, 4, None, "sha256", 8),
+    0xC0AF: CipherSuite("ECDHE-ECDSA-AES256-CCM8", "CCM", 32, 4, None, "sha256", 8),
+    0xCCA8: CipherSuite("ECDHE-RSA-CHACHA20-POLY1305", "CHACHA", 32, 12, None, "sha256"),
+    0xCCA9: CipherSuite("ECDHE-ECDSA-CHACHA20-POLY1305", "CHACHA", 32, 12, None, "sha256"),
+    0xCCAA: CipherSuite("DHE-RSA-CHACHA20-POLY1305", "CHACHA", 32, 12, None, "sha256"),
+}
+
+MAC_LEN = {"sha1": 20, "sha256": 32, "sha384": 48}
+
+# Key log
+
+class KeyLog():
+    """Secrets from NSS key log lines, by client random"""
+    secrets: Dict[bytes, Dict[str, bytes]]
+
+    def __init__(self):
+        self.secrets = {}
+
+    def add_line(self, line: str):
+        parts = line.strip().split(" ")
+        if len(parts) != 3 or parts[0].startswith("#"):
+            return
+        try:
+            client_random = bytes.fromhex(parts[1])
+            secret = bytes.fromhex(parts[2])
+        except ValueError:
+            return
+        self.secrets.setdefault(client_random, {})[parts[0]] = secret
+
+    def add_file(self, path: str):
+        with open(path, "r", errors="replace") as f:
+            for line in f:
+                self.add_line(line)
+
+    def get(self, client_random: bytes, label: str) -> bytes | None:
+        return self.secrets.get(client_random, {}).get(label, None)
+
+# Key derivation
+
+def p_hash(hash_name: str, secret: bytes, seed: bytes, length: int) -> bytes:
+    res = b""
+    a = seed
+    while len(res) < length:
+        a = hmac.new(secret, a, hash_name).digest()
+        res += hmac.new(secret, a + seed, hash_name).digest()
+    return res[:length]
+
+def prf(version: int, hash_name: str, secret: bytes, label: bytes, seed: bytes, length: int) -> bytes:
+    if version >= TLS12:
+        return p_hash(hash_name, secret, label + seed, length)
+    #TLS 1.0/1.1: MD5 and SHA1 halves xored
+    half = (len(secret) + 1) // 2
+    md5 = p_hash("md5", secret[:half], label + seed, length)
+    sha = p_hash("sha1", secret[len(secret) - half:], label + seed, length)
+    return bytes(a ^ b for a, b in zip(md5, sha))
+
+def hkdf_expand_label(hash_name: str, secret: bytes, label: bytes, context: bytes, length: int) -> bytes:
+    full_label = b"tls13 " + label
+    info = struct.pack(">HB", length, len(full_label)) + full_label + struct.pack(">B", len(context)) + context
+    res = b""
+    block = b""
+    i = 1
+    while len(res) < length:
+        block = hmac.new(secret, block + info + bytes([i]), hash_name).digest()
+        res += block
+        i += 1
+    return res[:length]
+
+# Record protection
+
+class RecordDecryptor():
+    """Decrypts the records of one direction with one set of keys"""
+    suite: CipherSuite
+    version: int
+    key: bytes
+    iv: bytes
+    mac_key: bytes
+    encrypt_then_mac: bool
+    seq: int
+
+    def __init__(self, suite: CipherSuite, version: int, key: bytes, iv: bytes, mac_key: bytes = b"", encrypt_then_mac: bool = False):
+        self.suite = suite
+        self.version = version
+        self.key = key
+        self.iv = iv
+        self.mac_key = mac_key
+        self.encrypt_then_mac = encrypt_then_mac
+        self.seq = 0
+
+        self.aead: Callable[[bytes, bytes, bytes], bytes] | None = None
+        if suite.kind == "GCM":
+            self.aead = AESGCM(key).decrypt
+        elif suite.kind == "CCM":
+            self.aead = AESCCM(key, suite.tag_len).decrypt
+        elif suite.kind == "CHACHA":
+            self.aead = ChaCha20Poly1305(key).decrypt
+
+    def xor_nonce(self) -> bytes:
+        seq = self.seq.to_bytes(len(self.iv), "big")
+        return bytes(a ^ b for a, b in zip(self.iv, seq))
+
+    def decrypt(self, content_type: int, version: int, payload: bytes) -> Tuple[int, bytes]:
+        """Returns (content type, plaintext)"""
+        try:
+            if self.version == TLS13:
+                return self._decrypt_tls13(content_type, version, payload)
+            if self.aead is not None:
+                return content_type, self._decrypt_aead12(content_type, version, payload)
+            return content_type, self._decrypt_cbc(payload)
+        finally:
+            self.seq += 1
+
+    def _decrypt_tls13(self, content_type: int, version: int, payload: bytes) -> Tuple[int, bytes]:
+        assert self.aead is not None
+        aad = struct.pack(">BHH", content_type, version, len(payload))
+        try:
+            inner = self.aead(self.xor_nonce(), payload, aad)
+        except InvalidTag:
+            raise TlsError("Bad record tag")
+        inner = inner.rstrip(b"\x00")
+        if len(inner) == 0:
+            raise TlsError("Empty inner plaintext")
+        return inner[-1], inner[:-1]
+
+    def _decrypt_aead12(self, content_type: int, version: int, payload: bytes) -> bytes:
+        assert self.aead is not None
+        if self.suite.kind == "CHACHA":
+            nonce = self.xor_nonce()
+            ciphertext = payload
+        else:
+            nonce = self.iv + payload[:8]
+            ciphertext = payload[8:]
+        aad = struct.pack(">QBHH", self.seq, content_type, version, len(ciphertext) - self.suite.tag_len)
+        try:
+            return self.aead(nonce, ciphertext, aad)
+        except InvalidTag:
+            raise TlsError("Bad record tag")
+
+    def _decrypt_cbc(self, payload: bytes) -> bytes:
+        assert self.suite.mac is not None
+        mac_len = MAC_LEN[self.suite.mac]
+        if self.encrypt_then_mac:
+            payload = payload[:-mac_len]
+
+        if self.version >= 0x0302:
+            iv = payload[:16]
+            ciphertext = payload[16:]
+        else:
+            #TLS 1.0: IV is the last ciphertext block of the previous record
+            iv = self.iv
+            ciphertext = payload
+            self.iv = ciphertext[-16:]
+
+        if len(ciphertext) == 0 or len(ciphertext) % 16 != 0:
+            raise TlsError("Bad CBC record length")
+        decryptor = Cipher(algorithms.AES(self.key), modes.CBC(iv)).decryptor()
+        plain = decryptor.update(ciphertext) + decryptor.finalize()
+
+        pad = plain[-1] + 1
+        if pad > len(plain):
+            raise TlsError("Bad CBC padding")
+        plain = plain[:-pad]
+        if not self.encrypt_then_mac:
+            plain = plain[:-mac_len]
+        return plain
+
+# Connection state
+
+def parse_handshake_messages(buf: bytearray) -> List[Tuple[int, bytes]]:
+    """Pop all complete handshake messages from buf"""
+    res = []
+    while len(buf) >= 4:
+        length = int.from_bytes(buf[1:4], "big")
+        if len(buf) < 4 + length:
+            break
+        res.append((buf[0], bytes(buf[4:4 + length])))
+        del buf[:4 + length]
+    return res
+
+def parse_extensions(body: bytes, offset: int) -> Dict[int, bytes]:
+    res = {}
+    if offset + 2 > len(body):
+        return res
+    end = offset + 2 + int.from_bytes(body[offset:offset + 2], "big")
+    offset += 2
+    while offset + 4 <= end:
+        ext_type, ext_len = struct.unpack_from(">HH", body, offset)
+        res[ext_type] = body[offset + 4: offset + 4 + ext_len]
+        offset += 4 + ext_len
+    return res
+
+class TlsDirection():
+    buf: bytearray
+    hs_buf: bytearray
+    decryptor: RecordDecryptor | None
+    #Pending keys, switched to after this direction's Finished (TLS 1.3) or its ChangeCipherSpec (TLS 1.2)
+    next_decryptor: RecordDecryptor | None
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.hs_buf = bytearray()
+        self.decryptor = None
+        self.next_decryptor = None
+
+class TlsConnection():
+    """
+    Follows both directions of a TLS connection. feed() returns decrypted application data.
+    Direction 0 is the client (EV), 1 the server (SECC).
+    """
+    keylog: KeyLog
+    dirs: Tuple[TlsDirection, TlsDirection]
+
+    client_random: bytes | None
+    server_random: bytes | None
+    version: int | None
+    suite_id: int | None
+    encrypt_then_mac: bool
+
+    error: str | None
+
+    def __init__(self, keylog: KeyLog):
+        self.keylog = keylog
+        self.dirs = (TlsDirection(), TlsDirection())
+
+        self.client_random = None
+        self.server_random = None
+        self.version = None
+        self.suite_id = None
+        self.encrypt_then_mac = False
+
+        self.error = None
+
+    @property
+    def suite(self) -> CipherSuite | None:
+        if self.suite_id is None:
+            return None
+        return CIPHER_SUITES.get(self.suite_id, None)
+
+    def info(self):
+        return {
+            "version": self.version,
+            "suite": self.suite.name if self.suite is not None else self.suite_id,
+            "keys": self.client_random is not None and self.client_random in self.keylog.secrets,
+            "error": self.error,
+        }
+
+    def feed(self, direction: int, data: bytes) -> List[bytes]:
+        d = self.dirs[direction]
+        d.buf += data
+        res = []
+        while len(d.buf) >= 5:
+            content_type, version, length = struct.unpack_from(">BHH", d.buf, 0)
+            if len(d.buf) < 5 + length:
+                break
+            payload = bytes(d.buf[5:5 + length])
+            del d.buf[:5 + length]
+            if self.error is not None:
+                continue
+            try:
+                plain = self.on_record(direction, content_type, version, payload)
+                if plain is not None:
+                    res.append(plain)
+            except TlsError as e:
+                self.error = str(e)
+        return res
+
+    def on_record(self, direction: int, content_type: int, version: int, payload: bytes) -> bytes | None:
+        d = self.dirs[direction]
+
+        if content_type == CONTENT_CCS:
+            #TLS 1.3 sends it only for middlebox compatibility
+            if self.version != TLS13:
+                d.decryptor = d.next_decryptor
+                d.next_decryptor = None
+            return None
+
+        if d.decryptor is not None:
+            content_type, payload = d.decryptor.decrypt(content_type, version, payload)
+        elif content_type == CONTENT_APPDATA:
+            raise TlsError("Encrypted record without keys")
+
+        if content_type == CONTENT_HANDSHAKE:
+            d.hs_buf += payload
+            for hs_type, body in parse_handshake_messages(d.hs_buf):
+                self.on_handshake(direction, hs_type, body)
+            return None
+        if content_type == CONTENT_APPDATA:
+            return payload
+        return None
+
+    def on_handshake(self, direction: int, hs_type: int, body: bytes):
+        if hs_type == HS_CLIENT_HELLO and direction == 0:
+            self.client_random = body[2:34]
+        elif hs_type == HS_SERVER_HELLO and direction == 1:
+            if body[2:34] == HRR_RANDOM:
+                return
+            self.server_random = body[2:34]
+            session_id_len = body[34]
+            offset = 35 + session_id_len
+            self.suite_id = int.from_bytes(body[offset:offset + 2], "big")
+            exts = parse_extensions(body, offset + 3)
+            self.version = int.from_bytes(body[0:2], "big")
+            if EXT_SUPPORTED_VERSIONS in exts:
+                self.version = int.from_bytes(exts[EXT_SUPPORTED_VERSIONS][0:2], "big")
+            self.encrypt_then_mac = EXT_ENCRYPT_THEN_MAC in exts
+            self.setup_keys()
+        elif hs_type == HS_FINISHED and self.version == TLS13:
+            d = self.dirs[direction]
+            d.decryptor = d.next_decryptor
+            d.next_decryptor = None
+
+    def setup_keys(self):
+        suite = self.suite
+        if suite is None:
+            raise TlsError(f"Unsupported cipher suite {self.suite_id}")
+        assert self.version is not None and self.client_random is not None and self.server_random is not None
+
+        if self.version == TLS13:
+            secrets = [self.keylog.get(self.client_random, label) for label in [
+                "CLIENT_HANDSHAKE_TRAFFIC_SECRET", "SERVER_HANDSHAKE_TRAFFIC_SECRET",
+                "CLIENT_TRAFFIC_SECRET_0", "SERVER_TRAFFIC_SECRET_0",
+            ]]
+            if any(s is None for s in secrets):
+                raise TlsError("Missing TLS 1.3 secrets")
+
+            def make(secret: bytes) -> RecordDecryptor:
+                key = hkdf_expand_label(suite.prf, secret, b"key", b"", suite.key_len)
+                iv = hkdf_expand_label(suite.prf, secret, b"iv", b"", 12)
+                return RecordDecryptor(suite, TLS13, key, iv)
+
+            #Everything after the ServerHello is encrypted with the handshake keys, until Finished
+            for i in range(2):
+                self.dirs[i].decryptor = make(secrets[i])#type: ignore
+                self.dirs[i].next_decryptor = make(secrets[2 + i])#type: ignore
+            return
+
+        master = self.keylog.get(self.client_random, "CLIENT_RANDOM")
+        if master is None:
+            raise TlsError("Missing master secret")
+        mac_len = MAC_LEN[suite.mac] if suite.mac is not None else 0
+        iv_len = suite.iv_len if (suite.kind != "CBC" or self.version < 0x0302) else 0
+        block = prf(self.version, suite.prf, master, b"key expansion",
+                    self.server_random + self.client_random, 2 * (mac_len + suite.key_len + iv_len))
+        parts = []
+        offset = 0
+        for length in [mac_len, mac_len, suite.key_len, suite.key_len, iv_len, iv_len]:
+            parts.append(block[offset:offset + length])
+            offset += length
+        #Switched to on ChangeCipherSpec
+        for i in range(2):
+            self.dirs[i].next_decryptor = RecordDecryptor(suite, self.version, parts[2 + i], parts[4 + i], parts[i], self.encrypt_then_mac)
@@ -0,0 +1,344 @@
+"""
+Index every V2GTP message of a session from its capture: TCP streams are reassembled,
+TLS is decrypted with the session keys, and the frames are written to v2g.index.json
+
+Usage: python -m code.analysis.v2g_indexer results/ [--workers N] [--force]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from . import pcap_reader, sessions
+from .tls_decrypt import KeyLog, TlsConnection
+
+INDEX_FILE = "v2g.index.json"
+KEY_LOG_FILE = "../key.log"
+
+ETH_P_IPV4 = 0x0800
+ETH_P_IPV6 = 0x86DD
+ETH_P_VLAN = (0x8100, 0x88A8)
+IPPROTO_TCP = 6
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+TLS_CONTENT_TYPES = (20, 21, 22, 23)
+
+V2GTP_VERSION = 0x01
+V2GTP_HEADER_LEN = 8
+
+#(address, port)
+Endpoint = Tuple[str, int]
+
+class TcpSegment(NamedTuple):
+    ts: int
+    src: Endpoint
+    dst: Endpoint
+    seq: int
+    flags: int
+    payload: bytes
+
+def ip_str(b: bytes) -> str:
+    if len(b) == 4:
+        return ".".join(str(x) for x in b)
+    return ":".join(b[i:i + 2].hex() for i in range(0, 16, 2))
+
+def parse_tcp(ts: int, frame: bytes) -> TcpSegment | None:
+    """Ethernet (optionally VLAN tagged) / IPv6 or IPv4 / TCP"""
+    if len(frame) < 14:
+        return None
+    ethertype = struct.unpack_from(">H", frame, 12)[0]
+    offset = 14
+    while ethertype in ETH_P_VLAN and len(frame) >= offset + 4:
+        ethertype = struct.unpack_from(">H", frame, offset + 2)[0]
+        offset += 4
+
+    if ethertype == ETH_P_IPV6:
+        if len(frame) < offset + 40:
+            return None
+        payload_len = struct.unpack_from(">H", frame, offset + 4)[0]
+        if frame[offset + 6] != IPPROTO_TCP:
+            return None
+        src = ip_str(frame[offset + 8:offset + 24])
+        dst = ip_str(frame[offset + 24:offset + 40])
+        end = offset + 40 + payload_len
+        offset += 40
+    elif ethertype == ETH_P_IPV4:
+        if len(frame) < offset + 20:
+            return None
+        ihl = (frame[offset] & 0x0F) * 4
+        total_len = struct.unpack_from(">H", frame, offset + 2)[0]
+        if frame[offset + 9] != IPPROTO_TCP:
+            return None
+        src = ip_str(frame[offset + 12:offset + 16])
+        dst = ip_str(frame[offset + 16:offset + 20])
+        end = offset + total_len
+        offset += ihl
+    else:
+        return None
+
+    if len(frame) < offset + 20:
+        return None
+    sport, dport, seq, _, off_flags = struct.unpack_from(">HHIIH", frame, offset)
+    data_offset = (off_flags >> 12) * 4
+    flags = off_flags & 0x3F
+    return TcpSegment(ts, (src, sport), (dst, dport), seq, flags, frame[offset + data_offset:end])
+
+class TcpDirection():
+    """In order byte stream of one direction, buffering segments that arrive early"""
+    next_seq: int | None
+    pending: Dict[int, Tuple[int, bytes]]
+
+    def __init__(self):
+        self.next_seq = None
+        self.pending = {}
+
+    def add(self, seg: TcpSegment) -> List[Tuple[int, bytes]]:
+        """Returns the (timestamp, data) chunks that became contiguous"""
+        if seg.flags & TCP_SYN:
+            self.next_seq = (seg.seq + 1) & 0xFFFFFFFF
+            return []
+        if len(seg.payload) == 0:
+            return []
+        if self.next_seq is None:
+            #Capture started mid connection
+            self.next_seq = seg.seq
+
+        self.pending[seg.seq] = (seg.ts, seg.payload)
+        res = []
+        while True:
+            chunk = self.pop_next()
+            if chunk is None:
+                break
+            res.append(chunk)
+        return res
+
+    def pop_next(self) -> Tuple[int, bytes] | None:
+        assert self.next_seq is not None
+        for seq, (ts, data) in list(self.pending.items()):
+            #Distance from the expected sequence number, modulo wrap around
+            rel = (seq - self.next_seq) & 0xFFFFFFFF
+            if rel >= 0x80000000:
+                #Retransmission overlapping data already delivered
+                overlap = (self.next_seq - seq) & 0xFFFFFFFF
+                del self.pending[seq]
+                if overlap < len(data):
+                    self.next_seq = (self.next_seq + len(data) - overlap) & 0xFFFFFFFF
+                    return (ts, data[overlap:])
+                continue
+            if rel == 0:
+                del self.pending[seq]
+                self.next_seq = (self.next_seq + len(data)) & 0xFFFFFFFF
+                return (ts, data)
+        return None
+
+class V2gtpParser():
+    buf: bytearray
+    ts: int
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.ts = 0
+
+    def feed(self, ts: int, data: bytes) -> List[Tuple[int, int, bytes]]:
+        """Returns (timestamp of the first byte, payload type, payload) of each complete frame"""
+        if len(self.buf) == 0:
+            self.ts = ts
+        self.buf += data
+        res = []
+        while len(self.buf) >= V2GTP_HEADER_LEN:
+            version, inv_version, payload_type, length = struct.unpack_from(">BBHI", self.buf, 0)
+            if version != V2GTP_VERSION or inv_version != version ^ 0xFF:
+                #Not V2GTP, resynchronise on the next byte
+                del self.buf[:1]
+                continue
+            if len(self.buf) < V2GTP_HEADER_LEN + length:
+                break
+            res.append((self.ts, payload_type, bytes(self.buf[V2GTP_HEADER_LEN:V2GTP_HEADER_LEN + length])))
+            del self.buf[:V2GTP_HEADER_LEN + length]
+            self.ts = ts
+        return res
+
+class Connection():
+    id: int
+    client: Endpoint
+    server: Endpoint
+    start: int
+    dirs: Tuple[TcpDirection, TcpDirection]
+    parsers: Tuple[V2gtpParser, V2gtpParser]
+    #None until the first payload shows whether the stream is TLS
+    tls: TlsConnection | None
+    plain: bool | None
+    closed: bool
+
+    def __init__(self, id: int, client: Endpoint, server: Endpoint, start: int):
+        self.id = id
+        self.client = client
+        self.server = server
+        self.start = start
+        self.dirs = (TcpDirection(), TcpDirection())
+        self.parsers = (V2gtpParser(), V2gtpParser())
+        self.tls = None
+        self.plain = None
+        self.closed = False
+
+    def to_json(self):
+        res: Dict[str, Any] = {
+            "id": self.id,
+            "client": list(self.client),
+            "server": list(self.server),
+            "start": self.start,
+            "tls": self.tls.info() if self.tls is not None else None,
+        }
+        return res
+
+class SessionIndexer():
+    keylog: KeyLog
+    connections: Dict[Tuple[Endpoint, Endpoint], Connection]
+    all_connections: List[Connection]
+    #[timestamp ns, connection id, direction (0 EV to SECC, 1 SECC to EV), payload type, payload hex]
+    frames: List[List[Any]]
+
+    def __init__(self, keylog: KeyLog):
+        self.keylog = keylog
+        self.connections = {}
+        self.all_connections = []
+        self.frames = []
+
+    def lookup(self, seg: TcpSegment) -> Tuple[Connection, int] | None:
+        conn = self.connections.get((seg.src, seg.dst), None)
+        if conn is not None:
+            return conn, 0
+        conn = self.connections.get((seg.dst, seg.src), None)
+        if conn is not None:
+            return conn, 1
+        return None
+
+    def new_connection(self, client: Endpoint, server: Endpoint, ts: int) -> Connection:
+        conn = Connection(len(self.all_connections), client, server, ts)
+        self.connections[(client, server)] = conn
+        self.all_connections.append(conn)
+        return conn
+
+    def add_segment(self, seg: TcpSegment):
+        found = self.lookup(seg)
+        if seg.flags & TCP_SYN and not seg.flags & TCP_ACK:
+            #The EV opens the connection, a new SYN on the same ports replaces an old connection
+            if found is None or found[0].closed or found[1] == 0 and found[0].dirs[0].next_seq != (seg.seq + 1) & 0xFFFFFFFF:
+                found = (self.new_connection(seg.src, seg.dst, seg.ts), 0)
+        if found is None:
+            if len(seg.payload) == 0:
+                return
+            #Capture started mid connection, assume the higher port is the client
+            if seg.src[1] > seg.dst[1]:
+                found = (self.new_connection(seg.src, seg.dst, seg.ts), 0)
+            else:
+                found = (self.new_connection(seg.dst, seg.src, seg.ts), 1)
+
+        conn, direction = found
+        for ts, data in conn.dirs[direction].add(seg):
+            self.add_stream_data(conn, direction, ts, data)
+        if seg.flags & (TCP_FIN | TCP_RST):
+            conn.closed = True
+
+    def add_stream_data(self, conn: Connection, direction: int, ts: int, data: bytes):
+        if conn.plain is None:
+            conn.plain = data[0] not in TLS_CONTENT_TYPES
+            if not conn.plain:
+                conn.tls = TlsConnection(self.keylog)
+
+        if conn.tls is not None:
+            chunks = conn.tls.feed(direction, data)
+        else:
+            chunks = [data]
+        for chunk in chunks:
+            for frame_ts, payload_type, payload in conn.parsers[direction].feed(ts, chunk):
+                self.frames.append([frame_ts, conn.id, direction, payload_type, payload.hex()])
+
+    def to_json(self):
+        return {
+            "version": 1,
+            "connections": [c.to_json() for c in self.all_connections],
+            "frames": self.frames,
+        }
+
+def session_keylog(session: str) -> KeyLog:
+    """Keys from the session log, plus the shared key.log written next to the sessions"""
+    keylog = KeyLog()
+    for entry in sessions.iter_session_entries(session):
+        if entry.get("type") == "KEYS" and isinstance(entry.get("data"), str):
+            keylog.add_line(entry["data"])
+    path = os.path.join(session, KEY_LOG_FILE)
+    if os.path.isfile(path):
+        keylog.add_file(path)
+    return keylog
+
+class IndexResult(NamedTuple):
+    session: str
+    connections: int
+    frames: int
+    skipped: bool
+    error: str | None
+
+def index_session(session: str, force: bool = False) -> IndexResult:
+    index_path = os.path.join(session, INDEX_FILE)
+    try:
+        captures = pcap_reader.session_capture_files(session)
+        if len(captures) == 0:
+            return IndexResult(session, 0, 0, True, None)
+        if not force and os.path.isfile(index_path):
+            newest = max(os.path.getmtime(p) for p in captures)
+            if os.path.getmtime(index_path) >= newest:
+                return IndexResult(session, 0, 0, True, None)
+
+        indexer = SessionIndexer(session_keylog(session))
+        for ts, frame in pcap_reader.iter_session_frames(session):
+            seg = parse_tcp(ts, frame)
+            if seg is not None:
+                indexer.add_segment(seg)
+
+        tmp = index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(indexer.to_json(), f, separators=(",", ":"))
+        os.replace(tmp, index_path)
+        return IndexResult(session, len(indexer.all_connections), len(indexer.frames), False, None)
+    except (OSError, ValueError, KeyError, pcap_reader.PcapError) as e:
+        return IndexResult(session, 0, 0, False, f"{type(e).__name__}: {e}")
+
+def index_tree(root: str, workers: int | None = None, force: bool = False) -> List[IndexResult]:
+    session_list = sessions.find_sessions(root)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(index_session, session_list, [force] * len(session_list), chunksize=4))
+
+def load_index(session: str) -> Dict[str, Any]:
+    with open(os.path.join(session, INDEX_FILE), "r") as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='V2G indexer'
+    )
+    parser.add_argument('root')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+
+    results = index_tree(args.root, args.workers, args.force)
+
+    for r in results:
+        if r.error is not None:
+            print(f"Error in {r.session}: {r.error}")
+    indexed = [r for r in results if not r.skipped and r.error is None]
+    frames = sum(r.frames for r in indexed)
+    print(f"{len(results)} sessions, {len(indexed)} indexed, {frames} V2GTP frames")
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ from .interface import socket_wrapper
 import contextlib
 
 from .utils import data_saver 
+from .utils import loop_monitor, metrics, settings
 
 #import v2g.protocol_version as protocol_version
 from .interface.bs_measure import CPMeasurementThread
@@ -54,6 +55,7 @@ async def final_cleanup(ctrl: Controller):
         yield None
     finally:
         await ctrl.do_reset()
+        await ctrl.on_session_end()
 
 #
 # Controller base class
@@ -72,6 +74,9 @@ class Controller:
 
     sock: socket_wrapper.WrappedSocket | None
 
+    #Only with --loop-monitor
+    loop_monitor: loop_monitor.LoopMonitor | None
+
     args: Any
 
     def __init__(self, interface: str, args):
@@ -82,6 +87,7 @@ class Controller:
         self.basic_signalling = CPMeasurementThread()
         
         self.sock = None
+        self.loop_monitor = None
 
         self.tasks_all = []
         self.tasks_run = []
@@ -94,6 +100,16 @@ class Controller:
 
         self.args = args
 
+        metrics.DATASAVER_QUEUE_DEPTH.add_function(self.queue_depth_metrics)
+
+    def queue_depth_metrics(self):
+        depth, max_depth = self.logger.queue_depth()
+        return {("depth",): depth, ("max_depth",): max_depth}
+
+    def on_loop_stall(self, stall: loop_monitor.LoopStall):
+        if self.logger.backup_file is not None:
+            self.logger.log_entry("LOOP_STALL", stall.to_json())
+
     def add_task(self, task, run):
         self.tasks_all.append(task)
         if run:
@@ -104,6 +120,14 @@ class Controller:
     async def do_reset(self):
         pass
 
+    async def on_session_start(self):
+        """Called once the user started a session and its log and capture are open, before any task runs"""
+        pass
+
+    async def on_session_end(self):
+        """Called after the last task of a session, also when it was cut short"""
+        pass
+
     async def wait_should_enable(self):
         try:
             await self.ui.waiter_plug.wait_user()
@@ -148,19 +172,27 @@ class Controller:
         for exp in self.tasks_all:
             await exp.reset()
 
-        with self.logger.trace_file_start(f"{desc.name}_{desc.box}_{desc.plug}") as _:
-            with self.logger.trace_enter("CHARGER"):
-                with pcap_wrapper.pcap_context( self.interface, os.path.join(self.logger.result_subfolder, "pcap.pcap") ) as _:
-                    async with final_cleanup(self) as _:
+        with self.logger.trace_file_start(data_saver.session_name(desc.name, desc.box, desc.plug)) as _:
+            if self.loop_monitor is not None:
+                self.loop_monitor.reset()
+            try:
+                with self.logger.trace_enter("CHARGER"):
+                    with pcap_wrapper.pcap_context( self.interface, os.path.join(self.logger.result_subfolder, "pcap.pcap") ) as _:
+                        async with final_cleanup(self) as _:
 
-                        self.logger.log_entry("INFO", desc.to_json())
-                        await asyncio.sleep(0.5)
+                            self.logger.log_entry("INFO", desc.to_json())
+                            #Inside the trace and capture, so that anything started here is recorded with the session
+                            await self.on_session_start()
+                            await asyncio.sleep(0.5)
 
-                        if res == "start_all":
-                            await self.run_session_all()
+                            if res == "start_all":
+                                await self.run_session_all()
 
-                        await self.run_session_manual()
-                        
+                            await self.run_session_manual()
+            finally:
+                #Also for sessions that were cut short, those are the interesting ones
+                if self.loop_monitor is not None:
+                    self.logger.log_entry("LOOP_LAG", self.loop_monitor.summary())
 
         print("Session done")
         return False
@@ -173,8 +205,13 @@ class Controller:
 
         signal.signal(signal.SIGTERM, sigterm_handler)
 
-        task_server = asyncio.create_task(self.ui.start_websocket_server())
+        task_server = asyncio.create_task(self.ui.start_websocket_server(port=self.args.ws_port))
         task_measure = asyncio.create_task(self.basic_signalling.run_thread())
+        metrics_server = await metrics.serve(self.args.metrics_port, settings.METRICS_HOST)
+        if self.args.loop_monitor:
+            self.loop_monitor = loop_monitor.LoopMonitor()
+            self.loop_monitor.stall_listeners.append(self.on_loop_stall)
+            self.loop_monitor.start()
 
         def sigint_handler(_signo, _stack_frame):
             pass
@@ -190,6 +227,10 @@ class Controller:
         finally:
             task_server.cancel()
             task_measure.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+            if self.loop_monitor is not None:
+                self.loop_monitor.stop()
 
             await asyncio.gather(task_server, task_measure)
 
@@ -12,6 +12,7 @@ from .interface import socket_wrapper
 from .interface import hal
 from . import controller
 from . import pcap_wrapper
+from .v2g.supported_app_protocol import PROTO_TESTS_EV
 
 import asyncio
 
@@ -23,6 +24,10 @@ class ControllerEV(controller.Controller):
 
     sdp: sdp.SDPRequest | None
 
+    slac_prearm: slac.SlacPrearm | None
+    prearm_task: asyncio.Future | None
+    exi_warm_task: asyncio.Future | None
+
     def __init__(self, interface: str, args):
         super().__init__(interface, args)
         slac.ev_init(interface)
@@ -32,6 +37,10 @@ class ControllerEV(controller.Controller):
         self.sdp = None
         self.sock = None
 
+        self.slac_prearm = None
+        self.prearm_task = None
+        self.exi_warm_task = None
+
     async def on_slac_status(self, progress: slac.SlacProgress, done: bool):
         print(f"SLAC status: {progress.name} {done}")
         await self.ui.state_slac.set_state(progress, done)
@@ -51,18 +60,83 @@ class ControllerEV(controller.Controller):
         #Connect car
         self.hardware.plug_sniff()
 
-        await self.basic_signalling.wait_ev_charger_connected(None)
+        last = {}
+        async def keep_last(meas):
+            last["meas"] = meas
+
+        await self.basic_signalling.wait_ev_charger_connected(keep_last)
+        if "meas" in last:
+            self.logger.log_entry("CP", {"phase": "connected", **last.pop("meas").to_json()})
 
         self.hardware.plug_connect()
         
-        await self.basic_signalling.wait_ev_charger_ready(None)
+        await self.basic_signalling.wait_ev_charger_ready(keep_last)
+        if "meas" in last:
+            self.logger.log_entry("CP", {"phase": "ready", **last.pop("meas").to_json()})
+
+    async def on_session_start(self):
+        self.start_prearm()
+
+    async def _prearm(self) -> slac.SlacPrearm:
+        self.slac_prearm = await slac.ev_prearm(self.slac_prearm, self.on_slac_status)
+        return self.slac_prearm
+
+    async def _exi_warm_up(self):
+        #First requests to the EXI server are slow, get that out of the way before the charger waits on us
+        try:
+            await PROTO_TESTS_EV["ALL"].encode()
+        except Exception:
+            print("EXI warm-up failed")
+
+    async def on_session_end(self):
+        #Nothing started for this session may carry over to the next one
+        for task in [self.prearm_task, self.exi_warm_task]:
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self.prearm_task = None
+        self.exi_warm_task = None
+
+    @staticmethod
+    def task_failed(task: asyncio.Future | None) -> bool:
+        """Done without a result, the exception is retrieved here so that it is not reported as lost"""
+        if task is None or not task.done():
+            return False
+        if task.cancelled():
+            return True
+        e = task.exception()
+        if e is not None:
+            print(f"Background preparation failed: {type(e).__name__}: {e}")
+            return True
+        return False
+
+    def start_prearm(self):
+        """Start the charger independent SLAC preparation in the background, a failed earlier one is started again"""
+        if self.task_failed(self.prearm_task):
+            self.prearm_task = None
+        if self.task_failed(self.exi_warm_task):
+            self.exi_warm_task = None
+        if self.prearm_task is None:
+            self.prearm_task = asyncio.ensure_future(self._prearm())
+        if self.exi_warm_task is None:
+            self.exi_warm_task = asyncio.ensure_future(self._exi_warm_up())
 
     async def do_slac_prepare(self):
-        await slac.ev_prepare(self.logger, self.on_slac_status)
+        self.start_prearm()
+        prearm_task = self.prearm_task
+        #Consumed, the next retry starts a new one (which reuses the cached result if still armed)
+        self.prearm_task = None
+        await prearm_task
+        await slac.ev_prepare(self.logger, self.on_slac_status, self.slac_prearm)
 
     async def do_slac(self) -> slac.SlacResult:
+        if self.slac_prearm is None:
+            raise ValueError("No SLAC preparation before SLAC")
         #Execute SLAC
-        slac_res = await slac.ev_run(self.logger, self.on_slac_status)
+        slac_res = await slac.ev_run(self.logger, self.on_slac_status, self.slac_prearm)
 
         return slac_res
 
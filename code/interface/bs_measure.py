@@ -6,6 +6,7 @@ from __future__ import annotations
 
 from ..utils import settings
 from ..utils.dataevent import DataEvent
+from ..utils import metrics
 
 from . import hal
 from . import adc_cal
@@ -173,10 +174,21 @@ class CPMeasurementThread():
     async def run_thread(self):
         _last_state = None
         _last_state_i = CPState.CP_STATE_UB
+        #Samples since rate_start, for the sample rate metric
+        rate_count = 0
+        rate_start = time.monotonic()
 
         while True:
             new_state = await CPMeasurement.measure()
 
+            metrics.CP_SAMPLES.inc()
+            rate_count += 1
+            now = time.monotonic()
+            if now - rate_start >= 1.0:
+                metrics.CP_SAMPLE_RATE.set(rate_count / (now - rate_start))
+                rate_count = 0
+                rate_start = now
+
             # Count how long without a change
             if(new_state.detected == _last_state_i):
                 if _last_state is not None:
@@ -9,10 +9,12 @@ from typing import Dict, List, Tuple, Any
 
 from ..utils.async_utils import blocking_to_async
 from ..utils.data_saver import DataSaver
+from ..utils import metrics
 
 from .trusted_ca_keys import TrustedCAKeysExtension, TrustedCAKey
 
 import os
+import time
 import traceback
 
 import ipaddress
@@ -185,12 +187,18 @@ async def create_tls_client(
 
     #Connect socket
     await blocking_to_async(conn.set_connect_state)()
-    while True:
-        try:
-            await blocking_to_async(conn.do_handshake)()
-            break
-        except OpenSSL.SSL.WantReadError:
-            pass
+    t_start = time.perf_counter()
+    result = "error"
+    try:
+        while True:
+            try:
+                await blocking_to_async(conn.do_handshake)()
+                break
+            except OpenSSL.SSL.WantReadError:
+                pass
+        result = "ok"
+    finally:
+        metrics.TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() - t_start, result=result)
 
     logger.log_entry("CERT", socket_wrapper.dump_cert_chain(conn.get_peer_cert_chain()))
 
@@ -7,13 +7,21 @@ import hashlib
 def to_bits(bytes, len):
     return (("0"*len) + bin(int.from_bytes(bytes, byteorder="little"))[2:])[-len:]
 
-def to_nid(nmk: bytes) -> bytes:
-
+def nmk_hash(nmk: bytes) -> bytes:
     val = nmk
     for _ in range(5):
         val = hashlib.sha256(val).digest()
+    return val
+
+def to_nid(nmk: bytes) -> bytes:
+    # Low 56 bits of the little endian hash, with bits 48-51 replaced by bits 52-55 and the top nibble cleared:
+    # the first 6 bytes stay, the 7th byte keeps only its high nibble, shifted down
+    nid = nmk_hash(nmk)
+    return nid[0:6] + bytes([nid[6] >> 4])
 
-    nid = val
+def to_nid_bits(nmk: bytes) -> bytes:
+    """Reference implementation working on the bit string, kept to verify to_nid"""
+    nid = nmk_hash(nmk)
     nid_truncated = to_bits(nid, 256)[-56:]
     nid_bits = "0000" + nid_truncated[0:4] + nid_truncated[8:]
     return int(nid_bits, base=2).to_bytes(7, byteorder="little")
@@ -21,3 +29,5 @@ def to_nid(nmk: bytes) -> bytes:
 if __name__ == "__main__":
     print(to_nid(bytes.fromhex("50D3E4933F855B7040784DF815AA8DB7")).hex().upper())
     print(to_nid(bytes.fromhex("0088119922AA33BB44CC55DD66EE77FF")).hex().upper())
+    for nmk in ["50D3E4933F855B7040784DF815AA8DB7", "0088119922AA33BB44CC55DD66EE77FF"]:
+        assert to_nid(bytes.fromhex(nmk)) == to_nid_bits(bytes.fromhex(nmk))
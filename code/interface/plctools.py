@@ -31,16 +31,23 @@ async def get_identity(device_mac: bytes):
         return None
     return res[0]
 
-async def get_network(device_mac: bytes):
+async def get_networks(device_mac: bytes):
+    """All networks the device is a member of, None if the device did not answer"""
     res = await blocking_to_async(slac_wrapper.nw_info)(device_mac)
     print(res)
     if res is None:
         return None
     if len(res) < 1:
         return None
-    if len(res[0]) < 1:
+    return res[0]
+
+async def get_network(device_mac: bytes):
+    res = await get_networks(device_mac)
+    if res is None:
+        return None
+    if len(res) < 1:
         return None
-    return res[0][0]
+    return res[0]
 
 async def get_local_mac() -> bytes | None:
     res = await get_version(LOCAL_DEVICE_MAC)
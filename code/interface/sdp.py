@@ -9,6 +9,7 @@ import struct
 from typing import Any, Callable, NamedTuple, Tuple
 from ..utils.data_saver import DataSaver
 from ..utils.async_utils import blocking_to_async
+from ..utils import metrics
 import ipaddress
 
 from ..network.states import StateBaseClass
@@ -166,13 +167,16 @@ async def sdp_client_single(logger: DataSaver, interface: str, req_tls: bool, re
 async def sdp_client(logger: DataSaver, interface: str, tls: bool, retries: int = 50) -> SDPRequest:
     with logger.trace_enter("SDP"):
         sdp_res = None
+        security = "tls" if tls else "tcp"
         for _ in range(retries):
+            metrics.SDP_REQUESTS.inc(security=security)
             try:
                 sdp_res = await sdp_client_single(logger, interface, tls)
                 break
             except BlockingIOError:
-                pass
+                metrics.SDP_RETRIES.inc(security=security)
         if sdp_res is None:
+            metrics.SDP_FAILURES.inc(security=security)
             raise SDPError(f"SDP Failed after {retries} retries")
         return sdp_res
 
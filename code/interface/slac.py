@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+import time
+
 from ..utils import settings
+from ..utils import metrics
 
 from .slac_common import *
-if settings.SKIP_SLAC:
+if settings.SKIP_SLAC and settings.SLAC_SIM_PROFILE is not None:
+    from .slac_sim import *
+elif settings.SKIP_SLAC:
     from .slac_tst import *
 else:
     from .slac_hw import *
@@ -17,6 +22,8 @@ if TYPE_CHECKING:
 class StateSLAC(StateBaseClass):
     state: SlacProgress
     state_done: bool
+    #perf_counter of the last state change, for the phase durations
+    state_since: float
 
     result: SlacResult | None
 
@@ -25,6 +32,7 @@ class StateSLAC(StateBaseClass):
 
         self.state = SlacProgress.S00_NONE
         self.state_done = False
+        self.state_since = time.perf_counter()
 
         self.result = None
 
@@ -56,6 +64,11 @@ class StateSLAC(StateBaseClass):
             })
 
     async def set_state(self, state, state_done):
+        if state != self.state:
+            now = time.perf_counter()
+            if self.state not in (SlacProgress.S00_NONE, SlacProgress.S11_DONE):
+                metrics.SLAC_PHASE_SECONDS.observe(now - self.state_since, phase=self.state.name)
+            self.state_since = now
         self.state = state
         self.state_done = state_done
         await self.send_state_state()
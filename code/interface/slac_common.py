@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from enum import Enum
+from typing import Any, Dict
 
 class SlacProgress(Enum):
     S00_NONE = 0
@@ -49,4 +50,40 @@ class SlacResult():
         "EVSE_ID": self.EVSE_ID.hex() if self.EVSE_ID is not None else None,
         "AAG": ':'.join('%02x' % b for b in self.AAG) if self.AAG is not None else None,
         "RUN_ID": self.RUN_ID.hex() if self.RUN_ID is not None else None,
-    }
\ No newline at end of file
+    }
+
+class SlacPrearm():
+    """Charger independent SLAC state, prepared in the background before the plug is connected"""
+    NMK: bytes | None
+    NID: bytes | None
+    PEV_MAC: bytes | None
+    PEV_ID: bytes | None
+    RUN_ID: bytes | None
+    LOCAL_MAC: bytes | None
+
+    #Timing of the key wipe
+    wipe: Dict[str, Any] | None
+    #Key is wiped and the modem has not been used for a SLAC run since
+    armed: bool
+
+    def __init__(self):
+        self.NMK = None
+        self.NID = None
+        self.PEV_MAC = None
+        self.PEV_ID = None
+        self.RUN_ID = None
+        self.LOCAL_MAC = None
+
+        self.wipe = None
+        self.armed = False
+
+    def to_json(self):
+        return {
+        "NMK": self.NMK.hex() if self.NMK is not None else None,
+        "NID": self.NID.hex() if self.NID is not None else None,
+        "PEV_MAC": self.PEV_MAC.hex() if self.PEV_MAC is not None else None,
+        "PEV_ID": self.PEV_ID.hex() if self.PEV_ID is not None else None,
+        "RUN_ID": self.RUN_ID.hex() if self.RUN_ID is not None else None,
+        "LOCAL_MAC": self.LOCAL_MAC.hex() if self.LOCAL_MAC is not None else None,
+        "wipe": self.wipe,
+    }
@@ -6,7 +6,7 @@ from __future__ import annotations
 
 import asyncio
 import time
-from typing import Any
+from typing import Any, Callable, Dict, List
 from . import slac_wrapper # type: ignore
 from ..utils.data_saver import DataSaver
 from ..utils.async_utils import blocking_to_async
@@ -59,16 +59,72 @@ class SlacError(Exception):
         else:
             raise SlacError(f"Unknown %i" % res)
 
-async def slac_set_nmk_robust(func):
+#Backoff used while waiting for the modem to accept and apply a key
+NMK_BACKOFF_START = 0.05
+NMK_BACKOFF_MAX = 1.0
+NMK_SET_RETRIES = 15
+NMK_WIPE_TIMEOUT = 4.0
+NMK_SET_TIMEOUT = 2.0
+
+def nmk_confirm_wiped(networks: List[Dict[str, Any]]) -> bool:
+    #Without a key the modem can not be part of a network with other stations
+    return all(len(nw.get("STATIONS", [])) == 0 for nw in networks)
+
+def nmk_confirm_set(nid_v: bytes | None) -> Callable[[List[Dict[str, Any]]], bool]:
+    def confirm(networks: List[Dict[str, Any]]) -> bool:
+        for nw in networks:
+            nw_nid = nw.get("NID")
+            if nw_nid is not None and nw_nid == nid_v:
+                return True
+        return False
+    return confirm
+
+async def slac_wait_nmk_applied(confirm: Callable[[List[Dict[str, Any]]], bool], timeout: float) -> bool:
+    """Poll the local modem until confirm() accepts its network state, or the timeout passes"""
+    t_end = time.monotonic() + timeout
+    delay = NMK_BACKOFF_START
+    while True:
+        networks = await plctools.get_networks(plctools.LOCAL_DEVICE_MAC)
+        if networks is not None and confirm(networks):
+            return True
+        if time.monotonic() + delay > t_end:
+            return False
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, NMK_BACKOFF_MAX)
+
+async def slac_set_nmk_robust(func, confirm: Callable[[List[Dict[str, Any]]], bool], timeout: float) -> Dict[str, Any]:
+    """
+    Run a blocking set/wipe key call until the modem accepts it, then wait until the
+    key is applied. Returns timing information for the log.
+    """
+    t_start = time.monotonic()
     wipe_key_res = slac_wrapper.ERROR_WIPE_KEY
-    for _ in range(15):
+    delay = NMK_BACKOFF_START
+    attempts = 0
+    while attempts < NMK_SET_RETRIES:
+        attempts += 1
         wipe_key_res = await blocking_to_async(func)()
         if wipe_key_res == slac_wrapper.ERROR_OK:
-            return
-        await asyncio.sleep(1)
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, NMK_BACKOFF_MAX)
         print("Retrying set NMK")
-    await asyncio.sleep(2)
-    SlacError.decode(wipe_key_res)
+    else:
+        SlacError.decode(wipe_key_res)
+
+    t_set = time.monotonic()
+    confirmed = await slac_wait_nmk_applied(confirm, timeout)
+    t_done = time.monotonic()
+
+    if not confirmed:
+        print("NMK not confirmed by modem")
+
+    return {
+        "attempts": attempts,
+        "set_time": t_set - t_start,
+        "confirm_time": t_done - t_set,
+        "confirmed": confirmed,
+    }
 
 def ev_init(interface: str):
     global slac_interface
@@ -78,31 +134,58 @@ def ev_init(interface: str):
     res = slac_wrapper.ev_init()
     SlacError.decode(res)
 
-async def ev_prepare(logger: DataSaver, progress: Any):
+async def ev_prearm(prearm: SlacPrearm | None, progress: Any) -> SlacPrearm:
+    """
+    Everything that does not need the charger: key generation, key wipe and reading
+    the local parameters. An armed result from a previous call is reused as is (a retry before
+    the modem was used), anything else gets a fresh key.
+    """
+    if prearm is not None and prearm.armed:
+        return prearm
+
+    local_mac = prearm.LOCAL_MAC if prearm is not None else None
+    prearm = SlacPrearm()
+    prearm.NMK = os.urandom(16)
+    prearm.NID = nid.to_nid(prearm.NMK)
+    prearm.LOCAL_MAC = local_mac
+
     #Reset the slac
     await progress(SlacProgress.S01_RESET, False)
     await blocking_to_async(slac_wrapper.ev_reset)()
 
-    nmk_v = os.urandom(16)
-    nid_v = nid.to_nid(nmk_v)
-
-    slac_wrapper.set_nmk(nmk_v)
-    slac_wrapper.set_nid(nid_v)
+    slac_wrapper.set_nmk(prearm.NMK)
+    slac_wrapper.set_nid(prearm.NID)
 
     await asyncio.sleep(0.5)
 
     await progress(SlacProgress.S02_WIPE_NMK, False)
-    await slac_set_nmk_robust(slac_wrapper.ev_wipekey)
-    await asyncio.sleep(2)
+    prearm.wipe = await slac_set_nmk_robust(slac_wrapper.ev_wipekey, nmk_confirm_wiped, NMK_WIPE_TIMEOUT)
+
+    prearm.PEV_MAC = slac_wrapper.read_pev_mac()
+    prearm.PEV_ID = slac_wrapper.read_pev_id()
+    prearm.RUN_ID = slac_wrapper.read_run_id()
+    if prearm.LOCAL_MAC is None:
+        prearm.LOCAL_MAC = await plctools.get_local_mac()
+
+    prearm.armed = True
+    return prearm
+
+async def ev_prepare(logger: DataSaver, progress: Any, prearm: SlacPrearm | None = None) -> SlacPrearm:
+    prearm = await ev_prearm(prearm, progress)
+    logger.log_entry("SLAC_PREARM", prearm.to_json())
     await progress(SlacProgress.S02_WIPE_NMK, True)
+    return prearm
 
-async def ev_run(logger: DataSaver, progress: Any) -> SlacResult:
+async def ev_run(logger: DataSaver, progress: Any, prearm: SlacPrearm) -> SlacResult:
     slac_res: SlacResult = SlacResult()
 
+    #From here on the modem state belongs to this run, a retry has to wipe again
+    prearm.armed = False
+
     try:
-        slac_res.PEV_MAC = slac_wrapper.read_pev_mac()
-        slac_res.PEV_ID = slac_wrapper.read_pev_id()
-        slac_res.RUN_ID = slac_wrapper.read_run_id()
+        slac_res.PEV_MAC = prearm.PEV_MAC
+        slac_res.PEV_ID = prearm.PEV_ID
+        slac_res.RUN_ID = prearm.RUN_ID
 
         #Run the slac process
         await progress(SlacProgress.S03_PARAM_REQ, False)
@@ -149,14 +232,17 @@ async def ev_run(logger: DataSaver, progress: Any) -> SlacResult:
         logger.log_entry("SLAC", slac_res.to_json())
 
     await progress(SlacProgress.S09_SET_NMK, False)
-    await slac_set_nmk_robust(slac_wrapper.ev_set_nmk)
+    timing = await slac_set_nmk_robust(slac_wrapper.ev_set_nmk, nmk_confirm_set(slac_res.NID), NMK_SET_TIMEOUT)
+    logger.log_entry("NMK_SET", timing)
     await progress(SlacProgress.S10_CONNECT, False)
 
     #sdp = asyncio.ensure_future(sdp_client(logger, "eth0", False, 10000))
 
     t_end = time.time() + 15
     network = None
-    local_mac = await plctools.get_local_mac()
+    local_mac = prearm.LOCAL_MAC
+    if local_mac is None:
+        local_mac = await plctools.get_local_mac()
     while time.time() < t_end:
         network = await plctools.get_network_full(local_mac)#type: ignore
         if network is not None:
@@ -0,0 +1,188 @@
+"""
+Simulated SLAC implementation with phase timings and failures drawn from a profile file
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import random
+from typing import Any, Dict, List
+from ..utils import settings
+from ..utils.data_saver import DataSaver
+
+from . import nid
+from .slac_common import *
+
+class SlacError(Exception):
+    def __init__(self, message):
+        # Call the base class constructor with the parameters it needs
+        super().__init__(message)
+
+#Error raised when a phase fails, same names as the hardware implementation
+PHASE_ERRORS: Dict[SlacProgress, str] = {
+    SlacProgress.S01_RESET: "SLAC_ERROR_AGAIN",
+    SlacProgress.S02_WIPE_NMK: "SLAC_ERROR_WIPE_KEY",
+    SlacProgress.S03_PARAM_REQ: "SLAC_ERROR_AGAIN",
+    SlacProgress.S04_START_ATTEN: "SLAC_ERROR_START_ATTEN_CHAR",
+    SlacProgress.S05_SOUNDING: "SLAC_ERROR_SOUNDING",
+    SlacProgress.S06_ATTEN_CHAR: "SLAC_ERROR_ATTEN_CHAR",
+    SlacProgress.S07_SELECT: "SLAC_ERROR_CONNECT",
+    SlacProgress.S08_MATCH: "SLAC_ERROR_MATCH",
+    SlacProgress.S09_SET_NMK: "SLAC_ERROR_SET_KEY",
+    SlacProgress.S10_CONNECT: "SLAC_ERROR_CONNECT",
+}
+
+class PhaseModel():
+    """
+    Duration distribution and failure probability of one SLAC phase
+
+    Supported distributions:
+    - {"fixed": 0.5}
+    - {"uniform": [0.2, 0.8]}
+    - {"normal": [mean, std]} (clipped at 0)
+    - {"samples": [0.41, 0.52, ...]} (e.g. exported from recorded sessions)
+    """
+    duration: Dict[str, Any]
+    fail: float
+
+    def __init__(self, duration: Dict[str, Any], fail: float = 0.0):
+        self.duration = duration
+        self.fail = fail
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "PhaseModel":
+        duration = {k: v for k, v in data.items() if k != "fail"}
+        if len(duration) != 1:
+            raise ValueError(f"Phase needs exactly one distribution: {data}")
+        return PhaseModel(duration, float(data.get("fail", 0.0)))
+
+    def draw_duration(self, rng: random.Random) -> float:
+        kind, val = next(iter(self.duration.items()))
+        if kind == "fixed":
+            return float(val)
+        if kind == "uniform":
+            return rng.uniform(val[0], val[1])
+        if kind == "normal":
+            return max(0.0, rng.gauss(val[0], val[1]))
+        if kind == "samples":
+            return float(rng.choice(val))
+        raise ValueError(f"Unknown distribution {kind}")
+
+    def draw_fail(self, rng: random.Random) -> bool:
+        return rng.random() < self.fail
+
+class SimProfile():
+    phases: Dict[SlacProgress, PhaseModel]
+    num_sounds: List[int]
+    aag_mean: float
+    aag_std: float
+    aag_groups: int
+
+    rng: random.Random
+
+    def __init__(self, data: Dict[str, Any]):
+        self.phases = {}
+        for name, phase in data.get("phases", {}).items():
+            self.phases[SlacProgress[name]] = PhaseModel.from_json(phase)
+
+        self.num_sounds = data.get("num_sounds", [10])
+        self.aag_mean = data.get("aag_mean", 30.0)
+        self.aag_std = data.get("aag_std", 5.0)
+        self.aag_groups = data.get("aag_groups", 58)
+
+        self.rng = random.Random(data.get("seed", None))
+
+    def rand_bytes(self, n: int) -> bytes:
+        return bytes(self.rng.getrandbits(8) for _ in range(n))
+
+    def rand_mac(self) -> bytes:
+        #QCA OUI, as used by most HomePlug GP modems
+        return b"\x00\xB0\x52" + self.rand_bytes(3)
+
+    def rand_aag(self) -> bytes:
+        return bytes(min(255, max(0, int(self.rng.gauss(self.aag_mean, self.aag_std)))) for _ in range(self.aag_groups))
+
+def load_profile(name: str) -> SimProfile:
+    with open(name, "r") as f:
+        return SimProfile(json.load(f))
+
+PROFILE = load_profile(settings.SLAC_SIM_PROFILE)
+
+async def run_phase(progress: Any, phase: SlacProgress):
+    await progress(phase, False)
+    model = PROFILE.phases.get(phase, None)
+    if model is None:
+        return
+    await asyncio.sleep(model.draw_duration(PROFILE.rng))
+    if model.draw_fail(PROFILE.rng):
+        raise SlacError(PHASE_ERRORS[phase])
+
+def ev_init(interface: str):
+    pass
+
+async def ev_prearm(prearm: SlacPrearm | None, progress: Any) -> SlacPrearm:
+    if prearm is not None and prearm.armed:
+        return prearm
+
+    #Fresh key for every run, the MACs stay those of the same modem
+    macs = (prearm.PEV_MAC, prearm.LOCAL_MAC) if prearm is not None else (PROFILE.rand_mac(), PROFILE.rand_mac())
+    prearm = SlacPrearm()
+    prearm.NMK = PROFILE.rand_bytes(16)
+    prearm.NID = nid.to_nid(prearm.NMK)
+    prearm.PEV_MAC, prearm.LOCAL_MAC = macs
+
+    await run_phase(progress, SlacProgress.S01_RESET)
+    await run_phase(progress, SlacProgress.S02_WIPE_NMK)
+
+    prearm.PEV_ID = PROFILE.rand_bytes(17)
+    prearm.RUN_ID = PROFILE.rand_bytes(8)
+
+    prearm.armed = True
+    return prearm
+
+async def ev_prepare(logger: DataSaver, progress: Any, prearm: SlacPrearm | None = None) -> SlacPrearm:
+    prearm = await ev_prearm(prearm, progress)
+    logger.log_entry("SLAC_PREARM", prearm.to_json())
+    await progress(SlacProgress.S02_WIPE_NMK, True)
+    return prearm
+
+async def ev_run(logger: DataSaver, progress: Any, prearm: SlacPrearm) -> SlacResult:
+    slac_res: SlacResult = SlacResult()
+
+    prearm.armed = False
+
+    try:
+        slac_res.PEV_MAC = prearm.PEV_MAC
+        slac_res.PEV_ID = prearm.PEV_ID
+        slac_res.RUN_ID = prearm.RUN_ID
+
+        #Run the slac process
+        await run_phase(progress, SlacProgress.S03_PARAM_REQ)
+
+        slac_res.NUM_SOUNDS = PROFILE.rng.choice(PROFILE.num_sounds)
+        slac_res.EVSE_MAC = PROFILE.rand_mac()
+
+        await run_phase(progress, SlacProgress.S04_START_ATTEN)
+        await run_phase(progress, SlacProgress.S05_SOUNDING)
+        await run_phase(progress, SlacProgress.S06_ATTEN_CHAR)
+
+        slac_res.EVSE_ID = PROFILE.rand_bytes(17)
+        slac_res.AAG = PROFILE.rand_aag()
+
+        await run_phase(progress, SlacProgress.S07_SELECT)
+        await run_phase(progress, SlacProgress.S08_MATCH)
+
+        slac_res.NMK = PROFILE.rand_bytes(16)
+        slac_res.NID = nid.to_nid(slac_res.NMK)
+
+        await progress(SlacProgress.S08_MATCH, True)
+
+    finally:
+        logger.log_entry("SLAC", slac_res.to_json())
+
+    await run_phase(progress, SlacProgress.S09_SET_NMK)
+    await run_phase(progress, SlacProgress.S10_CONNECT)
+
+    await progress(SlacProgress.S11_DONE, True)
+    return slac_res
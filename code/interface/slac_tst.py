@@ -19,7 +19,14 @@ class SlacError(Exception):
 def ev_init(interface: str):
     pass
 
-async def ev_prepare(logger: DataSaver, progress: Any):
+async def ev_prearm(prearm: SlacPrearm | None, progress: Any) -> SlacPrearm:
+    if prearm is not None and prearm.armed:
+        return prearm
+
+    prearm = SlacPrearm()
+    prearm.NMK = b"0123456789ABCDEF"
+    prearm.NID = b"ABCDEFG"
+
     #Reset the slac
     await progress(SlacProgress.S01_RESET, False)
     await asyncio.sleep(0.5)
@@ -27,11 +34,25 @@ async def ev_prepare(logger: DataSaver, progress: Any):
     await asyncio.sleep(0.5)
     await progress(SlacProgress.S02_WIPE_NMK, False)
     await asyncio.sleep(1.5)
+
+    prearm.PEV_MAC = b"MACPEV"
+    prearm.PEV_ID = b"000000"
+    prearm.LOCAL_MAC = b"MACLOC"
+
+    prearm.armed = True
+    return prearm
+
+async def ev_prepare(logger: DataSaver, progress: Any, prearm: SlacPrearm | None = None) -> SlacPrearm:
+    prearm = await ev_prearm(prearm, progress)
+    logger.log_entry("SLAC_PREARM", prearm.to_json())
     await progress(SlacProgress.S02_WIPE_NMK, True)
+    return prearm
 
-async def ev_run(logger: DataSaver, progress: Any) -> SlacResult:
+async def ev_run(logger: DataSaver, progress: Any, prearm: SlacPrearm) -> SlacResult:
     slac_res: SlacResult = SlacResult()
 
+    prearm.armed = False
+
     try:
 
         #Run the slac process
@@ -60,9 +81,9 @@ async def ev_run(logger: DataSaver, progress: Any) -> SlacResult:
         
         slac_res.NMK = b"0123456789ABCDEF"
         slac_res.NID = b"ABCDEFG"
-        slac_res.PEV_MAC = b"MACPEV"
+        slac_res.PEV_MAC = prearm.PEV_MAC
         slac_res.EVSE_MAC = b"MACSEE"
-        slac_res.PEV_ID = b"000000"
+        slac_res.PEV_ID = prearm.PEV_ID
         slac_res.EVSE_ID = b"00000000"
         slac_res.AAG = b"012345678"
         slac_res.NUM_SOUNDS = 10
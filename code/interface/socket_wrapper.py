@@ -10,6 +10,7 @@ import asyncio
 from ..v2g.exi_interface import ExiException
 
 from ..utils.async_utils import blocking_to_async
+from ..utils import metrics
 
 import OpenSSL.crypto
 import OpenSSL.SSL
@@ -20,6 +21,9 @@ class V2GPacket(NamedTuple):
     data: bytes
 
 class WrappedSocket(ABC):
+    #Label of the metrics
+    transport = "tcp"
+
     @abstractmethod
     def close(self):
         raise Exception()
@@ -28,6 +32,7 @@ class WrappedSocket(ABC):
         header = struct.pack(">BBHI", packet.version, 255-packet.version, packet.type, len(packet.data))
         #Not a standard given number, just a reasonable limit
         await self.send(header + packet.data)
+        metrics.SOCKET_FRAMES.inc(transport=self.transport, direction="tx")
 
     async def read_v2g_packet(self) -> V2GPacket:
         header = await self.read(8)
@@ -46,6 +51,7 @@ class WrappedSocket(ABC):
         res = await self.read(data_length)
         if(len(res) < data_length):
             raise ExiException("Incomplete packet data")
+        metrics.SOCKET_FRAMES.inc(transport=self.transport, direction="rx")
         return V2GPacket(version, type, res)
 
     async def read(self, n) -> bytes:
@@ -53,10 +59,12 @@ class WrappedSocket(ABC):
         while (len(buf) < n):
             tmp = await self._read(n)
             buf = buf + tmp
+        metrics.SOCKET_BYTES.inc(len(buf), transport=self.transport, direction="rx")
         return buf
 
     async def send(self, b: bytes):
         await self._sendall(b)
+        metrics.SOCKET_BYTES.inc(len(b), transport=self.transport, direction="tx")
 
     @abstractmethod
     async def _read(self, n) -> bytes:
@@ -83,6 +91,7 @@ class WrappedSocketRaw(WrappedSocket):
 
 class WrappedSocketTLS(WrappedSocket):
     conn: OpenSSL.SSL.Connection
+    transport = "tls"
 
     def __init__(self, conn: OpenSSL.SSL.Connection):
         self.conn = conn
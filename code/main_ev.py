@@ -7,6 +7,7 @@ from .certs import generate_self_signed_certificate, load_cert_chain
 from .controller_ev import ControllerEV
 from .experiment.experiment_ev import Task_EV_Conn_Base, Task_EV_SLAC, Task_EV_SDP, Task_EV_Conn_NTLS, Task_EV_Conn_V2, Task_EV_Conn_TLS_Old, Task_EV_Conn_V2_BadTrusted, Task_EV_Conn_V2_Suite, Task_EV_Conn_V20, Task_EV_Supported, Task_EV_V2G
 from .v2g.supported_app_protocol import PROTO_TESTS_EV
+from .utils import settings
 import faulthandler
 import asyncio
 import signal
@@ -34,7 +35,7 @@ async def add_proto_test_default(cont: ControllerEV, conn_task: Task_EV_Conn_Bas
 async def main(args):
     faulthandler.enable()
 
-    cont = ControllerEV("eth0", args)
+    cont = ControllerEV(args.interface, args)
 
     hubject_hash = bytes.fromhex("d8367e861f5807f8141fea572d676dbf58bb5f7c")
 
@@ -91,8 +92,14 @@ if __name__ == "__main__":
     parser.add_argument('--plug')
     parser.add_argument('--lat')
     parser.add_argument('--long')
+    parser.add_argument('--interface', default="eth0", help="PLC modem interface")
+    parser.add_argument('--ws-port', type=int, default=settings.WS_PORT_NSSL, help="Port of the UI websocket")
+    parser.add_argument('--metrics-port', type=int, default=None, help="Port of the metrics endpoint, defaults to the websocket port plus METRICS_PORT_OFFSET")
+    parser.add_argument('--loop-monitor', action='store_true', default=settings.LOOP_MONITOR, help="Measure event loop lag and log stalls with stack samples")
     
     args = parser.parse_args()
+    if args.metrics_port is None and settings.METRICS_PORT_OFFSET is not None:
+        args.metrics_port = args.ws_port + settings.METRICS_PORT_OFFSET
 
     try:
         asyncio.run(main(args))
@@ -0,0 +1,152 @@
+"""
+Versioned store of the UI state objects, clients get JSON patch style deltas between revisions
+"""
+
+from __future__ import annotations
+
+import collections
+import json
+import secrets
+import urllib.parse
+from typing import Any, Deque, Dict, List, Tuple
+
+from ..utils import settings
+
+#Messages that are not state and are sent as they are
+CONTROL_TYPES = ["init_done", "state_snapshot", "state_delta"]
+
+#Message types that hold one state per name
+NAMED_TYPES = ["task"]
+
+#States sent several times a second and built fresh for every send, stored as they are and replaced whole instead of diffed
+WHOLE_TYPES = ["basic_signaling"]
+
+class StoreClient():
+    """Passed as client to send_state_init to publish the state to the store instead of one client"""
+    pass
+
+STORE_CLIENT = StoreClient()
+
+def state_key(message: Any) -> str | None:
+    """Key of the state a message holds, None for control messages"""
+    if not isinstance(message, dict):
+        return None
+    msg_type = message.get("type", None)
+    if not isinstance(msg_type, str) or msg_type in CONTROL_TYPES:
+        return None
+    if msg_type in NAMED_TYPES:
+        return f"{msg_type}/{message.get('name', '')}"
+    return msg_type
+
+def escape(key: str) -> str:
+    """JSON pointer escaping (RFC 6901)"""
+    return key.replace("~", "~0").replace("/", "~1")
+
+def diff(old: Any, new: Any, path: str, ops: List[Dict[str, Any]]):
+    """Appends the patch operations turning old into new, objects are compared per member, everything else as a whole"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": path + "/" + escape(key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": path + "/" + escape(key), "value": value})
+            else:
+                diff(old[key], value, path + "/" + escape(key), ops)
+    elif old != new or type(old) != type(new):
+        ops.append({"op": "replace", "path": path, "value": new})
+
+def merge_ops(ops: List[Dict[str, Any]], later: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Operations with the effect of ops followed by later, without those that later overwrites"""
+    res = list(ops)
+    for op in later:
+        path = op["path"]
+        prefix = path + "/"
+        res = [o for o in res if o["path"] != path and not o["path"].startswith(prefix)]
+        res.append(op)
+    return res
+
+def merge_deltas(delta: Dict[str, Any], later: Dict[str, Any]) -> Dict[str, Any] | None:
+    """One delta message for two consecutive ones, None if later does not start where delta ends"""
+    if delta.get("epoch") != later.get("epoch") or delta.get("revision") != later.get("base"):
+        return None
+    return {
+        "type": "state_delta",
+        "epoch": delta["epoch"],
+        "base": delta["base"],
+        "revision": later["revision"],
+        "ops": merge_ops(delta["ops"], later["ops"]),
+    }
+
+def parse_resume(path: str | None) -> Tuple[str, int] | None:
+    """(epoch, revision) from a connection path like /?epoch=...&revision=..."""
+    if path is None:
+        return None
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+    try:
+        return query["epoch"][0], int(query["revision"][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+class StateStore():
+    #Changes on every start, revisions of another run cannot be resumed
+    epoch: str
+    revision: int
+    state: Dict[str, Any]
+    #(revision, ops) of the most recent changes
+    history: Deque[Tuple[int, List[Dict[str, Any]]]]
+
+    def __init__(self, history_size: int | None = None):
+        self.epoch = secrets.token_hex(8)
+        self.revision = 0
+        self.state = {}
+        self.history = collections.deque(maxlen=history_size if history_size is not None else settings.STATE_HISTORY)
+
+    def update(self, key: str, value: Any) -> List[Dict[str, Any]]:
+        """Set a state, returns the operations of the new revision (empty if nothing changed)"""
+        ops: List[Dict[str, Any]] = []
+        if key in WHOLE_TYPES:
+            if self.state.get(key, None) != value:
+                ops.append({"op": "replace" if key in self.state else "add", "path": "/" + escape(key), "value": value})
+        else:
+            #Copy in JSON form, senders reuse and modify their dicts and tuples would never equal the lists clients see
+            value = json.loads(json.dumps(value))
+            if key not in self.state:
+                ops.append({"op": "add", "path": "/" + escape(key), "value": value})
+            else:
+                diff(self.state[key], value, "/" + escape(key), ops)
+        if len(ops) == 0:
+            return ops
+        self.state[key] = value
+        self.revision += 1
+        self.history.append((self.revision, ops))
+        return ops
+
+    def delta_since(self, revision: int) -> List[Dict[str, Any]] | None:
+        """All operations after a revision, None if they are no longer kept"""
+        if revision == self.revision:
+            return []
+        if revision > self.revision or len(self.history) == 0 or self.history[0][0] > revision + 1:
+            return None
+        ops: List[Dict[str, Any]] = []
+        for rev, rev_ops in self.history:
+            if rev > revision:
+                ops.extend(rev_ops)
+        return ops
+
+    def snapshot_message(self) -> Dict[str, Any]:
+        return {
+            "type": "state_snapshot",
+            "epoch": self.epoch,
+            "revision": self.revision,
+            "state": self.state,
+        }
+
+    def delta_message(self, base: int, ops: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            "type": "state_delta",
+            "epoch": self.epoch,
+            "base": base,
+            "revision": self.revision,
+            "ops": ops,
+        }
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
 import asyncio
+import collections
 import json
+import math
 import signal
-import subprocess
-from typing import Any, Dict, List, TYPE_CHECKING, NamedTuple, Tuple
+import sys
+import time
+from typing import Any, Deque, Dict, List, TYPE_CHECKING, NamedTuple, Tuple
 
-from ..utils import settings
+from ..utils import data_saver, settings
 
 from ..interface.bs_measure import CPMeasurement
 import websockets.client as wsc
@@ -22,6 +25,8 @@ from .state_base import StateBaseClass, StateWaiter
 
 
 class StateInfo(StateBaseClass):
+    #Interface of the EV process the charger is tested with
+    device: str
     name: str
     box: str
     plug: str
@@ -30,9 +35,10 @@ class StateInfo(StateBaseClass):
     exp_start_waiter: StateWaiter
     #exp_done_waiter: StateWaiter
 
-    def __init__(self, ws: "ui_link.UI_Link"):
+    def __init__(self, ws: "ui_link.UI_Link", device: str):
         super().__init__(ws)
 
+        self.device = device
         self.name = ""
         self.box = ""
         self.plug = ""
@@ -42,6 +48,7 @@ class StateInfo(StateBaseClass):
     def get_state(self):
         return {
             "type": "info",
+            "device": self.device,
             "name": self.name,
             "box": self.box,
             "plug": self.plug,
@@ -85,46 +92,106 @@ class StateSubprocess(StateBaseClass):
     #run_id: int
     process_lock: asyncio.Lock
 
-    process: None | subprocess.Popen = None
+    process: None | asyncio.subprocess.Process = None
+    supervise_task: None | asyncio.Future
     #forward_socket: None | wsc.WebSocketClientProtocol = None
 
+    #Exit code of the last run, None while running or before the first run
+    returncode: int | None
+    #Recent output lines as (stream, line), sent to new clients
+    output: Deque[Tuple[str, str]]
+
     state_info: StateInfo
     results_folder: str
-
-    def __init__(self, ws: "ui_link.UI_Link", state_info, results_folder):
+    #PLC interface and UI websocket port of the EV process
+    device: str
+    port: int
+    #Appended to session folder names, keeps runs of several devices started in the same second apart
+    folder_suffix: str
+    #Session folder of the current or last run (the output folder with the session name appended)
+    session_folder: str | None
+    #When the last run exited, None while running
+    session_end: float | None
+
+    def __init__(self, ws: "ui_link.UI_Link", state_info, results_folder, device: str, port: int, folder_suffix: str = ""):
         super().__init__(ws)
     
         #self.run_id = 0
         self.process_lock = asyncio.Lock()
 
         self.process = None
+        self.supervise_task = None
+        self.returncode = None
+        self.output = collections.deque(maxlen=settings.PROCESS_OUTPUT_LINES)
 
         self.state_info = state_info
 
         self.results_folder = results_folder
+        self.device = device
+        self.port = port
+        self.folder_suffix = folder_suffix
+        self.session_folder = None
+        self.session_end = None
 
         #self.forward_socket = None
 
-    def check_running_impl(self):
-        if self.process is not None:
-            if self.process.poll() is None:
-                return True
-            else:
-                self.process = None
-        return False
-
-    async def check_running(self):
-        async with self.process_lock:
-            return self.check_running_impl()
-
-    async def get_state(self):
+    def get_state(self):
         return {
             "type": "process",
-            "running": await self.check_running()
+            "device": self.device,
+            "running": self.process is not None,
+            "pid": self.process.pid if self.process is not None else None,
+            "returncode": self.returncode,
         }
 
     async def send_state_update(self):
-        await self.ws.send_broadcast(await self.get_state())
+        await self.ws.send_broadcast(self.get_state())
+
+    def current_session(self, grace: float = 0.0) -> str | None:
+        """Folder of the running session, or of the last one if it ended less than grace seconds ago"""
+        if self.session_folder is None:
+            return None
+        if self.process is not None or (self.session_end is not None and time.time() - self.session_end < grace):
+            return self.session_folder
+        return None
+
+    async def read_output(self, stream: str, reader: asyncio.StreamReader):
+        """Forward the lines of one output stream to the console and all clients"""
+        console = sys.stdout if stream == "stdout" else sys.stderr
+        while True:
+            try:
+                line_b = await reader.readline()
+            except ValueError:
+                #Longer than the reader limit, the start of the line is dropped
+                line_b = b"[line too long]\n"
+            if len(line_b) == 0:
+                break
+            line = line_b.decode(errors="replace").rstrip("\n")
+            console.write(line + "\n")
+            console.flush()
+            self.output.append((stream, line))
+            await self.ws.send_broadcast({
+                "type": "process_output",
+                "device": self.device,
+                "lines": [[stream, line]]
+            })
+
+    async def supervise(self, process: asyncio.subprocess.Process):
+        """Runs for the lifetime of the child, the only place that notices it exit"""
+        try:
+            await asyncio.gather(
+                self.read_output("stdout", process.stdout),  # type: ignore
+                self.read_output("stderr", process.stderr),  # type: ignore
+            )
+        finally:
+            returncode = await process.wait()
+            async with self.process_lock:
+                if self.process is process:
+                    self.process = None
+                    self.returncode = returncode
+                    self.session_end = time.time()
+            print(f"EV process on {self.device} exited with {returncode}")
+            await self.send_state_update()
 
     async def on_message(self, message):
         if message["type"] == "start":
@@ -135,19 +202,36 @@ class StateSubprocess(StateBaseClass):
                 if self.process is None:
                     my_env = os.environ.copy()
                     my_env["OPENSSL_CONF"] = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../openssl.conf")
+                    #Output goes through a pipe, without this it arrives in 4k blocks
+                    my_env["PYTHONUNBUFFERED"] = "1"
 
-                    self.process = subprocess.Popen(
-                        ["python",
+                    outpath = os.path.join(self.results_folder, datetime.datetime.now(datetime.timezone.utc).strftime("%Y_%m_%d_%H_%M_%S") + self.folder_suffix)
+                    self.process = await asyncio.create_subprocess_exec(
+                        "python",
                         "-m", "code.main_ev",
                         "--name", self.state_info.name,
                         "--box", self.state_info.box,
                         "--plug", self.state_info.plug,
                         "--lat", str(self.state_info.gps[0]) if self.state_info.gps[0] is not None else "nan",
                         "--long", str(self.state_info.gps[1]) if self.state_info.gps[1] is not None else "nan",
-                        os.path.join(self.results_folder, datetime.datetime.now(datetime.timezone.utc).strftime("%Y_%m_%d_%H_%M_%S"))
-                        ],
-                        cwd=os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../"), env=my_env
+                        "--interface", self.device,
+                        "--ws-port", str(self.port),
+                        outpath,
+                        cwd=os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../"), env=my_env,
+                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                        limit=settings.PROCESS_LINE_LIMIT
                     )
+                    self.returncode = None
+                    #Where DataSaver.trace_file_start of the EV process puts the session
+                    self.session_folder = data_saver.subfolder(outpath, data_saver.session_name(self.state_info.name, self.state_info.box, self.state_info.plug))
+                    self.session_end = None
+                    self.output.clear()
+                    self.supervise_task = asyncio.ensure_future(self.supervise(self.process))
+                    started = True
+                else:
+                    started = False
+            if started:
+                await self.send_state_update()
                 
             #asyncio.ensure_future(self.thread_runner(new_run_id))
 
@@ -163,19 +247,70 @@ class StateSubprocess(StateBaseClass):
             async with self.process_lock:
                 if self.process is not None:
                     self.process.kill()
-                    self.process = None
                     
     async def send_state_init(self, client):
-        await self.ws.send_client(client, await self.get_state())
-
+        await self.ws.send_client(client, self.get_state())
+        if len(self.output):
+            await self.ws.send_client(client, {
+                "type": "process_output",
+                "device": self.device,
+                "lines": [list(l) for l in self.output]
+            })
+
+
+class MeasurementWindow():
+    """min/max/mean of the CP samples since the last UI update"""
+    count: int
+    mins: List[float]
+    maxs: List[float]
+    sums: List[float]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mins = [math.inf] * 3
+        self.maxs = [-math.inf] * 3
+        self.sums = [0.0] * 3
+
+    def add(self, meas: CPMeasurement):
+        self.count += 1
+        for i, v in enumerate((meas.level_low, meas.level_high, meas.duty)):
+            if math.isnan(v):
+                continue
+            self.mins[i] = min(self.mins[i], v)
+            self.maxs[i] = max(self.maxs[i], v)
+            self.sums[i] += v
+
+    def to_json(self):
+        res: Dict[str, Any] = {"n": self.count}
+        for i, key in enumerate(["l", "h", "d"]):
+            if self.mins[i] == math.inf:
+                res[key] = None
+            else:
+                res[key] = [self.mins[i], self.maxs[i], self.sums[i] / self.count]
+        return res
 
 class StateBasic(StateBaseClass):
+    """
+    CP measurements for the UI. A change of the detected state is sent at once,
+    level and duty changes at most BASIC_UI_RATE times per second.
+    """
     last_measurement: CPMeasurement | None
+    last_sent: CPMeasurement | None
+    last_send_time: float
+    flush_handle: asyncio.TimerHandle | None
+    window: MeasurementWindow
 
     def __init__(self, ws: "ui_link.UI_Link"):
         super().__init__(ws)
 
         self.last_measurement = None
+        self.last_sent = None
+        self.last_send_time = 0.0
+        self.flush_handle = None
+        self.window = MeasurementWindow()
 
     def get_state(self):
         return {
@@ -184,14 +319,41 @@ class StateBasic(StateBaseClass):
         }
 
     async def send_state_update(self):
-        await self.ws.send_broadcast(self.get_state())
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.last_sent = self.last_measurement
+        self.last_send_time = time.monotonic()
+
+        message = self.get_state()
+        if settings.BASIC_UI_SUMMARY:
+            message["window"] = self.window.to_json()
+            self.window.reset()
+        await self.ws.send_broadcast(message)
 
     async def send_state_init(self, client):
         await self.ws.send_client(client, self.get_state())
 
+    async def flush(self):
+        """Send the newest measurement if it was held back by the rate limit"""
+        self.flush_handle = None
+        if self.last_measurement is not self.last_sent:
+            await self.send_state_update()
+
     async def set_measurement(self, meas):
         self.last_measurement = meas
-        await self.send_state_update()
+        if settings.BASIC_UI_SUMMARY:
+            self.window.add(meas)
+
+        if settings.BASIC_UI_RATE is None or self.last_sent is None or meas.detected != self.last_sent.detected:
+            await self.send_state_update()
+            return
+
+        wait = self.last_send_time + 1 / settings.BASIC_UI_RATE - time.monotonic()
+        if wait <= 0:
+            await self.send_state_update()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(wait, lambda: asyncio.ensure_future(self.flush()))
 
 
 
@@ -4,6 +4,7 @@ import asyncio
 from typing import Any, Dict, List, TYPE_CHECKING, NamedTuple, Tuple
 
 from .state_base import StateBaseClass
+from ..utils import metrics
 
 if TYPE_CHECKING:
     from . import ui_link
@@ -166,7 +167,14 @@ class StateTask(StateBaseClass):
             new_state = TaskResultEnum.Failed_Anomaly
             return new_state
         finally:
+            metrics.TASK_RESULTS.inc(task=self.name, result=new_state.name)
             try:
+                if ctrl.logger.backup_file is not None:
+                    ctrl.logger.log_entry("TASK", {
+                        "name": self.name,
+                        "result": new_state.name,
+                        "manual": manual,
+                    })
                 await self.set_result(new_state)
             except Exception as e:
                 print("Cleanup exception")
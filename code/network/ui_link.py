@@ -1,33 +1,240 @@
+from __future__ import annotations
+
 from abc import abstractmethod
 import websockets.server as ws
 import websockets.exceptions as wse
 import traceback
 import asyncio
-from typing import Any, List
+import collections
+import time
+from typing import Any, Deque, Dict, List, Tuple
 from ..utils import settings
+from ..utils import metrics
+from .state_store import merge_deltas
 import json
 import ssl
 import os
 
+#Outbound message policies, by message type
+POLICY_KEEP = 0 #Always queued, a client that falls this far behind is disconnected
+POLICY_COALESCE = 1 #Replaces the queued message with the same key, only the newest full state matters
+POLICY_DROP = 2 #Dropped when the queue is full
+POLICY_MERGE = 3 #State deltas, merged into the delta at the end of the queue so that a slow client gets fewer and larger ones
+
+MESSAGE_POLICY = {
+    "init_tasks": POLICY_KEEP,
+    "init_done": POLICY_KEEP,
+    "state_snapshot": POLICY_KEEP,
+    "state_delta": POLICY_MERGE,
+    "process_output": POLICY_DROP,
+}
+DEFAULT_POLICY = POLICY_COALESCE
+
+#Message types that hold one state per name
+NAMED_TYPES = ["task"]
+
+def message_policy(message) -> Tuple[int, Any]:
+    """(policy, coalescing key) of an outbound message"""
+    if not isinstance(message, dict):
+        return POLICY_KEEP, None
+    msg_type = message.get("type", None)
+    policy = MESSAGE_POLICY.get(msg_type, DEFAULT_POLICY)
+    if policy != POLICY_COALESCE:
+        return policy, None
+    if msg_type in NAMED_TYPES:
+        return policy, (msg_type, message.get("name", None))
+    if "device" in message:
+        #One state per EV process in fleet mode
+        return policy, (msg_type, message["device"])
+    return policy, msg_type
+
+class ClientQueue():
+    """
+    Bounded outbound queue of one client, sent in order by its own writer task
+    so that a slow client never holds up the sender or the other clients
+    """
+    client: Any
+    size: int
+    #Label of the metrics
+    server: str
+
+    #[policy, key, message as sent, message], entries are updated in place when coalescing,
+    #a merged delta is serialized when it is sent
+    pending: Deque[List[Any]]
+    by_key: Dict[Any, List[Any]]
+    event: asyncio.Event
+    task: asyncio.Future | None
+    closed: bool
+
+    #Statistics
+    sent: int
+    dropped: int
+    coalesced: int
+    max_depth: int
+    send_time_max: float
+    send_time_total: float
+
+    def __init__(self, client, size: int, server: str = ""):
+        self.client = client
+        self.size = size
+        self.server = server
+
+        self.pending = collections.deque()
+        self.by_key = {}
+        self.event = asyncio.Event()
+        self.task = None
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.send_time_max = 0.0
+        self.send_time_total = 0.0
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run_writer())
+
+    def stop(self):
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def put(self, message_s: str, policy: int, key: Any, message: Any = None):
+        """Never waits, returns False if the client had to be disconnected"""
+        if self.closed:
+            return False
+
+        if policy == POLICY_MERGE and len(self.pending) and self.pending[-1][0] == POLICY_MERGE:
+            last = self.pending[-1]
+            merged = merge_deltas(last[3], message)
+            if merged is not None:
+                last[2] = None
+                last[3] = merged
+                self.coalesced += 1
+                metrics.WS_DROPPED.inc(server=self.server, reason="coalesced")
+                return True
+
+        if policy == POLICY_COALESCE and key in self.by_key:
+            self.by_key[key][2] = message_s
+            self.coalesced += 1
+            metrics.WS_DROPPED.inc(server=self.server, reason="coalesced")
+            return True
+
+        if len(self.pending) >= self.size:
+            #Make room by dropping the oldest droppable message
+            for entry in self.pending:
+                if entry[0] == POLICY_DROP:
+                    self.pending.remove(entry)
+                    self.dropped += 1
+                    metrics.WS_DROPPED.inc(server=self.server, reason="dropped")
+                    break
+            else:
+                if policy == POLICY_DROP:
+                    self.dropped += 1
+                    metrics.WS_DROPPED.inc(server=self.server, reason="dropped")
+                    return True
+                print("Client too slow, disconnecting")
+                metrics.WS_DROPPED.inc(server=self.server, reason="disconnected")
+                self.stop()
+                asyncio.ensure_future(self.client.close())
+                return False
+
+        entry = [policy, key, message_s, message]
+        self.pending.append(entry)
+        if key is not None:
+            self.by_key[key] = entry
+        self.max_depth = max(self.max_depth, len(self.pending))
+        self.event.set()
+        return True
+
+    async def run_writer(self):
+        try:
+            while not self.closed:
+                await self.event.wait()
+                self.event.clear()
+                while len(self.pending):
+                    entry = self.pending.popleft()
+                    if entry[1] is not None and self.by_key.get(entry[1]) is entry:
+                        del self.by_key[entry[1]]
+                    message_s = entry[2] if entry[2] is not None else json.dumps(entry[3])
+                    t_start = time.monotonic()
+                    await self.client.send(message_s)
+                    t_send = time.monotonic() - t_start
+                    self.sent += 1
+                    self.send_time_total += t_send
+                    self.send_time_max = max(self.send_time_max, t_send)
+                    metrics.WS_SEND_SECONDS.observe(t_send, server=self.server)
+        except (wse.ConnectionClosed, wse.ConnectionClosedError):
+            self.closed = True
+        except Exception as e:
+            #A writer that died silently would leave the client connected but never sent to again
+            print(f"Client writer failed, disconnecting: {type(e).__name__}: {e}")
+            traceback.print_exc()
+            metrics.WS_DROPPED.inc(server=self.server, reason="disconnected")
+            self.closed = True
+            self.pending.clear()
+            self.by_key.clear()
+            await self.client.close()
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "send_time_max": self.send_time_max,
+            "send_time_mean": self.send_time_total / self.sent if self.sent else 0.0,
+        }
+
 class UI_Link:
     clients: List[ws.WebSocketServerProtocol]
     client_lock: asyncio.Lock
+    queues: Dict[Any, ClientQueue]
+    #Label of the websocket metrics
+    metrics_name = "ui"
 
     
     def __init__(self):
         self.clients = []
         self.client_lock = asyncio.Lock()
+        self.queues = {}
+        metrics.WS_CLIENTS.add_function(lambda: {(self.metrics_name,): len(self.clients)})
+
+    async def add_client(self, client):
+        async with self.client_lock:
+            self.clients.append(client)
+            queue = ClientQueue(client, settings.WS_QUEUE_SIZE, self.metrics_name)
+            self.queues[client] = queue
+            queue.start()
+
+    async def remove_client(self, client):
+        async with self.client_lock:
+            self.clients.remove(client)
+            queue = self.queues.pop(client, None)
+            if queue is not None:
+                queue.stop()
+                print(f"Client queue: {queue.stats()}")
+            print(self.clients)
+
+    def queue_stats(self) -> List[Dict[str, Any]]:
+        return [q.stats() for q in self.queues.values()]
 
     async def send_broadcast(self, message):
+        """Queues the message for every client, does not wait for the network"""
         message_s = json.dumps(message)
-        async with self.client_lock:
-            try:
-                await asyncio.gather(*[client.send(message_s) for client in self.clients])
-            except (wse.ConnectionClosed, wse.ConnectionClosedError):
-                pass
+        policy, key = message_policy(message)
+        for queue in list(self.queues.values()):
+            queue.put(message_s, policy, key, message)
 
     async def send_client(self, client, message):
         message_s = json.dumps(message)
+        queue = self.queues.get(client, None)
+        if queue is not None:
+            policy, key = message_policy(message)
+            queue.put(message_s, policy, key, message)
+            return
         try:
             await client.send(message_s)
         except (wse.ConnectionClosed, wse.ConnectionClosedError):
@@ -39,8 +246,7 @@ class UI_Link:
 
     async def on_websocket_client(self, client):
         print("Client connected")
-        async with self.client_lock:
-            self.clients.append(client)
+        await self.add_client(client)
         
         try:
             await self.on_websocket_client_inner(client)
@@ -50,12 +256,10 @@ class UI_Link:
             print("Client unexpected crash")
             raise
         finally:
-            async with self.client_lock:
-                self.clients.remove(client)
-                print(self.clients)
+            await self.remove_client(client)
             print("Client done")
 
-    async def start_websocket_server(self, use_ssl = False):
+    async def start_websocket_server(self, use_ssl = False, port: int | None = None):
         ssl_context = None
         if use_ssl:
             ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -69,7 +273,7 @@ class UI_Link:
         print("Starting websocket")
         server = await ws.serve(
             ws_handler = self.on_websocket_client,
-            port = settings.WS_PORT_SSL if use_ssl else settings.WS_PORT_NSSL,
+            port = port if port is not None else (settings.WS_PORT_SSL if use_ssl else settings.WS_PORT_NSSL),
             start_serving = False, ssl = ssl_context)
         try:
             await server.serve_forever()
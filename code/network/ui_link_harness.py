@@ -6,85 +6,256 @@ import websockets.exceptions as wse
 import traceback
 import asyncio
 import logging
-from typing import List
+from typing import Any, Dict, List, Set, Tuple
 from . import states
 from ..utils import settings
+from ..utils import metrics
 import json
+import urllib.parse
 
 from . import ui_link
 
-class UI_Harness(ui_link.UI_Link):
+#Forwarded frames are wrapped and unwrapped as strings, the payload is never parsed.
+#Frames carry the device after the type, this prefix without it is for the first device
+FORWARD_PREFIX = '{"type":"forward","data":'
+FORWARD_SUFFIX = '}'
+
+class ForwardStats():
+    messages_down: int
+    bytes_down: int
+    messages_up: int
+    bytes_up: int
+    dropped_up: int
+
+    def __init__(self):
+        self.messages_down = 0
+        self.bytes_down = 0
+        self.messages_up = 0
+        self.bytes_up = 0
+        self.dropped_up = 0
+
+    def to_json(self):
+        return dict(vars(self))
+
+def forward_prefix(device: str) -> str:
+    return '{"type":"forward","device":' + json.dumps(device) + ',"data":'
+
+class Device():
+    """One EV process with its own PLC interface and websocket port, and the forwarding to it"""
+    ws: "UI_Harness"
+    name: str
+    port: int
     state_info: states.StateInfo
     state_process: states.StateSubprocess
-    
-    def __init__(self, results_folder):
-        super().__init__()
 
-        self.state_info = states.StateInfo(self)
-        self.state_process = states.StateSubprocess(self, self.state_info, results_folder)
+    #Frames of this device are wrapped with this prefix
+    prefix: str
+
+    #One connection to the EV process shared by every browser that opened forwarding
+    upstream: None | wsc.WebSocketClientProtocol
+    upstream_lock: asyncio.Lock
+    upstream_queue: "asyncio.Queue[str]"
+    upstream_tasks: List[asyncio.Future]
+    forward_clients: Set[wss.WebSocketServerProtocol]
+    forward_stats: ForwardStats
+
+    def __init__(self, ws: "UI_Harness", name: str, port: int, results_folder: str, folder_suffix: str):
+        self.ws = ws
+        self.name = name
+        self.port = port
+        self.state_info = states.StateInfo(ws, name)
+        self.state_process = states.StateSubprocess(ws, self.state_info, results_folder, name, port, folder_suffix)
+        self.prefix = forward_prefix(name)
+
+        self.upstream = None
+        self.upstream_lock = asyncio.Lock()
+        self.upstream_queue = asyncio.Queue(maxsize=settings.FORWARD_QUEUE_SIZE)
+        self.upstream_tasks = []
+        self.forward_clients = set()
+        self.forward_stats = ForwardStats()
+        metrics.EV_PROCESS_RUNNING.add_function(lambda: {(self.name,): int(self.state_process.process is not None)})
 
-    @staticmethod
-    async def run_forward(client: wss.WebSocketServerProtocol, forward: wsc.WebSocketClientProtocol):
+    async def open_upstream(self, query: str) -> bool:
+        """Returns whether a new connection was opened"""
+        async with self.upstream_lock:
+            if self.upstream is not None:
+                return False
+            self.upstream = await wsc.connect(f"ws://localhost:{self.port}/{query}")
+            #Drop what was queued for a previous connection
+            while not self.upstream_queue.empty():
+                self.upstream_queue.get_nowait()
+            self.upstream_tasks = [
+                asyncio.ensure_future(self.run_upstream_reader(self.upstream)),
+                asyncio.ensure_future(self.run_upstream_writer(self.upstream)),
+            ]
+            return True
+
+    async def close_upstream(self, upstream: wsc.WebSocketClientProtocol):
+        async with self.upstream_lock:
+            if self.upstream is not upstream:
+                return
+            self.upstream = None
+            for task in self.upstream_tasks:
+                if task is not asyncio.current_task():
+                    task.cancel()
+            self.upstream_tasks = []
+            clients = list(self.forward_clients)
+            self.forward_clients.clear()
+        await upstream.close()
+        print(f"Forwarding of {self.name} closed: {self.forward_stats.to_json()}")
+        for client in clients:
+            await self.ws.send_client(client, {"type": "forward_fail", "device": self.name})
+
+    async def run_upstream_reader(self, upstream: wsc.WebSocketClientProtocol):
         try:
-            async for message in forward:
-                await client.send(json.dumps({"type":"forward", "data":json.loads(message)}))
+            async for message in upstream:
+                if isinstance(message, bytes):
+                    message = message.decode()
+                self.forward_stats.messages_down += 1
+                self.forward_stats.bytes_down += len(message)
+                metrics.FORWARD_MESSAGES.inc(device=self.name, direction="down")
+                metrics.FORWARD_BYTES.inc(len(message), device=self.name, direction="down")
 
+                wrapped = self.prefix + message + FORWARD_SUFFIX
+                for client in list(self.forward_clients):
+                    queue = self.ws.queues.get(client, None)
+                    if queue is not None:
+                        queue.put(wrapped, ui_link.POLICY_KEEP, None)
         except wse.ConnectionClosed:
             pass
         finally:
-            try:
-                await client.send(json.dumps({"type": "forward_fail"}))
-            except wse.ConnectionClosed:
-                pass
-    
+            await self.close_upstream(upstream)
+
+    async def run_upstream_writer(self, upstream: wsc.WebSocketClientProtocol):
+        try:
+            while True:
+                message = await self.upstream_queue.get()
+                await upstream.send(message)
+        except wse.ConnectionClosed:
+            await self.close_upstream(upstream)
+
+    async def send_upstream(self, client, message: str):
+        if self.upstream is None or client not in self.forward_clients:
+            await self.ws.send_client(client, {"type": "forward_fail", "device": self.name})
+            return
+        try:
+            await asyncio.wait_for(self.upstream_queue.put(message), settings.FORWARD_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Forwarding to {self.name} stalled, message dropped")
+            self.forward_stats.dropped_up += 1
+            metrics.FORWARD_MESSAGES.inc(device=self.name, direction="dropped_up")
+            #The browser closes its panel, reopens forwarding and resyncs
+            self.remove_forward_client(client)
+            await self.ws.send_client(client, {"type": "forward_fail", "device": self.name})
+            return
+        self.forward_stats.messages_up += 1
+        self.forward_stats.bytes_up += len(message)
+        metrics.FORWARD_MESSAGES.inc(device=self.name, direction="up")
+        metrics.FORWARD_BYTES.inc(len(message), device=self.name, direction="up")
+
+    async def on_forward_open(self, client, resume: Any):
+        resync: Dict[str, Any] = {"type": "state_resync"}
+        query = ""
+        if isinstance(resume, dict):
+            resync["epoch"] = resume.get("epoch")
+            resync["revision"] = resume.get("revision")
+            query = "?" + urllib.parse.urlencode({"epoch": resume.get("epoch"), "revision": resume.get("revision")})
+
+        try:
+            opened = await self.open_upstream(query)
+        except (OSError, wse.InvalidHandshake):
+            await self.ws.send_client(client, {"type": "forward_fail", "device": self.name})
+            return
+        #No await before this, the reader task has not run yet and the success comes before any forwarded frame
+        self.forward_clients.add(client)
+        await self.ws.send_client(client, {"type": "forward_success", "device": self.name})
+
+        #On a shared connection the EV process sends what the browser is missing since its revision
+        #(or a snapshot) to every browser, the others skip deltas they already have
+        if not opened:
+            await self.send_upstream(client, json.dumps(resync))
+
+    def remove_forward_client(self, client):
+        self.forward_clients.discard(client)
+        if len(self.forward_clients) == 0 and self.upstream is not None:
+            asyncio.ensure_future(self.close_upstream(self.upstream))
+
+class UI_Harness(ui_link.UI_Link):
+    metrics_name = "harness"
+    #By interface name, in the order of settings.EV_DEVICES
+    devices: Dict[str, Device]
+    #Messages without a device go to the first one
+    default_device: Device
+
+    def __init__(self, results_folder, devices: List[Tuple[str, int]] | None = None):
+        super().__init__()
+
+        if devices is None:
+            devices = settings.EV_DEVICES
+        self.devices = {}
+        for name, port in devices:
+            self.devices[name] = Device(self, name, port, results_folder, f"_{name}" if len(devices) > 1 else "")
+        self.default_device = next(iter(self.devices.values()))
+
+    def get_device(self, message: Dict[str, Any]) -> Device:
+        return self.devices.get(message.get("device", None), self.default_device)
+
+    def unwrap_forward(self, message_s: str) -> Tuple[Device, str] | None:
+        """Device and payload of a wrapped frame, without parsing the payload"""
+        if not message_s.endswith(FORWARD_SUFFIX):
+            return None
+        for device in self.devices.values():
+            if message_s.startswith(device.prefix):
+                return device, message_s[len(device.prefix):-len(FORWARD_SUFFIX)]
+        if message_s.startswith(FORWARD_PREFIX):
+            return self.default_device, message_s[len(FORWARD_PREFIX):-len(FORWARD_SUFFIX)]
+        return None
+
     async def on_websocket_client_inner(self, client: wss.WebSocketServerProtocol):
-        await self.state_info.send_state_init(client)
+        await self.send_client(client, {
+            "type": "devices",
+            "devices": list(self.devices.keys())
+        })
+        for device in self.devices.values():
+            await device.state_info.send_state_init(client)
+            await device.state_process.send_state_init(client)
         await self.send_client(client, {
             "type": "init_done"
         })
 
-        forward_socket: None | wsc.WebSocketClientProtocol = None    
-
-        async for message_s in client:
-            try:
-                message = json.loads(message_s)
-                
-                if message["type"] == "info":
-                    await self.state_info.on_message(message["data"])
-                elif message["type"] == "process":
-                    await self.state_process.on_message(message["data"])
-
-                elif message["type"] == "forward_open":
-                    if forward_socket is not None:
-                        await forward_socket.close()
-
-                    try:
-                        forward_socket = await wsc.connect(f"ws://localhost:{settings.WS_PORT_NSSL}")
-                        await client.send(json.dumps({"type": "forward_success"}))
-                        asyncio.ensure_future(UI_Harness.run_forward(client, forward_socket))
-                        
-                    except (OSError, wse.InvalidHandshake):
-                        await client.send(json.dumps({"type": "forward_fail"}))
-                        pass
-
-
-                elif message["type"] == "forward":
-                    if forward_socket is not None:
-                        try:
-                            await forward_socket.send(json.dumps(message["data"]))
-                        except wse.ConnectionClosed:
-                            forward_socket = None
-
-                    if forward_socket is None:
-                        await client.send(json.dumps({"type": "forward_fail"}))
-                
-                #elif message["type"] == "shutdown":
-                #    os.system("shutdown -h now")
-
-            except KeyboardInterrupt:
-                raise
-            except asyncio.CancelledError:
-                raise
-            except:
-                logging.error(traceback.format_exc())
-                pass
+        try:
+            async for message_s in client:
+                try:
+                    if isinstance(message_s, str):
+                        forward = self.unwrap_forward(message_s)
+                        if forward is not None:
+                            await forward[0].send_upstream(client, forward[1])
+                            continue
+
+                    message = json.loads(message_s)
+                    
+                    if message["type"] == "info":
+                        await self.get_device(message).state_info.on_message(message["data"])
+                    elif message["type"] == "process":
+                        await self.get_device(message).state_process.on_message(message["data"])
+
+                    elif message["type"] == "forward_open":
+                        await self.get_device(message).on_forward_open(client, message.get("resume", None))
+
+                    elif message["type"] == "forward":
+                        #Other spellings of a forwarded frame
+                        await self.get_device(message).send_upstream(client, json.dumps(message["data"]))
+                    
+                    #elif message["type"] == "shutdown":
+                    #    os.system("shutdown -h now")
+
+                except KeyboardInterrupt:
+                    raise
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    logging.error(traceback.format_exc())
+                    pass
+        finally:
+            for device in self.devices.values():
+                device.remove_forward_client(client)
@@ -3,15 +3,17 @@ import websockets.exceptions as wse
 import traceback
 import asyncio
 import logging
-from typing import List
+from typing import List, Tuple
 from . import states
 from . import states_task
 from ..utils import settings
+from ..utils import metrics
 import json
 import ssl
 import os
 
 from . import ui_link
+from . import state_store
 
 from ..interface import slac
 from ..interface import sdp
@@ -27,10 +29,15 @@ class UI_Inner(ui_link.UI_Link):
     state_sdp: sdp.StateSDPClient
     state_proto: states.StateProto
     state_v2g: states.StateV2G
+    store: state_store.StateStore
+    metrics_name = "ev"
     
     def __init__(self):
         self.clients = []
         self.client_lock = asyncio.Lock()
+        self.queues = {}
+        self.store = state_store.StateStore()
+        metrics.WS_CLIENTS.add_function(lambda: {(self.metrics_name,): len(self.clients)})
 
         self.state_tasks = []
         self.state_basic = states.StateBasic(self)
@@ -48,7 +55,7 @@ class UI_Inner(ui_link.UI_Link):
                 self.add_task(task.requires.task)
             self.state_tasks.append(task)
 
-    async def on_websocket_message(self, message_s):
+    async def on_websocket_message(self, message_s, client = None):
         try:
             message = json.loads(message_s)
             #print(message)
@@ -59,6 +66,12 @@ class UI_Inner(ui_link.UI_Link):
                 await self.waiter_plug.on_message(message["data"])
             elif message["type"] == "waiter_done":
                 await self.waiter_done.on_message(message["data"])
+            elif message["type"] == "state_resync":
+                #The client lost track of the revisions, or joined a shared connection at the given one
+                resume = None
+                if isinstance(message.get("epoch", None), str) and isinstance(message.get("revision", None), int):
+                    resume = (message["epoch"], message["revision"])
+                await self.send_sync(client, resume)
             else:
                 print("Unknown type")
         except KeyboardInterrupt:
@@ -67,39 +80,71 @@ class UI_Inner(ui_link.UI_Link):
             logging.error(traceback.format_exc())
             pass
 
+    async def send_broadcast(self, message):
+        """State messages update the store and go out as deltas"""
+        key = state_store.state_key(message)
+        if key is None:
+            await super().send_broadcast(message)
+            return
+        base = self.store.revision
+        ops = self.store.update(key, message)
+        if len(ops):
+            await super().send_broadcast(self.store.delta_message(base, ops))
+
+    async def send_client(self, client, message):
+        if client is state_store.STORE_CLIENT:
+            await self.send_broadcast(message)
+        else:
+            await super().send_client(client, message)
+
+    async def capture_states(self):
+        """Bring the store up to date with every state object"""
+        await self.send_broadcast({
+            "type": "init_tasks",
+            "tasks": [ t.get_state_init() for t in self.state_tasks ]
+        })
+
+        await self.state_basic.send_state_init(state_store.STORE_CLIENT)
+        await self.waiter_start.send_state_init(state_store.STORE_CLIENT)
+        await self.waiter_plug.send_state_init(state_store.STORE_CLIENT)
+        await self.waiter_done.send_state_init(state_store.STORE_CLIENT)
+        await self.state_slac.send_state_init(state_store.STORE_CLIENT)
+        await self.state_sdp.send_state_init(state_store.STORE_CLIENT)
+        await self.state_proto.send_state_init(state_store.STORE_CLIENT)
+        await self.state_v2g.send_state_init(state_store.STORE_CLIENT)
+
+    async def send_sync(self, client, resume: Tuple[str, int] | None):
+        """Delta from the revision the client has if possible, else the full state"""
+        if resume is not None and resume[0] == self.store.epoch:
+            ops = self.store.delta_since(resume[1])
+            if ops is not None:
+                await self.send_client(client, self.store.delta_message(resume[1], ops))
+                return
+        await self.send_client(client, self.store.snapshot_message())
+
     async def on_websocket_client(self, client):
         print("Client connected")
-        async with self.client_lock:
-            self.clients.append(client)
+        path = getattr(client, "path", None)
+        if path is None and getattr(client, "request", None) is not None:
+            path = client.request.path
+        resume = state_store.parse_resume(path)
+
+        await self.capture_states()
+        await self.add_client(client)
         
         try:
-            #Send all tasks
-            await self.send_client(client, {
-                "type": "init_tasks",
-                "tasks": [ t.get_state_init() for t in self.state_tasks ]
-            })
-
-            await self.state_basic.send_state_init(client)
-            await self.waiter_start.send_state_init(client)
-            await self.waiter_plug.send_state_init(client)
-            await self.waiter_done.send_state_init(client)
-            await self.state_slac.send_state_init(client)
-            await self.state_sdp.send_state_init(client)
-            await self.state_proto.send_state_init(client)
-            await self.state_v2g.send_state_init(client)
+            await self.send_sync(client, resume)
             await self.send_client(client, {
                 "type": "init_done"
             })
 
             async for message in client:
-                await self.on_websocket_message(message)
+                await self.on_websocket_message(message, client)
         except wse.ConnectionClosedError:
             print("Client crash")
         except:
             print("Client unexpected crash")
             raise
         finally:
-            async with self.client_lock:
-                self.clients.remove(client)
-                print(self.clients)
+            await self.remove_client(client)
             print("Client done")
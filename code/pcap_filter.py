@@ -0,0 +1,89 @@
+"""
+Capture profiles: classic BPF programs for the ring capture, and the equivalent tcpdump expressions
+"""
+
+from __future__ import annotations
+
+import ctypes
+import socket
+import struct
+from typing import Dict, List, NamedTuple, Tuple
+
+SO_ATTACH_FILTER = 26
+
+#Classic BPF opcodes
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_JEQ_K = 0x15
+BPF_JGE_K = 0x35
+BPF_RET_K = 0x06
+
+ETH_P_HOMEPLUG_AV = 0x88E1
+ETH_P_IPV6 = 0x86DD
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+V2G_UDP_PORT = 15118
+
+#Vendor specific HomePlug MMEs (modem management, e.g. nw_info/sw_ver queries) start at MMTYPE 0xA000
+HOMEPLUG_VENDOR_MMTYPE_HIGH = 0xA0
+
+# (code, jt, jf, k)
+BpfInstr = Tuple[int, int, int, int]
+
+class CaptureProfile(NamedTuple):
+    name: str
+    #None: capture everything
+    program: List[BpfInstr] | None
+    tcpdump_filter: str | None
+    snaplen: int
+
+def slac_v2g_program(snaplen: int, homeplug_only: bool) -> List[BpfInstr]:
+    """
+    Accept HomePlug AV frames that are not vendor management messages,
+    and (unless homeplug_only) IPv6 TCP and SDP/UDP 15118
+    """
+    accept = [(BPF_RET_K, 0, 0, snaplen)]
+    drop = [(BPF_RET_K, 0, 0, 0)]
+    if homeplug_only:
+        return [
+            (BPF_LD_H_ABS, 0, 0, 12),
+            (BPF_JEQ_K, 0, 3, ETH_P_HOMEPLUG_AV),
+            (BPF_LD_B_ABS, 0, 0, 16), #High byte of little endian MMTYPE
+            (BPF_JGE_K, 1, 0, HOMEPLUG_VENDOR_MMTYPE_HIGH),
+        ] + accept + drop
+    return [
+        (BPF_LD_H_ABS, 0, 0, 12),                       #0
+        (BPF_JEQ_K, 0, 3, ETH_P_HOMEPLUG_AV),           #1 -> 2 / 5
+        (BPF_LD_B_ABS, 0, 0, 16),                       #2
+        (BPF_JGE_K, 10, 0, HOMEPLUG_VENDOR_MMTYPE_HIGH), #3 -> drop / 4
+        (BPF_RET_K, 0, 0, snaplen),                     #4 accept
+        (BPF_JEQ_K, 0, 8, ETH_P_IPV6),                  #5 -> 6 / drop
+        (BPF_LD_B_ABS, 0, 0, 20),                       #6 IPv6 next header
+        (BPF_JEQ_K, 5, 0, IPPROTO_TCP),                 #7 -> accept / 8
+        (BPF_JEQ_K, 0, 5, IPPROTO_UDP),                 #8 -> 9 / drop
+        (BPF_LD_H_ABS, 0, 0, 54),                       #9 UDP source port
+        (BPF_JEQ_K, 2, 0, V2G_UDP_PORT),                #10 -> accept / 11
+        (BPF_LD_H_ABS, 0, 0, 56),                       #11 UDP destination port
+        (BPF_JEQ_K, 0, 1, V2G_UDP_PORT),                #12 -> accept / drop
+        (BPF_RET_K, 0, 0, snaplen),                     #13 accept
+        (BPF_RET_K, 0, 0, 0),                           #14 drop
+    ]
+
+PROFILES: Dict[str, CaptureProfile] = {
+    "all": CaptureProfile("all", None, None, 65535),
+    "slac_v2g": CaptureProfile(
+        "slac_v2g", slac_v2g_program(65535, False),
+        f"(ether proto 0x88e1 and ether[16] < 0xa0) or (ip6 and (tcp or udp port {V2G_UDP_PORT}))", 65535
+    ),
+    "slac": CaptureProfile(
+        "slac", slac_v2g_program(65535, True),
+        "ether proto 0x88e1 and ether[16] < 0xa0", 65535
+    ),
+}
+
+def attach_filter(sock: socket.socket, program: List[BpfInstr]):
+    raw = b"".join(struct.pack("=HBBI", *instr) for instr in program)
+    buf = ctypes.create_string_buffer(raw)
+    #struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
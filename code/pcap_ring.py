@@ -0,0 +1,392 @@
+"""
+In-process packet capture using an AF_PACKET socket with a TPACKET_V3 memory mapped ring,
+written to pcapng by a separate writer thread
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import mmap
+import os
+import shutil
+import queue
+import select
+import socket
+import struct
+import threading
+from typing import Any, BinaryIO, Dict, List, Tuple
+
+from . import pcap_filter
+
+#Linux constants, not all exported by the socket module
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+#struct tpacket_block_desc / tpacket_hdr_v1
+BLOCK_STATUS_OFFSET = 8
+BLOCK_HDR = struct.Struct("=IIII") #block_status, num_pkts, offset_to_first_pkt, blk_len
+#struct tpacket3_hdr
+PACKET_HDR = struct.Struct("=IIIIIIHH") #next_offset, sec, nsec, snaplen, len, status, mac, net
+
+#pcapng blocks
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_EPB = 0x00000006
+LINKTYPE_ETHERNET = 1
+
+# (timestamp ns, captured data, original length)
+Packet = Tuple[int, bytes, int]
+
+def pad4(b: bytes) -> bytes:
+    return b + b"\x00" * (-len(b) % 4)
+
+def pcapng_block(block_type: int, body: bytes) -> bytes:
+    body = pad4(body)
+    total = len(body) + 12
+    return struct.pack("<II", block_type, total) + body + struct.pack("<I", total)
+
+def pcapng_option(code: int, value: bytes) -> bytes:
+    return struct.pack("<HH", code, len(value)) + pad4(value)
+
+class PcapngWriter():
+    """Minimal pcapng writer, one section with one interface and nanosecond timestamps"""
+    f: BinaryIO
+
+    def __init__(self, f: BinaryIO, interface: str, snaplen: int = 65535):
+        self.f = f
+        self.f.write(pcapng_block(PCAPNG_SHB, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)))
+        self.f.write(pcapng_block(PCAPNG_IDB,
+            struct.pack("<HHI", LINKTYPE_ETHERNET, 0, snaplen) +
+            pcapng_option(2, interface.encode()) + #if_name
+            pcapng_option(9, b"\x09") + #if_tsresol: nanoseconds
+            pcapng_option(0, b"")
+        ))
+
+    def write_packet(self, ts_ns: int, data: bytes, orig_len: int):
+        self.f.write(pcapng_block(PCAPNG_EPB,
+            struct.pack("<IIIII", 0, ts_ns >> 32, ts_ns & 0xFFFFFFFF, len(data), orig_len) + data
+        ))
+
+class SegmentIndex():
+    """
+    Index of the capture segments of a session, for analysis tools.
+    Rewritten atomically on every change, so it is always readable.
+    """
+    path: str
+    profile: str
+    segments: List[Dict[str, Any]]
+
+    def __init__(self, path: str, profile: str):
+        self.path = path
+        self.profile = profile
+        self.segments = []
+        self.lock = threading.Lock()
+
+    def update(self, segment: Dict[str, Any]):
+        with self.lock:
+            for i, s in enumerate(self.segments):
+                if s["id"] == segment["id"]:
+                    self.segments[i] = segment
+                    break
+            else:
+                self.segments.append(segment)
+
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({
+                    "version": 1,
+                    "profile": self.profile,
+                    "segments": self.segments
+                }, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+
+class SegmentCompressor():
+    """
+    Compresses closed segments in the background. Not a daemon thread, so pending
+    segments still get compressed when the process exits.
+    """
+    index: SegmentIndex
+
+    def __init__(self, index: SegmentIndex, level: int = 6):
+        self.index = index
+        self.level = level
+        self._queue: queue.Queue[Dict[str, Any] | None] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="pcap_compress")
+        self._thread.start()
+
+    def submit(self, segment: Dict[str, Any]):
+        self._queue.put(segment)
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            segment = self._queue.get()
+            if segment is None:
+                return
+            src = segment["file"]
+            dst = src + ".gz"
+            folder = os.path.dirname(self.index.path)
+            try:
+                with open(os.path.join(folder, src), "rb") as f_in:
+                    with gzip.open(os.path.join(folder, dst + ".tmp"), "wb", compresslevel=self.level) as f_out:
+                        shutil.copyfileobj(f_in, f_out, 1 << 20)
+                os.replace(os.path.join(folder, dst + ".tmp"), os.path.join(folder, dst))
+                os.remove(os.path.join(folder, src))
+            except OSError as e:
+                print(f"Pcap compression failed for {src}: {e}")
+                continue
+            self.index.update(dict(segment, file=dst, compressed=True))
+
+class SegmentWriter():
+    """pcapng output split into segments by size or time"""
+    base: str
+    interface: str
+    snaplen: int
+    rotate_bytes: int | None
+    rotate_ns: int | None
+
+    def __init__(self, base: str, interface: str, snaplen: int, index: SegmentIndex,
+                 rotate_bytes: int | None = None, rotate_seconds: float | None = None,
+                 compressor: SegmentCompressor | None = None):
+        self.base = base
+        self.interface = interface
+        self.snaplen = snaplen
+        self.index = index
+        self.rotate_bytes = rotate_bytes
+        self.rotate_ns = int(rotate_seconds * 1e9) if rotate_seconds is not None else None
+        self.compressor = compressor
+
+        self.f: BinaryIO | None = None
+        self.writer: PcapngWriter | None = None
+        self.segment: Dict[str, Any] | None = None
+        self.next_id = 0
+
+    def segment_name(self, id: int) -> str:
+        if self.rotate_bytes is None and self.rotate_ns is None:
+            return os.path.basename(self.base)
+        stem, ext = os.path.splitext(os.path.basename(self.base))
+        return f"{stem}.{id:05d}{ext}"
+
+    def open(self, ts_ns: int | None):
+        name = self.segment_name(self.next_id)
+        self.f = open(os.path.join(os.path.dirname(self.base), name), "wb")
+        self.writer = PcapngWriter(self.f, self.interface, self.snaplen)
+        self.segment = {
+            "id": self.next_id,
+            "file": name,
+            "start_ns": ts_ns,
+            "end_ns": ts_ns,
+            "packets": 0,
+            "bytes": self.f.tell(),
+            "closed": False,
+            "compressed": False,
+        }
+        self.next_id += 1
+        self.index.update(dict(self.segment))
+
+    def close(self):
+        if self.f is None or self.segment is None:
+            return
+        self.f.close()
+        self.f = None
+        self.writer = None
+        self.segment["closed"] = True
+        self.index.update(dict(self.segment))
+        if self.compressor is not None:
+            self.compressor.submit(dict(self.segment))
+        self.segment = None
+
+    def should_rotate(self, ts_ns: int) -> bool:
+        assert self.segment is not None
+        if self.segment["packets"] == 0:
+            return False
+        if self.rotate_bytes is not None and self.segment["bytes"] >= self.rotate_bytes:
+            return True
+        if self.rotate_ns is not None and ts_ns - self.segment["start_ns"] >= self.rotate_ns:
+            return True
+        return False
+
+    def write(self, packets: List[Packet]):
+        for ts, data, orig_len in packets:
+            if self.segment is not None and self.should_rotate(ts):
+                self.close()
+            if self.segment is None:
+                self.open(ts)
+            assert self.writer is not None and self.segment is not None and self.f is not None
+            self.writer.write_packet(ts, data, orig_len)
+            if self.segment["start_ns"] is None:
+                self.segment["start_ns"] = ts
+            self.segment["end_ns"] = ts
+            self.segment["packets"] += 1
+            self.segment["bytes"] = self.f.tell()
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+class RingCapture():
+    """
+    Capture all frames of an interface into a pcapng file.
+    start() only returns once the socket is bound, so no frame after that point is missed.
+    """
+    interface: str
+    output: str
+
+    block_size: int
+    block_nr: int
+    retire_ms: int
+
+    sock: socket.socket | None
+    ring: mmap.mmap | None
+
+    def __init__(self, interface: str, output: str,
+                 profile: pcap_filter.CaptureProfile = pcap_filter.PROFILES["all"],
+                 rotate_bytes: int | None = None, rotate_seconds: float | None = None, compress: bool = False,
+                 block_size: int = 1 << 20, block_nr: int = 4, retire_ms: int = 10):
+        self.interface = interface
+        self.output = output
+        self.profile = profile
+
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.retire_ms = retire_ms
+
+        self.sock = None
+        self.ring = None
+
+        self.index = SegmentIndex(os.path.splitext(output)[0] + ".index.json", profile.name)
+        self.compressor = SegmentCompressor(self.index) if compress else None
+        self.segments = SegmentWriter(output, interface, profile.snaplen, self.index, rotate_bytes, rotate_seconds, self.compressor)
+
+        self._queue: queue.Queue[List[Packet] | None] = queue.Queue()
+        self._stop_r = -1
+        self._stop_w = -1
+        self._reader: threading.Thread | None = None
+        self._writer: threading.Thread | None = None
+
+        self.packets = 0
+        self.drops = 0
+
+    def start(self):
+        frame_size = 2048
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack("=IIIIIII",
+                self.block_size, self.block_nr,
+                frame_size, (self.block_size * self.block_nr) // frame_size,
+                self.retire_ms, 0, 0
+            ))
+            if self.profile.program is not None:
+                pcap_filter.attach_filter(sock, self.profile.program)
+            self.ring = mmap.mmap(sock.fileno(), self.block_size * self.block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            #Socket was created without a protocol, so nothing is queued before binding to the interface
+            sock.bind((self.interface, ETH_P_ALL))
+            #First segment exists from the start, even if nothing is captured
+            self.segments.open(None)
+        except:
+            if self.ring is not None:
+                self.ring.close()
+                self.ring = None
+            if self.compressor is not None:
+                self.compressor.close()
+            sock.close()
+            raise
+        self.sock = sock
+        self._stop_r, self._stop_w = os.pipe()
+
+        self._writer = threading.Thread(target=self._write_thread, name="pcap_writer", daemon=True)
+        self._writer.start()
+        self._reader = threading.Thread(target=self._read_thread, name="pcap_reader", daemon=True)
+        self._reader.start()
+
+    def _read_blocks(self, block_i: int) -> int:
+        """Hand all blocks the kernel released to the writer, returns the next block to check"""
+        ring = self.ring
+        assert ring is not None
+        while True:
+            base = block_i * self.block_size
+            status, num_pkts, first_offset, _ = BLOCK_HDR.unpack_from(ring, base + BLOCK_STATUS_OFFSET)
+            if not (status & TP_STATUS_USER):
+                return block_i
+
+            packets: List[Packet] = []
+            offset = base + first_offset
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, pkt_len, _, mac, _ = PACKET_HDR.unpack_from(ring, offset)
+                packets.append((sec * 1000000000 + nsec, ring[offset + mac: offset + mac + snaplen], pkt_len))
+                offset += next_offset
+
+            #Give block back to the kernel
+            struct.pack_into("=I", ring, base + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+
+            self.packets += len(packets)
+            self._queue.put(packets)
+            block_i = (block_i + 1) % self.block_nr
+
+    def _read_thread(self):
+        assert self.sock is not None
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+        poller.register(self._stop_r, select.POLLIN)
+
+        block_i = 0
+        try:
+            while True:
+                events = poller.poll()
+                block_i = self._read_blocks(block_i)
+                if any(fd == self._stop_r for fd, _ in events):
+                    break
+            #Let the kernel retire the partially filled block, then collect it
+            poller.unregister(self._stop_r)
+            poller.poll(2 * self.retire_ms)
+            self._read_blocks(block_i)
+        finally:
+            self._queue.put(None)
+
+    def _write_thread(self):
+        try:
+            while True:
+                packets = self._queue.get()
+                if packets is None:
+                    break
+                self.segments.write(packets)
+                if self._queue.empty():
+                    self.segments.flush()
+        finally:
+            self.segments.close()
+            if self.compressor is not None:
+                self.compressor.close()
+
+    def stop(self):
+        if self._reader is not None:
+            os.write(self._stop_w, b"\x00")
+            self._reader.join()
+            self._reader = None
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+        if self.sock is not None:
+            #tp_packets, tp_drops, tp_freeze_q_cnt
+            _, self.drops, _ = struct.unpack("=III", self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+            if self.ring is not None:
+                self.ring.close()
+                self.ring = None
+            self.sock.close()
+            self.sock = None
+
+        if self._stop_r >= 0:
+            os.close(self._stop_r)
+            os.close(self._stop_w)
+            self._stop_r = -1
+            self._stop_w = -1
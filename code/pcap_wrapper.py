@@ -1,9 +1,57 @@
 import subprocess
 import signal
+import os
 
 from contextlib import contextmanager
 
 from .utils import settings
+from . import pcap_ring
+from . import pcap_filter
+
+@contextmanager
+def pcap_context_tcpdump(interface: str, output: str):
+    print(output)
+    # Code to acquire resource:
+    #Rotation and compression are only supported by the ring backend
+    profile = pcap_filter.PROFILES[settings.PCAP_PROFILE]
+    pcap_process = subprocess.Popen([
+        "tcpdump",
+        "-i", interface,
+        "-s", str(profile.snaplen),
+        "-w", output
+    ] + ([profile.tcpdump_filter] if profile.tcpdump_filter is not None else []))
+    try:
+        yield pcap_process
+    finally:
+        # Code to release resource:
+        if pcap_process is not None:
+            print("Pcap exit")
+            pcap_process.send_signal(signal.SIGINT)
+            try:
+                pcap_process.wait(1)
+            except subprocess.TimeoutExpired:
+                print("Pcap kill")
+                pcap_process.kill()
+
+@contextmanager
+def pcap_context_ring(interface: str, output: str):
+    #Ring capture writes pcapng
+    output = os.path.splitext(output)[0] + ".pcapng"
+    print(output)
+    capture = pcap_ring.RingCapture(
+        interface, output,
+        profile = pcap_filter.PROFILES[settings.PCAP_PROFILE],
+        rotate_bytes = settings.PCAP_ROTATE_BYTES,
+        rotate_seconds = settings.PCAP_ROTATE_SECONDS,
+        compress = settings.PCAP_COMPRESS
+    )
+    #Returns once the socket is bound, nothing sent after this is missed
+    capture.start()
+    try:
+        yield capture
+    finally:
+        capture.stop()
+        print(f"Pcap exit, {capture.packets} packets, {capture.drops} dropped")
 
 @contextmanager
 def pcap_context(interface: str, output: str):
@@ -13,24 +61,10 @@ def pcap_context(interface: str, output: str):
         finally:
              pass
 
+    elif settings.PCAP_BACKEND == "ring":
+        with pcap_context_ring(interface, output) as capture:
+            yield capture
+
     else:
-        print(output)
-        # Code to acquire resource:
-        pcap_process = subprocess.Popen([
-            "tcpdump",
-            "-i", interface,
-            "-s", "65535",
-            "-w", output
-        ])
-        try:
-            yield pcap_process
-        finally:
-            # Code to release resource:
-            if pcap_process is not None:
-                print("Pcap exit")
-                pcap_process.send_signal(signal.SIGINT)
-                try:
-                    pcap_process.wait(1)
-                except subprocess.TimeoutExpired:
-                    print("Pcap kill")
-                    pcap_process.kill()
\ No newline at end of file
+        with pcap_context_tcpdump(interface, output) as capture:
+            yield capture
@@ -0,0 +1,185 @@
+"""
+Writers for the append only logs of DataSaver (JSON lines backup log, binary log)
+"""
+
+from __future__ import annotations
+
+import atexit
+import os
+import queue
+import threading
+import time
+from typing import List, Tuple
+
+#Durability modes
+DURABILITY_FLUSH = "flush" #Flush to the OS on every flush point
+DURABILITY_FSYNC = "fsync" #Flush and fsync on every flush point
+DURABILITY_NONE = "none" #Leave it to the file buffer, only flushed on close
+
+DURABILITY_MODES = [DURABILITY_FLUSH, DURABILITY_FSYNC, DURABILITY_NONE]
+
+class BackupWriterError(Exception):
+    """The background thread could not write the log, records written since are lost"""
+    def __init__(self, msg):
+        super().__init__(msg)
+
+def flush_file(f, durability: str):
+    if durability == DURABILITY_NONE:
+        return
+    f.flush()
+    if durability == DURABILITY_FSYNC:
+        os.fsync(f.fileno())
+
+class SyncBackupWriter():
+    """Writes and flushes every record on the calling thread"""
+    path: str
+    durability: str
+
+    def __init__(self, path: str, durability: str):
+        self.path = path
+        self.durability = durability
+        self.file = open(path, "ab")
+
+    def write(self, line: bytes, boundary: bool):
+        self.file.write(line)
+        flush_file(self.file, self.durability)
+
+    def depth(self) -> int:
+        return 0
+
+    def close(self):
+        self.file.close()
+
+class ThreadedBackupWriter():
+    """
+    Records are queued and written in batches by a background thread.
+    A batch is flushed when the oldest unflushed record is flush_seconds old, when flush_bytes are unflushed,
+    and at every trace boundary. A full queue blocks the caller rather than dropping records.
+    If writing fails, the thread keeps emptying the queue so that callers never block on it,
+    and write and close raise the error instead.
+    """
+    path: str
+    durability: str
+    flush_seconds: float
+    flush_bytes: int
+
+    #(line, boundary), None to stop
+    queue: "queue.Queue[Tuple[bytes, bool] | None]"
+    thread: threading.Thread
+    closed: bool
+    #Set by the thread when writing failed
+    error: BaseException | None
+
+    #Statistics
+    lines: int
+    flushes: int
+    max_depth: int
+
+    def __init__(self, path: str, durability: str, flush_seconds: float, flush_bytes: int, queue_size: int):
+        self.path = path
+        self.durability = durability
+        self.flush_seconds = flush_seconds
+        self.flush_bytes = flush_bytes
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+        self.error = None
+        self.lines = 0
+        self.flushes = 0
+        self.max_depth = 0
+
+        #Open on the caller so that errors show up where the log is started
+        self.file = open(path, "ab")
+        self.thread = threading.Thread(target=self.run_thread, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def raise_error(self):
+        if self.error is not None:
+            raise BackupWriterError(f"Writing {self.path} failed: {type(self.error).__name__}: {self.error}") from self.error
+
+    def write(self, line: bytes, boundary: bool):
+        self.raise_error()
+        self.queue.put((line, boundary))
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def run_thread(self):
+        try:
+            self.write_batches()
+        except Exception as e:
+            self.error = e
+            print(f"Backup writer for {self.path} failed: {type(e).__name__}: {e}")
+            #Nobody may block on a full queue, drop everything until close
+            while self.queue.get() is not None:
+                pass
+            try:
+                self.file.close()
+            except OSError:
+                pass
+
+    def write_batches(self):
+        unflushed = 0
+        #Time of the oldest record not flushed yet
+        oldest = 0.0
+        stop = False
+        while not stop:
+            timeout = None
+            if unflushed:
+                timeout = max(0.0, oldest + self.flush_seconds - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = (b"", False)
+
+            #Take everything that is already queued as one batch
+            batch: List[bytes] = []
+            flush = False
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                line, boundary = item
+                if len(line):
+                    batch.append(line)
+                flush = flush or boundary
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if len(batch):
+                if unflushed == 0:
+                    oldest = time.monotonic()
+                self.file.write(b"".join(batch))
+                unflushed += sum(len(line) for line in batch)
+                self.lines += len(batch)
+
+            if unflushed and (stop or flush or unflushed >= self.flush_bytes or time.monotonic() - oldest >= self.flush_seconds):
+                flush_file(self.file, self.durability)
+                self.flushes += 1
+                unflushed = 0
+        self.file.close()
+
+    def close(self):
+        """Write everything still queued and close the file"""
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+def make_backup_writer(path: str, writer: str, durability: str, flush_seconds: float, flush_bytes: int, queue_size: int):
+    if durability not in DURABILITY_MODES:
+        raise ValueError(f"Unknown backup durability mode {durability}")
+    if writer == "sync":
+        return SyncBackupWriter(path, durability)
+    if writer == "thread":
+        return ThreadedBackupWriter(path, durability, flush_seconds, flush_bytes, queue_size)
+    raise ValueError(f"Unknown backup writer {writer}")
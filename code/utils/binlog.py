@@ -0,0 +1,317 @@
+"""
+Compact binary session log: length prefixed records with interned trace paths and data types,
+integer ns timestamps and raw payload bytes, plus a sidecar offset index for seeking
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import struct
+import zlib
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Tuple
+
+LOG_FILE = "log.bin"
+INDEX_SUFFIX = ".idx"
+
+LOG_MAGIC = b"V2GLOG\x00\x01"
+INDEX_MAGIC = b"V2GIDX\x00\x01"
+
+#Record kinds
+KIND_TRACE = 1 #Defines a trace path id: id, parent id and last element
+KIND_TYPE = 2 #Defines a data type id
+KIND_ENTRY = 3 #One log entry
+
+#Payload encodings of entries
+ENC_NULL = 0
+ENC_JSON = 1
+ENC_TEXT = 2
+ENC_RAW = 3 #{"version", "type", "data": hex} of a V2GTP packet, stored as bytes
+ENC_COMPRESSED = 0x80 #Flag: payload is zlib compressed
+
+#Payloads from this size on are compressed when compression is enabled
+COMPRESS_MIN = 256
+
+#Trace id 0 is the empty trace
+ROOT_TRACE = 0
+
+LENGTH = struct.Struct("<I")
+TRACE_HEAD = struct.Struct("<BII")
+TYPE_HEAD = struct.Struct("<BH")
+ENTRY_HEAD = struct.Struct("<BqIHB")
+RAW_HEAD = struct.Struct("<BH")
+#(offset, trace id, type id, kind)
+INDEX_ENTRY = struct.Struct("<QIHBx")
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+#Trace leave times were always logged without fractions
+TIME_FORMATS = {"TRACE_LEAVE": "%Y-%m-%d %H:%M:%S"}
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+def time_to_ns(t: datetime.datetime) -> int:
+    return ((t - EPOCH) // datetime.timedelta(microseconds=1)) * 1000
+
+def ns_to_time(ns: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=ns // 1000)
+
+def format_time(ns: int, data_type: str) -> str:
+    return ns_to_time(ns).strftime(TIME_FORMATS.get(data_type, TIME_FORMAT))
+
+def encode_payload(data_type: str, data: Any, compress: bool) -> Tuple[int, bytes]:
+    if data is None:
+        return ENC_NULL, b""
+    if isinstance(data, str):
+        enc, payload = ENC_TEXT, data.encode()
+    elif data_type == "RAW" and isinstance(data, dict) and data.keys() == {"version", "type", "data"} and \
+            isinstance(data["data"], str) and isinstance(data["version"], int) and isinstance(data["type"], int) and \
+            0 <= data["version"] < 256 and 0 <= data["type"] < 65536:
+        raw = bytes.fromhex(data["data"])
+        #Only when the hex form comes back identical
+        if raw.hex() == data["data"]:
+            enc, payload = ENC_RAW, RAW_HEAD.pack(data["version"], data["type"]) + raw
+        else:
+            enc, payload = ENC_JSON, json.dumps(data).encode()
+    else:
+        enc, payload = ENC_JSON, json.dumps(data).encode()
+
+    if compress and len(payload) >= COMPRESS_MIN:
+        packed = zlib.compress(payload, 6)
+        if len(packed) < len(payload):
+            return enc | ENC_COMPRESSED, packed
+    return enc, payload
+
+def decode_payload(enc: int, payload: bytes) -> Any:
+    if enc & ENC_COMPRESSED:
+        payload = zlib.decompress(payload)
+        enc &= ~ENC_COMPRESSED
+    if enc == ENC_NULL:
+        return None
+    if enc == ENC_TEXT:
+        return payload.decode()
+    if enc == ENC_RAW:
+        version, packet_type = RAW_HEAD.unpack_from(payload, 0)
+        return {"version": version, "type": packet_type, "data": payload[RAW_HEAD.size:].hex()}
+    return json.loads(payload)
+
+class BinaryEntry(NamedTuple):
+    ns: int
+    trace: Tuple[str, ...]
+    data_type: str
+    data: Any
+
+    def to_backup(self) -> Dict[str, Any]:
+        """Same form as a backup.bak.txt line"""
+        return {
+            "version": 1,
+            "type": self.data_type,
+            "trace": list(self.trace),
+            "time": format_time(self.ns, self.data_type),
+            "data": self.data,
+        }
+
+class BinaryLogReader():
+    """Iterates a binary log in order, or seeks to the entries of a trace path or data type through the index"""
+    path: str
+    traces: Dict[int, Tuple[str, ...]]
+    types: Dict[int, str]
+    #(offset, trace id, type id, kind) of every record
+    index: List[Tuple[int, int, int, int]]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.traces = {ROOT_TRACE: ()}
+        self.types = {}
+        self.index = []
+        self.file: BinaryIO = open(path, "rb")
+        if self.file.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            self.file.close()
+            raise ValueError(f"Not a binary log: {path}")
+        self.load_index()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def read_record(self, offset: int) -> Tuple[bytes, int] | None:
+        """(record body, next offset), None if cut off"""
+        self.file.seek(offset)
+        head = self.file.read(LENGTH.size)
+        if len(head) < LENGTH.size:
+            return None
+        length = LENGTH.unpack(head)[0]
+        body = self.file.read(length)
+        if len(body) < length:
+            return None
+        return body, offset + LENGTH.size + length
+
+    def on_definition(self, body: bytes):
+        kind = body[0]
+        if kind == KIND_TRACE:
+            _, trace_id, parent = TRACE_HEAD.unpack_from(body, 0)
+            name = body[TRACE_HEAD.size:].decode()
+            self.traces[trace_id] = self.traces.get(parent, ()) + (name,)
+        elif kind == KIND_TYPE:
+            _, type_id = TYPE_HEAD.unpack_from(body, 0)
+            self.types[type_id] = body[TYPE_HEAD.size:].decode()
+
+    def load_index(self):
+        """Reads the sidecar index, then scans whatever the index does not cover yet (after a crash)"""
+        offset = len(LOG_MAGIC)
+        index_path = self.path + INDEX_SUFFIX
+        if os.path.isfile(index_path):
+            with open(index_path, "rb") as f:
+                if f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+                    raw = f.read()
+                    raw = raw[:len(raw) - len(raw) % INDEX_ENTRY.size]
+                    self.index = list(INDEX_ENTRY.iter_unpack(raw))
+
+        for record_offset, _, _, kind in self.index:
+            if kind != KIND_ENTRY:
+                rec = self.read_record(record_offset)
+                if rec is not None:
+                    self.on_definition(rec[0])
+        if len(self.index):
+            rec = self.read_record(self.index[-1][0])
+            if rec is None:
+                #Index points past the end of a truncated log
+                self.index = [i for i in self.index if self.read_record(i[0]) is not None]
+                rec = self.read_record(self.index[-1][0]) if len(self.index) else None
+            if rec is not None:
+                offset = rec[1]
+
+        while True:
+            rec = self.read_record(offset)
+            if rec is None:
+                break
+            body, next_offset = rec
+            kind = body[0]
+            if kind == KIND_ENTRY:
+                _, _, trace_id, type_id, _ = ENTRY_HEAD.unpack_from(body, 0)
+                self.index.append((offset, trace_id, type_id, kind))
+            else:
+                self.on_definition(body)
+                self.index.append((offset, 0, 0, kind))
+            offset = next_offset
+
+    def decode_entry(self, body: bytes) -> BinaryEntry:
+        _, ns, trace_id, type_id, enc = ENTRY_HEAD.unpack_from(body, 0)
+        return BinaryEntry(ns, self.traces[trace_id], self.types[type_id], decode_payload(enc, body[ENTRY_HEAD.size:]))
+
+    def iter_entries(self, accept: Callable[[int, int], bool] | None = None) -> Iterator[BinaryEntry]:
+        """Entries in log order, optionally only those whose (trace id, type id) is accepted"""
+        for offset, trace_id, type_id, kind in self.index:
+            if kind != KIND_ENTRY or (accept is not None and not accept(trace_id, type_id)):
+                continue
+            rec = self.read_record(offset)
+            if rec is None:
+                return
+            yield self.decode_entry(rec[0])
+
+    def find(self, trace: List[str] | Tuple[str, ...] | None = None, prefix: bool = False,
+             data_type: str | None = None) -> Iterator[BinaryEntry]:
+        """Entries with the given trace path (or below it with prefix) and/or data type"""
+        trace_ids = None
+        if trace is not None:
+            trace = tuple(trace)
+            trace_ids = {i for i, t in self.traces.items() if t == trace or (prefix and t[:len(trace)] == trace)}
+        type_ids = None
+        if data_type is not None:
+            type_ids = {i for i, t in self.types.items() if t == data_type}
+
+        def accept(trace_id: int, type_id: int) -> bool:
+            return (trace_ids is None or trace_id in trace_ids) and (type_ids is None or type_id in type_ids)
+        return self.iter_entries(accept)
+
+def write_index_file(path: str, index: List[Tuple[int, int, int, int]]):
+    tmp = path + INDEX_SUFFIX + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(INDEX_MAGIC)
+        for entry in index:
+            f.write(INDEX_ENTRY.pack(*entry))
+    os.replace(tmp, path + INDEX_SUFFIX)
+
+class BinaryLogWriter():
+    """
+    Encodes records on the calling thread and hands them to two backup writers (log and index).
+    Appending to an existing log continues its trace and type numbering.
+    """
+    path: str
+    compress: bool
+    traces: Dict[Tuple[str, ...], int]
+    types: Dict[str, int]
+    offset: int
+
+    def __init__(self, path: str, compress: bool, make_writer: Callable[[str], Any]):
+        self.path = path
+        self.compress = compress
+        self.traces = {(): ROOT_TRACE}
+        self.types = {}
+
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            with BinaryLogReader(path) as reader:
+                self.traces.update({t: i for i, t in reader.traces.items()})
+                self.types.update({t: i for i, t in reader.types.items()})
+                #Drop a cut off last record and bring the index up to date
+                end = len(LOG_MAGIC)
+                if len(reader.index):
+                    rec = reader.read_record(reader.index[-1][0])
+                    assert rec is not None
+                    end = rec[1]
+                index = reader.index
+            with open(path, "r+b") as f:
+                f.truncate(end)
+            write_index_file(path, index)
+            self.offset = end
+            self.log = make_writer(path)
+            self.index = make_writer(path + INDEX_SUFFIX)
+        else:
+            self.log = make_writer(path)
+            self.index = make_writer(path + INDEX_SUFFIX)
+            self.log.write(LOG_MAGIC, False)
+            self.index.write(INDEX_MAGIC, False)
+            self.offset = len(LOG_MAGIC)
+
+    def write_record(self, body: bytes, trace_id: int, type_id: int, boundary: bool):
+        self.index.write(INDEX_ENTRY.pack(self.offset, trace_id, type_id, body[0]), boundary)
+        record = LENGTH.pack(len(body)) + body
+        self.log.write(record, boundary)
+        self.offset += len(record)
+
+    def trace_id(self, trace: Tuple[str, ...]) -> int:
+        res = self.traces.get(trace, None)
+        if res is None:
+            parent = self.trace_id(trace[:-1])
+            res = len(self.traces)
+            self.traces[trace] = res
+            self.write_record(TRACE_HEAD.pack(KIND_TRACE, res, parent) + trace[-1].encode(), 0, 0, False)
+        return res
+
+    def type_id(self, data_type: str) -> int:
+        res = self.types.get(data_type, None)
+        if res is None:
+            res = len(self.types)
+            self.types[data_type] = res
+            self.write_record(TYPE_HEAD.pack(KIND_TYPE, res) + data_type.encode(), 0, 0, False)
+        return res
+
+    def write(self, ns: int, trace: Tuple[str, ...], data_type: str, data: Any, boundary: bool):
+        trace_id = self.trace_id(trace)
+        type_id = self.type_id(data_type)
+        enc, payload = encode_payload(data_type, data, self.compress)
+        self.write_record(ENTRY_HEAD.pack(KIND_ENTRY, ns, trace_id, type_id, enc) + payload, trace_id, type_id, boundary)
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+def iter_backup_entries(path: str) -> Iterator[Dict[str, Any]]:
+    """Entries of a binary log in the form of backup.bak.txt lines"""
+    with BinaryLogReader(path) as reader:
+        for entry in reader.iter_entries():
+            yield entry.to_backup()
@@ -1,10 +1,15 @@
 from __future__ import annotations
-import datetime
 import json
 import os
-from typing import Any, List
+import time
+from typing import Any, Dict, List, Tuple
 import traceback
 
+from . import settings
+from .backup_writer import make_backup_writer
+from .binlog import LOG_FILE, BinaryLogWriter
+from .result_writer import ResultStreamWriter
+
 # Context manager for a part of the output log
 class DataSaverTraceContext():
     ctx: "DataSaver"
@@ -60,64 +65,158 @@ class DataSaverFileContext():
 
         self.ctx.trace_file_leave()
 
+class DataSaverClock():
+    """
+    Wall clock time in ns, read for every entry so that NTP steps and slews show up in the log as they happen.
+    Formatting is done on demand, and the date and time up to the second is reused between entries.
+    """
+    last_second: int
+    last_second_str: str
+
+    def __init__(self):
+        self.last_second = -1
+        self.last_second_str = ""
+
+    def now(self) -> int:
+        return time.time_ns()
+
+    def format_seconds(self, ns: int) -> str:
+        """UTC "%Y-%m-%d %H:%M:%S" """
+        second = ns // 1000000000
+        if second != self.last_second:
+            self.last_second = second
+            self.last_second_str = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(second))
+        return self.last_second_str
+
+    def format(self, ns: int) -> str:
+        """UTC "%Y-%m-%d %H:%M:%S.%f" """
+        return f"{self.format_seconds(ns)}.{(ns // 1000) % 1000000:06d}"
+
+def session_name(name: str, box: str, plug: str) -> str:
+    """Trace file name of a charging session"""
+    return f"{name}_{box}_{plug}"
+
+def subfolder(result_folder: str, name: str) -> str:
+    """Folder trace_file_start writes to"""
+    return result_folder + "_" + name
+
 class DataSaver:
     #Base folder for results
     result_folder: str
 
     #Folder for this run
     result_subfolder: str
-    #Line by line backup file
+    #Line by line backup file, or the binary log
     backup_file: Any
+    binary: bool
+
+    clock: DataSaverClock
+
+    #Current trace, shared by all entries logged in it
+    trace: Tuple[str, ...]
+    trace_stack: List[Tuple[str, ...]]
+    #Interned traces by (parent, name), and their JSON form
+    trace_children: Dict[Tuple[Tuple[str, ...], str], Tuple[str, ...]]
+    trace_json: Dict[Tuple[str, ...], str]
+    type_json: Dict[str, str]
 
     #Output data
-    trace: List[str]
     results_heads: List[Any]
     results: Any
+    #Set when result.json is streamed instead of kept in memory
+    result_stream: ResultStreamWriter | None
 
     def __init__(self, result_folder: str):
         self.result_folder = result_folder
         self.backup_file = None
+        self.binary = False
+        self.result_stream = None
+
+        self.clock = DataSaverClock()
 
-        self.trace = []
+        self.trace = ()
+        self.trace_stack = []
+        self.trace_children = {}
+        self.trace_json = {(): "[]"}
+        self.type_json = {}
         self.results_heads = []
 
+    @staticmethod
+    def make_writer(path: str):
+        return make_backup_writer(
+            path,
+            writer = settings.BACKUP_WRITER,
+            durability = settings.BACKUP_DURABILITY,
+            flush_seconds = settings.BACKUP_FLUSH_SECONDS,
+            flush_bytes = settings.BACKUP_FLUSH_BYTES,
+            queue_size = settings.BACKUP_QUEUE_SIZE,
+        )
+
     def init_backup_file(self):
         if self.backup_file is not None:
             self.backup_file.close()
-        self.backup_file = open(os.path.join(self.result_subfolder, "backup.bak.txt"), "a")
-
-
-    def write_backup(self, time_str, type, data):
-        backup_entry = {
-            "version": 1,
-            "type": type,
-            "trace": self.trace.copy(),
-            "time": time_str,
-            "data": data
-        }
-
-        self.backup_file.write(json.dumps(backup_entry, indent=None))
-        self.backup_file.write("\n")
-        self.backup_file.flush()
+        self.binary = settings.LOG_FORMAT == "binary"
+        if self.binary:
+            self.backup_file = BinaryLogWriter(os.path.join(self.result_subfolder, LOG_FILE), settings.LOG_COMPRESS, DataSaver.make_writer)
+        else:
+            self.backup_file = DataSaver.make_writer(os.path.join(self.result_subfolder, "backup.bak.txt"))
+
+    def queue_depth(self) -> Tuple[int, int]:
+        """Records waiting for the backup writers, and the most that ever waited"""
+        if self.backup_file is None:
+            return 0, 0
+        writers = [self.backup_file.log, self.backup_file.index] if self.binary else [self.backup_file]
+        return sum(w.depth() for w in writers), max(getattr(w, "max_depth", 0) for w in writers)
+
+    def write_backup(self, ns: int, time_str: str | None, type: str, data, boundary = False):
+        if self.binary:
+            self.backup_file.write(ns, self.trace, type, data, boundary)
+            return
+
+        type_json = self.type_json.get(type, None)
+        if type_json is None:
+            type_json = json.dumps(type)
+            self.type_json[type] = type_json
+
+        #Same as json.dumps of {"version", "type", "trace", "time", "data"}, serialized here so later changes to data do not end up in the log
+        line = '{"version": 1, "type": ' + type_json + ', "trace": ' + self.trace_json[self.trace] + \
+            ', "time": "' + str(time_str) + '", "data": ' + json.dumps(data) + '}\n'
+        self.backup_file.write(line.encode(), boundary)
 
     def trace_file_start(self, name):
-        self.result_subfolder = self.result_folder + "_" + name
+        self.result_subfolder = subfolder(self.result_folder, name)
         os.makedirs(self.result_subfolder, exist_ok = True)
 
         self.init_backup_file()
+        if settings.RESULT_STREAM and not self.binary:
+            self.result_stream = ResultStreamWriter(os.path.join(self.result_subfolder, "result.json"))
 
         return DataSaverFileContext(self)
 
     def trace_enter(self, entry: str):
-        self.trace.append(entry)
-
-        time_str = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
-        self.write_backup(time_str, "TRACE_ENTER", None)
+        child = self.trace_children.get((self.trace, entry), None)
+        if child is None:
+            child = self.trace + (entry,)
+            self.trace_children[(self.trace, entry)] = child
+            self.trace_json[child] = json.dumps(child)
+        self.trace_stack.append(self.trace)
+        self.trace = child
+
+        ns = self.clock.now()
+        time_str = None if self.binary else self.clock.format(ns)
+        self.write_backup(ns, time_str, "TRACE_ENTER", None, True)
+
+        if self.result_stream is not None:
+            self.result_stream.trace_enter(self.trace, str(time_str))
+            return DataSaverTraceContext(self, entry)
+        if self.binary:
+            #The binary log replaces result.json
+            return DataSaverTraceContext(self, entry)
 
         new_entry = {
             "version": 1,
             "type": "TRACE",
-            "trace": self.trace.copy(),
+            "trace": self.trace,
 
             "start_time": time_str,
             "end_time": None,
@@ -133,13 +232,22 @@ class DataSaver:
         return DataSaverTraceContext(self, entry)
 
     def log_entry(self, data_type: str, data):
-        time_str = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
-        self.write_backup(time_str, data_type, data)
+        ns = self.clock.now()
+        if self.binary:
+            self.write_backup(ns, None, data_type, data)
+            return
+
+        time_str = self.clock.format(ns)
+        self.write_backup(ns, time_str, data_type, data)
+
+        if self.result_stream is not None:
+            self.result_stream.log_entry(self.trace, time_str, data_type, data)
+            return
 
         new_entry = {
             "version": 1,
             "type": "ENTRY",
-            "trace": self.trace.copy(),
+            "trace": self.trace,
 
             "time": time_str,
             "data_type": data_type,
@@ -151,24 +259,30 @@ class DataSaver:
     def trace_leave(self, it: DataSaverTraceContext):
         if self.trace[-1] != it.data_type:
             raise Exception("Logging stack error")
-        
-        time_val = datetime.datetime.now(datetime.timezone.utc)
-        time_str = time_val.strftime("%Y-%m-%d %H:%M:%S")
-        self.write_backup(time_str, "TRACE_LEAVE", None)
 
-        self.results_heads[-1]["end_time"] = time_str
+        ns = self.clock.now()
+        time_str = None if self.binary else self.clock.format_seconds(ns)
+        self.write_backup(ns, time_str, "TRACE_LEAVE", None, True)
 
-        self.results_heads.pop()
-        self.trace.pop()
+        if self.result_stream is not None:
+            self.result_stream.trace_leave(time_str)
+        elif not self.binary:
+            self.results_heads[-1]["end_time"] = time_str
+            self.results_heads.pop()
+        self.trace = self.trace_stack.pop()
 
     def trace_file_leave(self):
-        with open(os.path.join(self.result_subfolder, "result.json"), "w") as f:
-            json.dump(self.results, f, indent=2)
-            self.results = []
+        if self.result_stream is not None:
+            self.result_stream.close()
+            self.result_stream = None
+        elif not self.binary:
+            with open(os.path.join(self.result_subfolder, "result.json"), "w") as f:
+                json.dump(self.results, f, indent=2)
+                self.results = []
+
+        if self.backup_file is not None:
+            self.backup_file.close()
+            self.backup_file = None
 
         if len(self.trace) != 0:
             raise RuntimeError("Closed file without exiting traces")
-                
-
-        
-      
@@ -0,0 +1,144 @@
+"""
+Benchmark of the DataSaver backup log writers: log entries per second and event loop stalls,
+and with --micro the log_entry calls per second of each output format
+
+Usage: python -m code.utils.data_saver_bench [--entries N] [--dir PATH] [--micro]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from . import settings
+from .data_saver import DataSaver
+
+#(writer, durability)
+CONFIGS: List[Tuple[str, str]] = [
+    ("sync", "flush"),
+    ("sync", "fsync"),
+    ("thread", "flush"),
+    ("thread", "fsync"),
+    ("thread", "none"),
+]
+
+#(log format, stream result.json) for --micro
+MICRO_CONFIGS: List[Tuple[str, bool]] = [
+    ("json", False),
+    ("json", True),
+    ("binary", False),
+]
+
+#Entries between trace boundaries, roughly one V2G message exchange
+ENTRIES_PER_TRACE = 20
+
+#Interval of the loop lag probe
+PROBE_INTERVAL = 0.001
+
+async def probe_loop(stalls: List[float], stop: asyncio.Event):
+    """Records how late each wake up is"""
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        stalls.append(max(0.0, time.perf_counter() - t - PROBE_INTERVAL))
+
+async def produce(logger: DataSaver, entries: int):
+    data = {"msg": "CurrentDemandReq", "values": list(range(16)), "text": "x" * 200}
+    with logger.trace_enter("BENCH"):
+        for i in range(entries):
+            if i % ENTRIES_PER_TRACE == 0:
+                ctx = logger.trace_enter("STEP")
+            logger.log_entry("BENCH", data)
+            if i % ENTRIES_PER_TRACE == ENTRIES_PER_TRACE - 1 or i == entries - 1:
+                logger.trace_leave(ctx)
+                #Let the probe run, like the controller awaiting the next message
+                await asyncio.sleep(0)
+
+async def run_config(folder: str, writer: str, durability: str, entries: int) -> Dict[str, float]:
+    settings.BACKUP_WRITER = writer
+    settings.BACKUP_DURABILITY = durability
+
+    logger = DataSaver(os.path.join(folder, f"bench_{writer}_{durability}"))
+    stalls: List[float] = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_loop(stalls, stop))
+    await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    file_ctx = logger.trace_file_start("run")
+    await produce(logger, entries)
+    loop_time = time.perf_counter() - start
+    stop.set()
+    await probe
+
+    #Includes draining the queue, and writing result.json which is not part of the stall measurement
+    file_ctx.__exit__(None, None, None)
+    total_time = time.perf_counter() - start
+
+    stalls.sort()
+    return {
+        "entries_per_s": entries / loop_time,
+        "entries_per_s_drained": entries / total_time,
+        "stall_max_ms": 1000 * stalls[-1] if len(stalls) else 0.0,
+        "stall_p99_ms": 1000 * stalls[int(len(stalls) * 0.99)] if len(stalls) else 0.0,
+        "stall_total_ms": 1000 * sum(stalls),
+    }
+
+def run_micro(folder: str, log_format: str, stream: bool, entries: int) -> float:
+    """log_entry calls per second, without waiting for the writer thread"""
+    settings.BACKUP_WRITER = "thread"
+    settings.BACKUP_DURABILITY = "none"
+    settings.LOG_FORMAT = log_format
+    settings.RESULT_STREAM = stream
+
+    logger = DataSaver(os.path.join(folder, f"micro_{log_format}_{stream}"))
+    data = {"msg": "CurrentDemandReq", "values": list(range(16))}
+    with logger.trace_file_start("run"):
+        with logger.trace_enter("BENCH"):
+            with logger.trace_enter("STEP"):
+                start = time.perf_counter()
+                for _ in range(entries):
+                    logger.log_entry("BENCH", data)
+                res = entries / (time.perf_counter() - start)
+    return res
+
+def main_micro(entries: int, folder: str):
+    print(f"{'format':8} {'stream':6} {'log_entry/s':>12}")
+    for log_format, stream in MICRO_CONFIGS:
+        res = run_micro(folder, log_format, stream, entries)
+        print(f"{log_format:8} {str(stream):6} {res:12.0f}")
+
+async def main_async(entries: int, folder: str):
+    print(f"{'writer':8} {'durability':10} {'entries/s':>10} {'drained/s':>10} {'stall max':>10} {'stall p99':>10} {'stall sum':>10}")
+    for writer, durability in CONFIGS:
+        res = await run_config(folder, writer, durability, entries)
+        print(f"{writer:8} {durability:10} {res['entries_per_s']:10.0f} {res['entries_per_s_drained']:10.0f} "
+              f"{res['stall_max_ms']:8.2f}ms {res['stall_p99_ms']:8.2f}ms {res['stall_total_ms']:8.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='DataSaver benchmark'
+    )
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--dir', default=None, help="Folder on the storage to test, e.g. the results SD card")
+    parser.add_argument('--micro', action='store_true', help="Only measure log_entry calls per second")
+    args = parser.parse_args()
+
+    def run(folder: str):
+        if args.micro:
+            main_micro(args.entries, folder)
+        else:
+            asyncio.run(main_async(args.entries, folder))
+
+    if args.dir is not None:
+        run(args.dir)
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        run(folder)
+
+if __name__ == "__main__":
+    main()
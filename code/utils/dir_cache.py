@@ -0,0 +1,198 @@
+"""
+Cached directory listings for the results browser, rescanned only when the directory mtime changes,
+with sort orders computed once per scan and directory sizes summed in the background
+"""
+
+from __future__ import annotations
+
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, OrderedDict, Set, Tuple
+
+from . import settings
+
+SORT_KEYS = ["name", "time", "size"]
+
+class ListingEntry(NamedTuple):
+    name: str
+    path: str
+    isdir: bool
+    #File size, or total size of a directory tree (None until computed)
+    size: int | None
+    mtime_ns: int
+
+class TreeSize(NamedTuple):
+    mtime_ns: int
+    #Sizes of the files directly in the directory, valid while mtime_ns is unchanged
+    own: int
+    subdirs: List[str]
+    total: int
+    computed: float
+
+class Listing():
+    path: str
+    mtime_ns: int
+    scanned: float
+    entries: List[ListingEntry]
+    #Entry indices per sort key, size order is redone when directory sizes change
+    orders: Dict[str, List[int]]
+    size_version: int
+
+    def __init__(self, path: str, mtime_ns: int, entries: List[ListingEntry]):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.scanned = time.time()
+        self.entries = entries
+        self.orders = {}
+        self.size_version = -1
+
+def is_active(mtime_ns: int) -> bool:
+    """Recently changed directories are likely sessions still being written, their file sizes change without a mtime change"""
+    return time.time() - mtime_ns / 1e9 < settings.LISTING_ACTIVE_TIME
+
+def scan(path: str) -> List[ListingEntry]:
+    entries = []
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                isdir = e.is_dir()
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append(ListingEntry(e.name, e.path, isdir, None if isdir else st.st_size, st.st_mtime_ns))
+    return entries
+
+class DirCache():
+    listings: OrderedDict[str, Listing]
+    sizes: Dict[str, TreeSize]
+    #Bumped whenever a directory size is computed
+    size_version: int
+    pending: Set[str]
+    lock: threading.Lock
+    size_pool: ThreadPoolExecutor
+
+    def __init__(self):
+        self.listings = collections.OrderedDict()
+        self.sizes = {}
+        self.size_version = 0
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.size_pool = ThreadPoolExecutor(max_workers=1)
+
+    def listing(self, path: str) -> Listing:
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            cached = self.listings.get(path, None)
+            if cached is not None and cached.mtime_ns == mtime_ns and not (is_active(mtime_ns) and time.time() - cached.scanned > settings.LISTING_ACTIVE_TTL):
+                self.listings.move_to_end(path)
+                return cached
+
+        listing = Listing(path, mtime_ns, scan(path))
+        with self.lock:
+            self.listings[path] = listing
+            self.listings.move_to_end(path)
+            while len(self.listings) > settings.LISTING_CACHE_SIZE:
+                self.listings.popitem(last=False)
+        return listing
+
+    def dir_size(self, entry: ListingEntry) -> int | None:
+        cached = self.sizes.get(entry.path, None)
+        if cached is None:
+            return None
+        return cached.total
+
+    def order(self, listing: Listing, sort: str) -> List[int]:
+        with self.lock:
+            if sort == "size" and listing.size_version != self.size_version:
+                listing.orders.pop("size", None)
+            if sort in listing.orders:
+                return listing.orders[sort]
+
+        if sort == "time":
+            order = sorted(range(len(listing.entries)), key=lambda i: listing.entries[i].mtime_ns)
+        elif sort == "size":
+            size_version = self.size_version
+            sizes = [self.dir_size(e) if e.isdir else e.size for e in listing.entries]
+            order = sorted(range(len(listing.entries)), key=lambda i: -1 if sizes[i] is None else sizes[i])
+            listing.size_version = size_version
+        else:
+            order = sorted(range(len(listing.entries)), key=lambda i: listing.entries[i].name)
+        with self.lock:
+            listing.orders[sort] = order
+        return order
+
+    def page(self, path: str, sort: str = "name", reverse: bool = False, offset: int = 0, limit: int | None = None) -> Tuple[List[ListingEntry], int]:
+        """One page of a directory listing and the total number of entries"""
+        if sort not in SORT_KEYS:
+            sort = "name"
+        if limit is None:
+            limit = settings.LISTING_PAGE_SIZE
+        listing = self.listing(path)
+        order = self.order(listing, sort)
+        n = len(order)
+        if reverse:
+            indices = [order[n - 1 - i] for i in range(offset, min(n, offset + limit))]
+        else:
+            indices = order[offset:offset + limit]
+
+        res = []
+        stale = []
+        for i in indices:
+            e = listing.entries[i]
+            if e.isdir:
+                cached = self.sizes.get(e.path, None)
+                if cached is None or time.time() - cached.computed > settings.LISTING_SIZE_TTL:
+                    stale.append(e.path)
+                e = e._replace(size=None if cached is None else cached.total)
+            res.append(e)
+        if sort == "size":
+            #Sizes of the whole listing are needed for the order, not just of this page
+            stale = [e.path for e in listing.entries if e.isdir and e.path not in self.sizes]
+        self.schedule_sizes(stale)
+        return res, n
+
+    def schedule_sizes(self, paths: List[str]):
+        with self.lock:
+            paths = [p for p in paths if p not in self.pending]
+            self.pending.update(paths)
+        for p in paths:
+            self.size_pool.submit(self.update_size, p)
+
+    def update_size(self, path: str):
+        try:
+            self.tree_size(path)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.pending.discard(path)
+
+    def tree_size(self, path: str) -> int:
+        """Total size below a directory, directories unchanged since the last call are not listed again"""
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self.sizes.get(path, None)
+        if cached is not None and cached.mtime_ns == mtime_ns and not is_active(mtime_ns):
+            own = cached.own
+            subdirs = cached.subdirs
+        else:
+            own = 0
+            subdirs = []
+            for e in scan(path):
+                if e.isdir:
+                    subdirs.append(e.path)
+                else:
+                    own += e.size or 0
+        total = own
+        for sub in subdirs:
+            try:
+                total += self.tree_size(sub)
+            except OSError:
+                pass
+        if cached is None or cached.total != total:
+            with self.lock:
+                self.size_version += 1
+        self.sizes[path] = TreeSize(mtime_ns, own, subdirs, total, time.time())
+        return total
@@ -0,0 +1,240 @@
+"""
+Opt-in monitor of the asyncio loop: a heartbeat measures how late the loop gets to run callbacks,
+and while it is stalled a watchdog thread samples the stack of the loop thread so that stalls can be put down to a subsystem
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Any, Callable, Counter, Dict, List, NamedTuple, Tuple
+
+from . import metrics, settings
+
+#Folder of the code package, frames below it are attributed by their module path
+CODE_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+
+#(module path below code/, subsystem), first match wins
+SUBSYSTEMS = [
+    ("interface/bs_measure", "cp"),
+    ("interface/hal", "cp"),
+    ("interface/adc_cal", "cp"),
+    ("interface/slac", "slac"),
+    ("interface/plctools", "slac"),
+    ("interface/sdp", "sdp"),
+    ("interface/socket_wrapper", "socket"),
+    ("interface/connection_tls", "socket"),
+    ("interface/trusted_ca_keys", "socket"),
+    ("interface/connection_ev", "v2g"),
+    ("v2g/", "v2g"),
+    ("utils/data_saver", "datasaver"),
+    ("utils/backup_writer", "datasaver"),
+    ("utils/binlog", "datasaver"),
+    ("utils/result_writer", "datasaver"),
+    ("network/", "ui"),
+    ("experiment/", "task"),
+    ("pcap_", "pcap"),
+    ("controller", "controller"),
+]
+
+#Frames of a sample kept, innermost last
+STACK_DEPTH = 12
+
+class LoopStall(NamedTuple):
+    #time.time() when the loop got going again
+    end: float
+    lag: float
+    subsystem: str
+    #Samples per subsystem taken during the stall
+    samples: Dict[str, int]
+    stack: List[str]
+
+    def to_json(self):
+        return self._asdict()
+
+class SubsystemStats():
+    stalls: int
+    total: float
+    max: float
+    samples: int
+    stacks: Counter[Tuple[str, ...]]
+
+    def __init__(self):
+        self.stalls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = 0
+        self.stacks = collections.Counter()
+
+    def to_json(self):
+        return {
+            "stalls": self.stalls,
+            "total": self.total,
+            "max": self.max,
+            "samples": self.samples,
+            "stacks": [{"count": n, "stack": list(s)} for s, n in self.stacks.most_common(settings.LOOP_MONITOR_STACKS)],
+        }
+
+def library_name(filename: str) -> str:
+    parts = filename.replace(os.sep, "/").split("/")
+    if "site-packages" in parts:
+        return parts[parts.index("site-packages") + 1].split(".")[0]
+    if len(parts) >= 2 and parts[-2] not in ("", "lib") and not parts[-2].startswith("python"):
+        return parts[-2]
+    return os.path.splitext(parts[-1])[0]
+
+def short_path(filename: str) -> str:
+    if filename.startswith(CODE_ROOT):
+        return filename[len(CODE_ROOT):]
+    return "/".join(filename.replace(os.sep, "/").split("/")[-2:])
+
+def attribute(frame: FrameType) -> Tuple[str, Tuple[str, ...]]:
+    """Subsystem of the innermost frame in our code (a library called from it counts for it), and the stack"""
+    stack = traceback.extract_stack(frame)
+    #Only the callback the loop is running, not the loop machinery above it
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i].name == "_run" and stack[i].filename.endswith(os.path.join("asyncio", "events.py")):
+            stack = stack[i + 1:]
+            break
+    lines = tuple(f"{short_path(f.filename)}:{f.lineno} {f.name}" for f in stack[-STACK_DEPTH:])
+    for f in reversed(stack):
+        if not f.filename.startswith(CODE_ROOT):
+            continue
+        rel = f.filename[len(CODE_ROOT):].replace(os.sep, "/")
+        if rel.startswith("utils/loop_monitor"):
+            continue
+        for prefix, name in SUBSYSTEMS:
+            if rel.startswith(prefix):
+                return name, lines
+        return "other", lines
+    return library_name(stack[-1].filename) if len(stack) else "unknown", lines
+
+class LoopMonitor():
+    interval: float
+    threshold: float
+    #monotonic time the next heartbeat is due, written on the loop and read by the watchdog
+    expected: float
+    loop_thread: int
+    lock: threading.Lock
+    #(subsystem, stack) taken since the last heartbeat
+    samples: List[Tuple[str, Tuple[str, ...]]]
+    stopped: threading.Event
+    task: asyncio.Future | None
+    thread: threading.Thread | None
+
+    #Since the last reset
+    beats: int
+    lag_total: float
+    lag_max: float
+    subsystems: Dict[str, SubsystemStats]
+
+    stall_listeners: List[Callable[[LoopStall], Any]]
+
+    def __init__(self, interval: float | None = None, threshold: float | None = None):
+        self.interval = interval if interval is not None else settings.LOOP_MONITOR_INTERVAL
+        self.threshold = threshold if threshold is not None else settings.LOOP_MONITOR_THRESHOLD
+        self.expected = time.monotonic() + self.interval
+        self.loop_thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.samples = []
+        self.stopped = threading.Event()
+        self.task = None
+        self.thread = None
+        self.stall_listeners = []
+        self.reset()
+
+    def reset(self):
+        self.beats = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.subsystems = {}
+
+    def start(self):
+        """Needs the running loop, its thread is the one sampled"""
+        self.loop_thread = threading.get_ident()
+        self.expected = time.monotonic() + self.interval
+        self.stopped.clear()
+        self.task = asyncio.ensure_future(self.run_heartbeat())
+        self.thread = threading.Thread(target=self.run_watchdog, name="loop_monitor", daemon=True)
+        self.thread.start()
+        print(f"Loop monitor on, heartbeat {self.interval}s, stalls over {self.threshold}s")
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run_heartbeat(self):
+        while True:
+            self.expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self.expected)
+            with self.lock:
+                samples = self.samples
+                self.samples = []
+            self.beats += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            metrics.LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.threshold:
+                self.on_stall(lag, samples)
+
+    def run_watchdog(self):
+        while not self.stopped.wait(settings.LOOP_MONITOR_SAMPLE_INTERVAL):
+            if time.monotonic() - self.expected < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread, None)
+            if frame is None:
+                continue
+            try:
+                sample = attribute(frame)
+            finally:
+                del frame
+            with self.lock:
+                self.samples.append(sample)
+
+    def on_stall(self, lag: float, samples: List[Tuple[str, Tuple[str, ...]]]):
+        per_subsystem: Counter[str] = collections.Counter(s for s, _ in samples)
+        if len(samples):
+            subsystem = per_subsystem.most_common(1)[0][0]
+            stack = collections.Counter(st for s, st in samples if s == subsystem).most_common(1)[0][0]
+        else:
+            #Over before the watchdog looked
+            subsystem = "unknown"
+            stack = ()
+
+        for s, st in samples:
+            stats = self.subsystems.setdefault(s, SubsystemStats())
+            stats.samples += 1
+            stats.stacks[st] += 1
+        stats = self.subsystems.setdefault(subsystem, SubsystemStats())
+        stats.stalls += 1
+        stats.total += lag
+        stats.max = max(stats.max, lag)
+        metrics.LOOP_STALLS.inc(subsystem=subsystem)
+
+        stall = LoopStall(time.time(), lag, subsystem, dict(per_subsystem), list(stack))
+        print(f"Loop stalled {lag * 1000:.0f}ms in {subsystem}: {stack[-1] if len(stack) else '?'}")
+        for listener in self.stall_listeners:
+            listener(stall)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "beats": self.beats,
+            "lag_mean": self.lag_total / self.beats if self.beats else 0.0,
+            "lag_max": self.lag_max,
+            "stalls": sum(s.stalls for s in self.subsystems.values()),
+            "subsystems": {
+                name: stats.to_json()
+                for name, stats in sorted(self.subsystems.items(), key=lambda i: -i[1].total)
+            },
+        }
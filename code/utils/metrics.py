@@ -0,0 +1,242 @@
+"""
+In-process metrics (counters, gauges and histograms) served in the Prometheus text exposition format,
+so that runs on different firmware and deployments can be compared
+"""
+
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+import asyncio
+import bisect
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+#Seconds, from a fast EXI encode up to a slow TLS handshake
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+def format_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    if math.isnan(v):
+        return "NaN"
+    if v == int(v) and abs(v) < 1e15:
+        return str(int(v))
+    return repr(float(v))
+
+def escape_label(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    parts = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    if len(parts) == 0:
+        return ""
+    return "{" + ",".join(parts) + "}"
+
+class Metric(ABC):
+    name: str
+    help: str
+    type: str
+    label_names: Tuple[str, ...]
+    #Samples are updated from the CP measurement thread and the executor as well as the loop
+    lock: threading.Lock
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    @abstractmethod
+    def render_samples(self) -> List[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.render_samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+    values: Dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self.values = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render_samples(self) -> List[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.label_names, k)} {format_value(v)}" for k, v in items]
+
+class Gauge(Metric):
+    type = "gauge"
+    values: Dict[LabelValues, float]
+    #Called on every scrape, for values that are cheaper to read than to track (queue depths, client counts)
+    functions: List[Callable[[], Dict[LabelValues, float]]]
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self.values = {}
+        self.functions = []
+
+    def set(self, value: float, **labels: str):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def add_function(self, fn: Callable[[], Dict[LabelValues, float]]):
+        self.functions.append(fn)
+
+    def remove_function(self, fn: Callable[[], Dict[LabelValues, float]]):
+        if fn in self.functions:
+            self.functions.remove(fn)
+
+    def render_samples(self) -> List[str]:
+        with self.lock:
+            values = dict(self.values)
+        for fn in list(self.functions):
+            try:
+                values.update(fn())
+            except Exception as e:
+                print(f"Metric {self.name} not available: {type(e).__name__}: {e}")
+        return [f"{self.name}{format_labels(self.label_names, k)} {format_value(v)}" for k, v in sorted(values.items())]
+
+class HistogramTimer():
+    histogram: Histogram
+    labels: Dict[str, str]
+    start: float
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: Tuple[float, ...]
+    #Per label set: (count per bucket, not cumulative, last one is +Inf), sum, count
+    values: Dict[LabelValues, Tuple[List[int], float, int]]
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total, count = self.values.get(key, None) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def time(self, **labels: str) -> HistogramTimer:
+        """Context manager observing the time spent inside, awaits included"""
+        return HistogramTimer(self, labels)
+
+    def render_samples(self) -> List[str]:
+        with self.lock:
+            items = sorted((k, (list(c), s, n)) for k, (c, s, n) in self.values.items())
+        lines = []
+        for k, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (math.inf,), counts):
+                cumulative += c
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, k, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, k)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, k)} {count}")
+        return lines
+
+REGISTRY: List[Metric] = []
+
+def render() -> str:
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+#EV side
+EXI_SECONDS = Histogram("exi_codec_seconds", "EXI encode/decode latency including the codec round trip", ("schema", "op"))
+EXI_ERRORS = Counter("exi_codec_errors_total", "EXI encode/decode failures", ("schema", "op"))
+SOCKET_BYTES = Counter("socket_bytes_total", "Bytes on V2G sockets", ("transport", "direction"))
+SOCKET_FRAMES = Counter("socket_frames_total", "V2GTP frames on V2G sockets", ("transport", "direction"))
+TLS_HANDSHAKE_SECONDS = Histogram("tls_handshake_seconds", "TLS client handshake duration", ("result",))
+SDP_REQUESTS = Counter("sdp_requests_total", "SDP requests sent, including retries", ("security",))
+SDP_RETRIES = Counter("sdp_retries_total", "SDP requests without a response in time", ("security",))
+SDP_FAILURES = Counter("sdp_failures_total", "SDP discoveries that ran out of retries", ("security",))
+SLAC_PHASE_SECONDS = Histogram("slac_phase_seconds", "Time spent in each SLAC phase", ("phase",),
+                               buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+CP_SAMPLES = Counter("cp_samples_total", "CP measurements taken")
+CP_SAMPLE_RATE = Gauge("cp_sample_rate", "CP measurements per second over the last second")
+DATASAVER_QUEUE_DEPTH = Gauge("datasaver_queue_depth", "Chunks waiting for the backup writer", ("stat",))
+TASK_RESULTS = Counter("task_results_total", "Finished tasks by final state", ("task", "result"))
+LOOP_LAG_SECONDS = Histogram("loop_lag_seconds", "How late the asyncio loop ran the monitor heartbeat (only with the loop monitor on)")
+LOOP_STALLS = Counter("loop_stalls_total", "Loop stalls over the monitor threshold by the subsystem that held the loop", ("subsystem",))
+
+#Both sides
+WS_CLIENTS = Gauge("ws_clients", "Connected websocket clients", ("server",))
+WS_SEND_SECONDS = Histogram("ws_send_seconds", "Time to hand one message to a websocket client", ("server",))
+WS_DROPPED = Counter("ws_dropped_total", "Websocket messages dropped or coalesced for slow clients", ("server", "reason"))
+
+#Harness side
+FORWARD_MESSAGES = Counter("forward_messages_total", "Messages forwarded between UI clients and an EV process", ("device", "direction"))
+FORWARD_BYTES = Counter("forward_bytes_total", "Bytes forwarded between UI clients and an EV process", ("device", "direction"))
+EV_PROCESS_RUNNING = Gauge("ev_process_running", "Whether the EV process of a device is running", ("device",))
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+            #Callbacks read state owned by the loop, so rendering stays on it (it is a few kB)
+            body = render().encode("utf-8")
+            head = "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        else:
+            body = b"Not found\n"
+            head = "HTTP/1.0 404 Not Found\r\nContent-Type: text/plain\r\n"
+        writer.write(f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(port: int | None, host: str) -> asyncio.AbstractServer | None:
+    """Start the /metrics endpoint on the running loop, None as port disables it"""
+    if port is None:
+        return None
+    try:
+        server = await asyncio.start_server(handle_client, host, port)
+    except OSError as e:
+        print(f"Metrics not served on {host}:{port}: {e}")
+        return None
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
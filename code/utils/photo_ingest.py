@@ -0,0 +1,193 @@
+"""
+Photo uploads: written to disk as they arrive while hashed, duplicates dropped,
+thumbnails made by a worker pool and each photo linked into the session that was running
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, BinaryIO, Dict, List, NamedTuple, Tuple
+
+from PIL import Image, ImageOps
+
+from . import settings
+from .async_utils import blocking_to_async
+
+THUMBS_FOLDER = "thumbs"
+INDEX_FILE = "index.jsonl"
+#Folder inside a session the photos are hard linked to
+SESSION_PHOTOS_FOLDER = "photos"
+
+class PhotoRecord(NamedTuple):
+    hash: str
+    #File name in the photos folder
+    file: str
+    size: int
+    uploaded: str
+    #Session folders (relative to the results folder) the photo is linked to
+    sessions: List[str]
+    name: str
+    box: str
+    plug: str
+
+def thumb_name(file: str) -> str:
+    return os.path.splitext(file)[0] + ".jpg"
+
+def make_thumbnail(src: str, dst: str, size: int) -> bool:
+    """Runs in the worker pool"""
+    try:
+        with Image.open(src) as img:
+            #JPEGs are decoded at a reduced scale right away
+            img.draft("RGB", (size, size))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size))
+            tmp = dst + ".tmp"
+            img.convert("RGB").save(tmp, "JPEG", quality=80)
+        os.replace(tmp, dst)
+        return True
+    except (OSError, ValueError) as e:
+        print(f"No thumbnail for {src}: {type(e).__name__}: {e}")
+        return False
+
+class PhotoIngest():
+    folder: str
+    results_base: str
+    #Latest record per content hash
+    records: Dict[str, PhotoRecord]
+    pool: ProcessPoolExecutor | None
+    thumb_tasks: Dict[str, asyncio.Future]
+    #Held from the duplicate check until the record is stored, so that the same photo uploaded twice at once is kept once
+    lock: asyncio.Lock
+
+    def __init__(self, folder: str, results_base: str):
+        self.folder = folder
+        self.results_base = results_base
+        self.records = {}
+        self.pool = None
+        self.thumb_tasks = {}
+        self.lock = asyncio.Lock()
+
+        os.makedirs(os.path.join(self.folder, THUMBS_FOLDER), exist_ok=True)
+        index = os.path.join(self.folder, INDEX_FILE)
+        if os.path.isfile(index):
+            with open(index) as f:
+                for line in f:
+                    try:
+                        record = PhotoRecord(**json.loads(line))
+                    except (ValueError, TypeError):
+                        #Cut off by a power loss
+                        continue
+                    self.records[record.hash] = record
+
+    def start(self):
+        """Queue the thumbnails missing after a restart, needs the running loop"""
+        for record in self.records.values():
+            self.queue_thumbnail(record)
+
+    def write_record(self, record: PhotoRecord):
+        """Runs in the executor, records is updated on the loop"""
+        with open(os.path.join(self.folder, INDEX_FILE), "a") as f:
+            f.write(json.dumps(record._asdict()) + "\n")
+
+    def queue_thumbnail(self, record: PhotoRecord):
+        dst = os.path.join(self.folder, THUMBS_FOLDER, thumb_name(record.file))
+        if os.path.isfile(dst) or record.hash in self.thumb_tasks:
+            return
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=settings.PHOTO_WORKERS)
+        task = asyncio.get_running_loop().run_in_executor(
+            self.pool, make_thumbnail, os.path.join(self.folder, record.file), dst, settings.PHOTO_THUMB_SIZE
+        )
+        self.thumb_tasks[record.hash] = task
+        task.add_done_callback(lambda _: self.thumb_tasks.pop(record.hash, None))
+
+    def link_session(self, record: PhotoRecord, session: str) -> PhotoRecord:
+        """Hard link the photo into the session folder, so that it is listed and exported with it"""
+        if session in record.sessions:
+            return record
+        session_photos = os.path.join(self.results_base, session, SESSION_PHOTOS_FOLDER)
+        try:
+            os.makedirs(session_photos, exist_ok=True)
+            os.link(os.path.join(self.folder, record.file), os.path.join(session_photos, record.file))
+        except FileExistsError:
+            pass
+        except OSError as e:
+            print(f"Could not link {record.file} to {session}: {e}")
+            return record
+        return record._replace(sessions=record.sessions + [session])
+
+    @staticmethod
+    def write_chunk(f: BinaryIO, h: Any, chunk: bytes):
+        #Both release the GIL for chunks of a useful size
+        h.update(chunk)
+        f.write(chunk)
+
+    @staticmethod
+    def remove_tmp(tmp: str):
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+    def store(self, tmp: str, digest: str, size: int, ext: str, sessions: List[str], info: Tuple[str, str, str], known: PhotoRecord | None) -> Tuple[PhotoRecord, bool, bool]:
+        """Runs in the executor: keeps or drops the upload and links it, returns its record, whether it was a duplicate and whether the record changed"""
+        if known is not None and os.path.isfile(os.path.join(self.folder, known.file)):
+            os.remove(tmp)
+            linked = known
+            for session in sessions:
+                linked = self.link_session(linked, session)
+            if linked is not known:
+                self.write_record(linked)
+            return linked, True, linked is not known
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        file = f"{now.strftime('%Y_%m_%d_%H_%M_%S')}_{digest[:12]}{ext}"
+        os.replace(tmp, os.path.join(self.folder, file))
+        record = PhotoRecord(digest, file, size, now.isoformat(), [], *info)
+        for session in sessions:
+            record = self.link_session(record, session)
+        self.write_record(record)
+        return record, False, True
+
+    async def ingest(self, chunks: AsyncIterator[bytes], filename: str, sessions: List[str], info: Tuple[str, str, str]) -> Tuple[PhotoRecord, bool]:
+        """Store an upload, returns its record and whether it was a duplicate"""
+        ext = os.path.splitext(os.path.basename(filename))[1].lower()
+        if not ext[1:].isalnum() or len(ext) > 6:
+            ext = ""
+        tmp = os.path.join(self.folder, f".upload_{secrets.token_hex(8)}.tmp")
+        h = hashlib.sha256()
+        size = 0
+        #File work runs in the executor, a slow disk must not hold up the loop that also serves the UI
+        try:
+            f = await blocking_to_async(open)(tmp, "wb")
+            try:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > settings.PHOTO_MAX_BYTES:
+                        raise ValueError(f"Upload larger than {settings.PHOTO_MAX_BYTES} bytes")
+                    await blocking_to_async(self.write_chunk)(f, h, chunk)
+            finally:
+                await blocking_to_async(f.close)()
+        except BaseException:
+            await asyncio.shield(blocking_to_async(self.remove_tmp)(tmp))
+            raise
+
+        digest = h.hexdigest()
+        async with self.lock:
+            record, duplicate, changed = await blocking_to_async(self.store)(
+                tmp, digest, size, ext, sessions, info, self.records.get(digest, None)
+            )
+            if changed:
+                self.records[record.hash] = record
+        if not duplicate:
+            self.queue_thumbnail(record)
+        return record, duplicate
+
+    def page(self, offset: int, limit: int) -> Tuple[List[PhotoRecord], int]:
+        """Newest first"""
+        records = sorted(self.records.values(), key=lambda r: r.uploaded, reverse=True)
+        return records[offset:offset + limit], len(records)
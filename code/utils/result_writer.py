@@ -0,0 +1,113 @@
+"""
+Streaming writer for result.json: writes the trace tree as traces open and close,
+in the same format as json.dump(indent=2) of the in-memory tree apart from whitespace
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, List
+
+INDENT = "  "
+
+#Room reserved for the end time of a trace, patched in when the trace is left
+END_TIME_WIDTH = 32
+
+def dumps_at(value: Any, level: int) -> str:
+    """json.dumps(indent=2) of a value that starts at the given nesting level"""
+    return json.dumps(value, indent=2).replace("\n", "\n" + INDENT * level)
+
+class OpenTrace():
+    #Nesting level of the trace object
+    level: int
+    #File offset of the end_time placeholder
+    end_time_offset: int
+    children: int
+
+    def __init__(self, level: int, end_time_offset: int):
+        self.level = level
+        self.end_time_offset = end_time_offset
+        self.children = 0
+
+class ResultStreamWriter():
+    """Only keeps the stack of open traces in memory"""
+    path: str
+    stack: List[OpenTrace]
+    written_root: bool
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.stack = []
+        self.written_root = False
+
+    def write(self, s: str):
+        self.file.write(s.encode("ascii"))
+
+    def start_child(self) -> int:
+        """Writes the separator before a new node, returns its nesting level"""
+        if len(self.stack) == 0:
+            #Like the in-memory tree, a new top level trace replaces the previous one
+            self.file.seek(0)
+            self.file.truncate()
+            self.written_root = True
+            return 0
+        parent = self.stack[-1]
+        level = parent.level + 2
+        self.write(("," if parent.children else "") + "\n" + INDENT * level)
+        parent.children += 1
+        return level
+
+    def trace_enter(self, trace: List[str], start_time: str):
+        level = self.start_child()
+        inner = INDENT * (level + 1)
+        self.write(
+            "{\n" +
+            inner + '"version": 1,\n' +
+            inner + '"type": "TRACE",\n' +
+            inner + '"trace": ' + dumps_at(trace, level + 1) + ",\n" +
+            inner + '"start_time": ' + dumps_at(start_time, level + 1) + ",\n" +
+            inner + '"end_time": '
+        )
+        offset = self.file.tell()
+        self.write("null".ljust(END_TIME_WIDTH) + ",\n" + inner + '"data": [')
+        self.stack.append(OpenTrace(level, offset))
+
+    def log_entry(self, trace: List[str], time_str: str, data_type: str, data: Any):
+        if len(self.stack) == 0:
+            raise Exception("Logging stack error")
+        level = self.start_child()
+        self.write(dumps_at({
+            "version": 1,
+            "type": "ENTRY",
+            "trace": trace,
+
+            "time": time_str,
+            "data_type": data_type,
+            "data": data
+        }, level))
+
+    def trace_leave(self, end_time: str | None):
+        it = self.stack.pop()
+        if it.children:
+            self.write("\n" + INDENT * (it.level + 1) + "]")
+        else:
+            self.write("]")
+        self.write("\n" + INDENT * it.level + "}")
+
+        if end_time is not None:
+            value = json.dumps(end_time)
+            if len(value) > END_TIME_WIDTH:
+                raise ValueError(f"End time too long: {value}")
+            end = self.file.tell()
+            self.file.seek(it.end_time_offset)
+            self.write(value.ljust(END_TIME_WIDTH))
+            self.file.seek(end)
+
+    def close(self):
+        #Left open traces keep a null end time, like in the in-memory tree
+        while len(self.stack):
+            self.trace_leave(None)
+        if not self.written_root:
+            self.write("null")
+        self.file.close()
@@ -2,6 +2,56 @@
 SKIP_BASIC = False #Disable basic signaling
 SKIP_SLAC = False #Disable SLAC
 SKIP_PCAP = False #Disable pcap
+PCAP_BACKEND = "ring" #"ring": in-process AF_PACKET capture (pcapng), "tcpdump": tcpdump subprocess (pcap)
+PCAP_PROFILE = "all" #Capture profile from pcap_filter.PROFILES: "all", "slac_v2g", "slac"
+PCAP_ROTATE_BYTES = None #Start a new capture segment after this many bytes (None: no size rotation)
+PCAP_ROTATE_SECONDS = None #Start a new capture segment after this many seconds (None: no time rotation)
+PCAP_COMPRESS = False #Gzip closed capture segments in the background
+SLAC_SIM_PROFILE = None #Profile file for simulated SLAC timings when SKIP_SLAC is set (None: no simulation)
+
+# Session log
+BACKUP_WRITER = "thread" #"thread": batched background writer, "sync": write and flush on the calling thread
+BACKUP_DURABILITY = "flush" #"flush": flush to the OS, "fsync": flush and fsync, "none": only flushed when closed
+BACKUP_FLUSH_SECONDS = 0.5 #Flush when the oldest unflushed line is this old
+BACKUP_FLUSH_BYTES = 64 * 1024 #Flush when this many bytes are unflushed
+BACKUP_QUEUE_SIZE = 4096 #Lines queued before log_entry blocks
+RESULT_STREAM = False #Write result.json while the session runs instead of keeping the tree in memory
+LOG_FORMAT = "json" #"json": backup.bak.txt and result.json, "binary": log.bin with offset index (python -m code.analysis.binlog_convert for JSON)
+LOG_COMPRESS = False #Compress large payloads in the binary log
+
+# Harness
+EV_DEVICES = [("eth0", 8082)] #(PLC interface, websocket port) of each EV process the harness runs side by side, e.g. [("eth0", 8082), ("eth1", 8083)]
+PROCESS_OUTPUT_LINES = 200 #Output lines of the EV process kept for clients that connect later
+PROCESS_LINE_LIMIT = 1024 * 1024 #Longest output line of the EV process forwarded in full
+LISTING_CACHE_SIZE = 256 #Directory listings of the results browser kept in memory
+LISTING_PAGE_SIZE = 200 #Entries per page of the results browser
+LISTING_ACTIVE_TIME = 60.0 #Directories changed this recently (seconds) are rescanned even without a mtime change
+LISTING_ACTIVE_TTL = 2.0 #Seconds a listing of such a directory is reused
+LISTING_SIZE_TTL = 60.0 #Seconds before a directory size is recomputed in the background
+PHOTO_THUMB_SIZE = 320 #Longest side of photo thumbnails in pixels
+PHOTO_WORKERS = 2 #Processes making photo thumbnails
+PHOTO_SESSION_GRACE = 600.0 #Photos taken up to this many seconds after a session ended are linked to it
+PHOTO_MAX_BYTES = 64 * 1024 * 1024 #Largest accepted photo upload
+
+# UI
+BASIC_UI_RATE = 5.0 #CP level and duty updates per second sent to the UI, state changes are sent at once (None: every sample)
+BASIC_UI_SUMMARY = False #Add min/max/mean of level and duty over the samples since the last update
+FORWARD_QUEUE_SIZE = 64 #Browser messages queued for the EV process
+FORWARD_PUT_TIMEOUT = 1.0 #Seconds a browser message waits for room in that queue before the browser is told forwarding failed
+STATE_HISTORY = 1024 #State revisions kept for clients that resume after a reconnect
+WS_QUEUE_SIZE = 256 #Outbound messages queued per websocket client before dropping or disconnecting
+
+# Metrics
+METRICS_HOST = "127.0.0.1" #Interface the /metrics endpoints listen on
+METRICS_PORT_HARNESS = 9000 #Metrics port of the harness, None disables
+METRICS_PORT_OFFSET = 1000 #EV processes serve metrics on their websocket port plus this (9082 for 8082), None disables
+
+# Loop monitor
+LOOP_MONITOR = False #Measure asyncio loop lag and sample the stack during stalls (main_ev --loop-monitor also turns it on)
+LOOP_MONITOR_INTERVAL = 0.02 #Seconds between heartbeats on the loop
+LOOP_MONITOR_THRESHOLD = 0.05 #Heartbeats this late count as stalls and are sampled
+LOOP_MONITOR_SAMPLE_INTERVAL = 0.01 #Seconds between stack samples of a stalled loop
+LOOP_MONITOR_STACKS = 5 #Most frequent stacks per subsystem in the session summary
 
 WS_PORT_SSL = 8081
 WS_PORT_NSSL = 8082
@@ -0,0 +1,269 @@
+"""
+ZIP archives of a folder streamed in chunks, with a layout fixed before the first byte
+so that any byte range can be produced again (resumed downloads)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import stat
+import struct
+import time
+import zlib
+from typing import Dict, Iterator, List, Tuple
+
+CHUNK_SIZE = 1 << 20
+
+#Entries are stored, captures hardly compress and stored sizes are known up front
+METHOD_STORED = 0
+#Data descriptor after the data (CRC is only known once read), UTF-8 names
+FLAGS = 0x0808
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+SIG_LOCAL = 0x04034b50
+SIG_DESCRIPTOR = 0x08074b50
+SIG_CENTRAL = 0x02014b50
+SIG_ZIP64_END = 0x06064b50
+SIG_ZIP64_LOCATOR = 0x07064b50
+SIG_END = 0x06054b50
+
+#CRCs of files read before, by (path, size, mtime), so that a resumed download does not read everything before its range again
+crc_cache: Dict[Tuple[str, int, int], int] = {}
+CRC_CACHE_MAX = 100000
+
+def dos_time(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def file_crc(path: str, size: int, mtime_ns: int) -> int:
+    key = (path, size, mtime_ns)
+    if key in crc_cache:
+        return crc_cache[key]
+    crc = 0
+    with open(path, "rb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if len(chunk) == 0:
+                raise OSError(f"{path} shrank while exporting")
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+    if len(crc_cache) >= CRC_CACHE_MAX:
+        crc_cache.clear()
+    crc_cache[key] = crc
+    return crc
+
+class ZipEntry():
+    name: bytes
+    path: str
+    size: int
+    mtime_ns: int
+    mode: int
+    #Offset of the local header in the archive
+    offset: int
+    zip64: bool
+    crc: int | None
+
+    def __init__(self, name: str, path: str, st: os.stat_result):
+        self.name = name.encode("utf-8")
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.mode = st.st_mode
+        self.offset = 0
+        self.zip64 = self.size >= ZIP64_LIMIT
+        self.crc = None
+
+    def local_header(self) -> bytes:
+        t, d = dos_time(self.mtime_ns / 1e9)
+        extra = b""
+        size = 0
+        if self.zip64:
+            #Sizes follow in the data descriptor
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            size = ZIP64_LIMIT
+        return struct.pack(
+            "<IHHHHHIIIHH", SIG_LOCAL, 45 if self.zip64 else 20, FLAGS, METHOD_STORED, t, d, 0, size, size, len(self.name), len(extra)
+        ) + self.name + extra
+
+    def local_header_size(self) -> int:
+        return 30 + len(self.name) + (20 if self.zip64 else 0)
+
+    def descriptor(self) -> bytes:
+        if self.zip64:
+            return struct.pack("<IIQQ", SIG_DESCRIPTOR, self.get_crc(), self.size, self.size)
+        return struct.pack("<IIII", SIG_DESCRIPTOR, self.get_crc(), self.size, self.size)
+
+    def descriptor_size(self) -> int:
+        return 24 if self.zip64 else 16
+
+    def central_extra(self) -> bytes:
+        fields = b""
+        if self.zip64:
+            fields += struct.pack("<QQ", self.size, self.size)
+        if self.offset >= ZIP64_LIMIT:
+            fields += struct.pack("<Q", self.offset)
+        if len(fields) == 0:
+            return b""
+        return struct.pack("<HH", 1, len(fields)) + fields
+
+    def central_header(self) -> bytes:
+        t, d = dos_time(self.mtime_ns / 1e9)
+        extra = self.central_extra()
+        version = 45 if len(extra) else 20
+        size = ZIP64_LIMIT if self.zip64 else self.size
+        offset = ZIP64_LIMIT if self.offset >= ZIP64_LIMIT else self.offset
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII", SIG_CENTRAL, (3 << 8) | version, version, FLAGS, METHOD_STORED, t, d,
+            self.get_crc(), size, size, len(self.name), len(extra), 0, 0, 0, (self.mode & 0xFFFF) << 16, offset
+        ) + self.name + extra
+
+    def central_header_size(self) -> int:
+        return 46 + len(self.name) + len(self.central_extra())
+
+    def get_crc(self) -> int:
+        if self.crc is None:
+            self.crc = file_crc(self.path, self.size, self.mtime_ns)
+        return self.crc
+
+    def iter_data(self, start: int, end: int) -> Iterator[bytes]:
+        """Bytes [start, end) of the file, the CRC is computed on the way if the whole file is read"""
+        whole = start == 0 and end == self.size and self.crc is None
+        crc = 0
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if len(chunk) == 0:
+                    raise OSError(f"{self.path} shrank while exporting")
+                if whole:
+                    crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        if whole:
+            self.crc = crc
+            if len(crc_cache) < CRC_CACHE_MAX:
+                crc_cache[(self.path, self.size, self.mtime_ns)] = crc
+
+class ZipStream():
+    """
+    Stored ZIP of every regular file below a folder. Sizes and mtimes are taken once,
+    files that grow afterwards are cut at the size they had (sessions that are still running).
+    """
+    root: str
+    entries: List[ZipEntry]
+    central_offset: int
+    central_size: int
+    size: int
+    etag: str
+
+    def __init__(self, root: str):
+        self.root = root
+        self.entries = []
+        base = os.path.dirname(os.path.normpath(root))
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                self.entries.append(ZipEntry(os.path.relpath(path, base).replace(os.sep, "/"), path, st))
+
+        offset = 0
+        h = hashlib.sha1()
+        for e in self.entries:
+            e.offset = offset
+            offset += e.local_header_size() + e.size + e.descriptor_size()
+            h.update(e.name + struct.pack("<QQ", e.size, e.mtime_ns))
+        self.central_offset = offset
+        self.central_size = sum(e.central_header_size() for e in self.entries)
+        self.size = self.central_offset + self.central_size + len(self.end_records())
+        self.etag = h.hexdigest()
+
+    def needs_zip64_end(self) -> bool:
+        return (len(self.entries) >= ZIP64_COUNT_LIMIT or self.central_offset >= ZIP64_LIMIT
+                or self.central_size >= ZIP64_LIMIT)
+
+    def end_records(self) -> bytes:
+        count = len(self.entries)
+        res = b""
+        if self.needs_zip64_end():
+            zip64_end_offset = self.central_offset + self.central_size
+            res += struct.pack("<IQHHIIQQQQ", SIG_ZIP64_END, 44, (3 << 8) | 45, 45, 0, 0,
+                               count, count, self.central_size, self.central_offset)
+            res += struct.pack("<IIQI", SIG_ZIP64_LOCATOR, 0, zip64_end_offset, 1)
+        res += struct.pack("<IHHHHIIH", SIG_END, 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+                           min(self.central_size, ZIP64_LIMIT), min(self.central_offset, ZIP64_LIMIT), 0)
+        return res
+
+    def iter_range(self, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        """Bytes [start, end) of the archive in chunks"""
+        if end is None:
+            end = self.size
+        if start >= end:
+            return
+
+        def cut(data: bytes, offset: int) -> bytes:
+            """Part of data (placed at offset in the archive) inside the range"""
+            return data[max(0, start - offset):max(0, end - offset)]
+
+        for e in self.entries:
+            header_size = e.local_header_size()
+            data_offset = e.offset + header_size
+            descriptor_offset = data_offset + e.size
+            entry_end = descriptor_offset + e.descriptor_size()
+            if entry_end <= start:
+                continue
+            if e.offset >= end:
+                return
+            if e.offset < end and data_offset > start:
+                yield cut(e.local_header(), e.offset)
+            if data_offset < end and descriptor_offset > start:
+                yield from e.iter_data(max(0, start - data_offset), min(e.size, end - data_offset))
+            if descriptor_offset < end:
+                yield cut(e.descriptor(), descriptor_offset)
+
+        if self.central_offset < end:
+            central = []
+            offset = self.central_offset
+            for e in self.entries:
+                h_size = e.central_header_size()
+                if offset + h_size > start and offset < end:
+                    central.append(cut(e.central_header(), offset))
+                offset += h_size
+                if len(central) >= 256:
+                    yield b"".join(central)
+                    central = []
+            if len(central):
+                yield b"".join(central)
+            yield cut(self.end_records(), offset)
+
+def parse_range(header: str | None, size: int) -> Tuple[int, int] | None:
+    """[start, end) of a single "bytes=" range, None for the whole file, raises ValueError if unsatisfiable"""
+    if header is None or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        #Multiple ranges are not supported, send everything
+        return None
+    first, _, last = spec.partition("-")
+    if first == "":
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - suffix), size
+    start = int(first)
+    end = size if last == "" else min(size, int(last) + 1)
+    if start >= size or start >= end:
+        raise ValueError("Range not satisfiable")
+    return start, end
@@ -7,6 +7,7 @@ import subprocess
 import xml.etree.ElementTree as ET
 import os
 from ..utils.async_utils import blocking_to_async
+from ..utils import metrics
 
 class ExiException(Exception):
     def __init__(self, msg):
@@ -24,8 +25,10 @@ class ExiInterface():
     async def encode(self, xml_obj: ET.Element) -> bytes:
         data = ET.tostring(xml_obj, encoding="unicode")
         #print(self.url, data)
-        x = (await blocking_to_async(requests.post)(self.url, headers={"Format": "XML", "Connection": "close", "Grammar": str(self.schema_id)}, data=data, timeout=0.5)).text
+        with metrics.EXI_SECONDS.time(schema=str(self.schema_id), op="encode"):
+            x = (await blocking_to_async(requests.post)(self.url, headers={"Format": "XML", "Connection": "close", "Grammar": str(self.schema_id)}, data=data, timeout=0.5)).text
         if(x == "null"):
+            metrics.EXI_ERRORS.inc(schema=str(self.schema_id), op="encode")
             raise ExiException("Encode failed")
         return bytes.fromhex(x)
 
@@ -33,9 +36,11 @@ class ExiInterface():
         data = exi_bytes.hex()
         #print(self.url, data)
         
-        x = (await blocking_to_async(requests.post)(self.url, headers={"Format": "EXI", "Connection": "close", "Grammar": str(self.schema_id)}, data=data, timeout=0.5)).text
+        with metrics.EXI_SECONDS.time(schema=str(self.schema_id), op="decode"):
+            x = (await blocking_to_async(requests.post)(self.url, headers={"Format": "EXI", "Connection": "close", "Grammar": str(self.schema_id)}, data=data, timeout=0.5)).text
         
         if(x == "null"):
+            metrics.EXI_ERRORS.inc(schema=str(self.schema_id), op="decode")
             raise ExiException("Decode failed")
         #print(x)
         return (x, ET.fromstring(x))
@@ -1,18 +1,25 @@
 from __future__ import annotations
 
 import datetime
+import itertools
 import subprocess
 import os
-from quart import Quart, request, jsonify, redirect, abort, render_template, send_file
+import time
+import urllib.parse
+from typing import Any, Dict
+from quart import Quart, Response, request, jsonify, redirect, abort, render_template, send_file
 import logging
 import shutil
 import asyncio
 from code.network import ui_link_harness
+from code.analysis import campaign_db
+from code.utils import dir_cache, metrics, photo_ingest, settings, zip_stream
 
 logging.basicConfig()
 
 RESULTS_BASE_FOLDER = "results"
 RESULTS_SUB_FOLDER = "experiments"
+PHOTOS_FOLDER = "photos"
 
 process: None | subprocess.Popen = None
 
@@ -25,10 +32,12 @@ def in_directory(full_path, directory):
     common_prefix = os.path.commonprefix([full_path, directory])
     return common_prefix == directory
 
-async def main_webserver():
+async def main_webserver(harness: ui_link_harness.UI_Harness):
     app = Quart(__name__)
+    app.config["MAX_CONTENT_LENGTH"] = settings.PHOTO_MAX_BYTES
+    listing_cache = dir_cache.DirCache()
 
-    async def serve_static(req_path, base, download):
+    async def serve_static(req_path, base, download, export_base=None):
         # Joining the base and the requested path
         abs_path = os.path.join(base, req_path)
 
@@ -62,14 +71,25 @@ async def main_webserver():
                 size /= 1000
             return f"{1000*size:1f}{prefixes[-1]}B"
 
-        # Show directory contents
-        files = sorted(os.listdir(abs_path))
+        # Show directory contents, one page from the listing cache
+        sort = request.args.get('sort', "name")
+        reverse = request.args.get('desc', None) is not None
+        try:
+            page = max(0, int(request.args.get('page', 0)))
+        except ValueError:
+            page = 0
+        page_size = settings.LISTING_PAGE_SIZE
+        entries, total = await asyncio.get_running_loop().run_in_executor(None, listing_cache.page, abs_path, sort, reverse, page * page_size, page_size)
         files = [{
-            "name": fn,
-            "size": format_size(os.path.getsize(os.path.join(abs_path, fn))),
-            "isdir": os.path.isdir(os.path.join(abs_path, fn))
-            } for fn in files]
-        return await render_template("files.html", files=files, base_dir=web_base, parent_dir = os.path.dirname(web_base.rstrip("/")))
+            "name": e.name,
+            "size": "..." if e.size is None else format_size(e.size),
+            "time": datetime.datetime.fromtimestamp(e.mtime_ns / 1e9).strftime('%Y-%m-%d %H:%M:%S'),
+            "isdir": e.isdir
+            } for e in entries]
+        if export_base is not None:
+            export_base = os.path.join(export_base, req_path, "")
+        return await render_template("files.html", files=files, base_dir=web_base, parent_dir = os.path.dirname(web_base.rstrip("/")), export_base=export_base,
+            sort=sort, desc=reverse, page=page, pages=max(1, (total + page_size - 1) // page_size), total=total)
 
     # Route for serving static files
     @app.route('/static/', defaults={'path': ''})
@@ -80,7 +100,7 @@ async def main_webserver():
     @app.route(f'/results/', defaults={'path': ''})
     @app.route(f'/results/<path:path>')
     async def serve_results(path):
-        return await serve_static(path, os.path.join(os.path.dirname(os.path.realpath(__file__)), RESULTS_BASE_FOLDER), request.args.get('ndl', None) is None)
+        return await serve_static(path, os.path.join(os.path.dirname(os.path.realpath(__file__)), RESULTS_BASE_FOLDER), request.args.get('ndl', None) is None, "/export/")
 
     @app.route('/shutdown')
     async def handle_shutdown():
@@ -92,23 +112,148 @@ async def main_webserver():
     async def handle_root():
         return redirect("/static/index.html")
     
+    results_base = os.path.join(os.path.dirname(os.path.realpath(__file__)), RESULTS_BASE_FOLDER)
+    photos = photo_ingest.PhotoIngest(os.path.join(results_base, PHOTOS_FOLDER), results_base)
+    photos.start()
+
     @app.route('/upload', methods=['POST'])
     async def upload_file():
-        request_files = await request.files
-        if 'file' not in request_files:
-            return 'No file part'
-        file = request_files['file']
-        if file.filename == '':
-            return 'No selected file'
-        if file:
-            filename = file.filename
-            ext = os.path.splitext(filename)[1]
-            new_filename = f"{datetime.datetime.now(datetime.timezone.utc).strftime('%Y_%m_%d_%H_%M_%S')}{ext}"
-            filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), RESULTS_BASE_FOLDER, "photos", new_filename)
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            await file.save(filepath)
-            return f'File successfully uploaded to {filepath}'
-        return ""
+        #In fleet mode the panel the photo was taken from names its device, the header upload goes to the first one
+        device = harness.devices.get(request.args.get('device', ""), harness.default_device)
+        session = device.state_process.current_session(settings.PHOTO_SESSION_GRACE)
+        sessions = [os.path.relpath(session, results_base)] if session is not None else []
+        info = (device.state_info.name, device.state_info.box, device.state_info.plug)
+        #Uploads over the hotspot are slow, the default body timeout would cut them
+        request.body_timeout = None
+
+        if request.mimetype == "multipart/form-data":
+            #Forms are parsed in full before anything could be hashed or written, only raw bodies stream
+            return 'Send the photo as the raw request body with ?filename=', 415
+
+        filename = request.args.get('filename', "")
+
+        async def chunks():
+            async for chunk in request.body:
+                yield chunk
+
+        try:
+            record, duplicate = await photos.ingest(chunks(), filename, sessions, info)
+        except ValueError as e:
+            return str(e), 413
+        if duplicate:
+            return f'Already uploaded as {record.file}'
+        return f'File successfully uploaded to {os.path.join(PHOTOS_FOLDER, record.file)}'
+
+    @app.route('/photos')
+    async def handle_photos():
+        try:
+            page = max(0, int(request.args.get('page', 0)))
+        except ValueError:
+            page = 0
+        page_size = settings.LISTING_PAGE_SIZE
+        records, total = photos.page(page * page_size, page_size)
+        return await render_template("photos.html", photos=records, base_dir=f"/results/{PHOTOS_FOLDER}/",
+            thumbs_dir=f"/results/{PHOTOS_FOLDER}/{photo_ingest.THUMBS_FOLDER}/", thumb_name=photo_ingest.thumb_name,
+            page=page, pages=max(1, (total + page_size - 1) // page_size))
+
+    campaign_db_path = os.path.join(results_base, campaign_db.DB_FILE)
+
+    #Running exports by id, for /exports
+    exports: Dict[int, Dict[str, Any]] = {}
+    export_ids = itertools.count()
+
+    #Zip of a results subtree streamed as it is read, with ranges so that a dropped download can be resumed
+    @app.route('/export/', defaults={'path': ''})
+    @app.route('/export/<path:path>')
+    async def handle_export(path):
+        abs_path = os.path.realpath(os.path.join(results_base, path))
+        if not in_directory(os.path.join(abs_path, ""), results_base):
+            return abort(403)
+        if not os.path.isdir(abs_path):
+            return abort(404)
+
+        loop = asyncio.get_running_loop()
+        archive = await loop.run_in_executor(None, zip_stream.ZipStream, abs_path)
+        etag = f'"{archive.etag}"'
+
+        #A range of an archive whose files changed since would not fit the part already downloaded
+        byte_range = None
+        if_range = request.headers.get("If-Range", None)
+        if if_range is None or if_range == etag:
+            try:
+                byte_range = zip_stream.parse_range(request.headers.get("Range", None), archive.size)
+            except ValueError:
+                return Response("", status=416, headers={"Content-Range": f"bytes */{archive.size}"})
+        start, end = byte_range if byte_range is not None else (0, archive.size)
+
+        name = os.path.basename(abs_path) + ".zip"
+        headers = {
+            "Content-Length": str(end - start),
+            "Content-Disposition": f"attachment; filename*=UTF-8''{urllib.parse.quote(name)}",
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+        }
+        if byte_range is not None:
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{archive.size}"
+
+        export_id = next(export_ids)
+        progress = {"path": path, "size": archive.size, "start": start, "end": end, "sent": 0, "started": time.time()}
+
+        async def body():
+            exports[export_id] = progress
+            chunks = archive.iter_range(start, end)
+            try:
+                while True:
+                    #Disk reads and CRCs off the event loop
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                    if chunk is None:
+                        break
+                    if len(chunk) == 0:
+                        continue
+                    progress["sent"] += len(chunk)
+                    yield chunk
+            finally:
+                del exports[export_id]
+                duration = time.time() - progress["started"]
+                print(f"Export of /{path}: {progress['sent']}/{end - start} bytes in {duration:.1f}s")
+
+        print(f"Export of /{path}: {len(archive.entries)} files, bytes {start}-{end}/{archive.size}")
+        response = Response(body(), status=206 if byte_range is not None else 200, headers=headers, mimetype="application/zip")
+        #Large exports over a slow link take longer than the default response timeout
+        response.timeout = None
+        return response
+
+    @app.route('/exports')
+    async def handle_exports():
+        now = time.time()
+        return jsonify([{
+            **p,
+            "rate": p["sent"] / max(now - p["started"], 1e-3),
+        } for p in exports.values()])
+
+    @app.route('/campaign/update', methods=['POST'])
+    async def handle_campaign_update():
+        res = await asyncio.get_running_loop().run_in_executor(None, campaign_db.update_db, results_base, campaign_db_path)
+        return jsonify(res._asdict())
+
+    @app.route('/campaign/query')
+    async def handle_campaign_query():
+        sql = request.args.get('sql', None)
+        if sql is None:
+            return abort(400)
+        if not os.path.isfile(campaign_db_path):
+            return abort(404)
+        try:
+            limit = int(request.args.get('limit', 1000))
+        except ValueError:
+            return abort(400)
+        if limit < 0 or limit > campaign_db.QUERY_LIMIT_MAX:
+            return abort(400)
+        try:
+            res = await asyncio.get_running_loop().run_in_executor(None, campaign_db.query_db, campaign_db_path, sql, (), limit)
+        except campaign_db.sqlite3.Error as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(res)
 
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.ERROR)
@@ -119,25 +264,21 @@ async def main_webserver():
 
     await app.run_task(host="0.0.0.0", port=8000, certfile=ssl_cert, keyfile=ssl_key)
 
-async def main_websocket():
-    harness = ui_link_harness.UI_Harness(os.path.join(os.path.dirname(os.path.realpath(__file__)), RESULTS_BASE_FOLDER, RESULTS_SUB_FOLDER, ""))
-
-    async def websocket_update_task():
-        while True:
-            await asyncio.sleep(1)
-            await harness.state_process.send_state_update()
-
-    asyncio.ensure_future(websocket_update_task())
-
+async def main_websocket(harness: ui_link_harness.UI_Harness):
+    #Process state is sent by StateSubprocess itself when the EV process starts and exits
     await harness.start_websocket_server(True)
 
 
 async def main():
     print(f"Loaded")
 
-    asyncio.ensure_future(main_websocket())
+    #Shared with the webserver, photo uploads are linked to the session the harness runs
+    harness = ui_link_harness.UI_Harness(os.path.join(os.path.dirname(os.path.realpath(__file__)), RESULTS_BASE_FOLDER, RESULTS_SUB_FOLDER, ""))
+
+    asyncio.ensure_future(main_websocket(harness))
+    await metrics.serve(settings.METRICS_PORT_HARNESS, settings.METRICS_HOST)
 
-    await main_webserver()
+    await main_webserver(harness)
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,67 @@
+import errno
+import os
+import tempfile
+import threading
+import unittest
+
+from code.utils import backup_writer
+
+class FailingFile():
+    """Stands in for the log file of a full disk"""
+    def write(self, data: bytes):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def flush(self):
+        pass
+
+    def fileno(self) -> int:
+        return -1
+
+    def close(self):
+        pass
+
+class ThreadedBackupWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "backup.bak.txt")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_write_and_close(self):
+        writer = backup_writer.ThreadedBackupWriter(self.path, backup_writer.DURABILITY_FLUSH, 0.1, 1 << 20, 4)
+        for i in range(100):
+            writer.write(f"{i}\n".encode(), i % 10 == 0)
+        writer.close()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"".join(f"{i}\n".encode() for i in range(100)))
+
+    def test_failing_file_does_not_block(self):
+        writer = backup_writer.ThreadedBackupWriter(self.path, backup_writer.DURABILITY_FLUSH, 0.1, 1 << 20, 4)
+        writer.file.close()
+        writer.file = FailingFile()
+
+        def produce():
+            #Far more than the queue holds, would block forever on a dead consumer
+            try:
+                for _ in range(1000):
+                    writer.write(b"line\n", True)
+            except backup_writer.BackupWriterError:
+                pass
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertIsInstance(writer.error, OSError)
+
+        with self.assertRaises(backup_writer.BackupWriterError):
+            writer.write(b"line\n", False)
+
+        closer = threading.Thread(target=lambda: self.assertRaises(backup_writer.BackupWriterError, writer.close), daemon=True)
+        closer.start()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+
+from code.utils import data_saver
+
+try:
+    from PIL import Image
+    from code.utils import photo_ingest
+except ImportError:
+    photo_ingest = None
+
+async def one_chunk(data: bytes):
+    yield data
+
+@unittest.skipIf(photo_ingest is None, "Pillow is not installed")
+class PhotoSessionLinkTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.results = self.folder.name
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_link_next_to_session_log(self):
+        #What the EV process writes, started by the harness with this output path
+        outpath = os.path.join(self.results, "2026_01_01_00_00_00_eth1")
+        logger = data_saver.DataSaver(outpath)
+        with logger.trace_file_start(data_saver.session_name("car", "box1", "ccs")):
+            with logger.trace_enter("CHARGER"):
+                logger.log_entry("INFO", {})
+        session_folder = logger.result_subfolder
+        self.assertTrue(os.path.isfile(os.path.join(session_folder, "backup.bak.txt")))
+
+        #What the harness expects, as StateSubprocess computes it
+        expected = data_saver.subfolder(outpath, data_saver.session_name("car", "box1", "ccs"))
+        self.assertEqual(expected, session_folder)
+
+        buf = io.BytesIO()
+        Image.new("RGB", (64, 48), (255, 0, 0)).save(buf, "JPEG")
+        ingest = photo_ingest.PhotoIngest(os.path.join(self.results, "photos"), self.results)
+
+        async def run():
+            return await ingest.ingest(one_chunk(buf.getvalue()), "plug.jpg", [os.path.relpath(expected, self.results)], ("car", "box1", "ccs"))
+        record, duplicate = asyncio.run(run())
+        if ingest.pool is not None:
+            ingest.pool.shutdown()
+
+        self.assertFalse(duplicate)
+        linked = os.path.join(session_folder, photo_ingest.SESSION_PHOTOS_FOLDER, record.file)
+        self.assertTrue(os.path.isfile(linked))
+        self.assertEqual(sorted(os.listdir(self.results)), sorted([os.path.basename(session_folder), "photos"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import copy
+import unittest
+
+from code.network import state_store
+
+def apply_patch(root, ops):
+    """What apply_patch in www/index.js does"""
+    for op in ops:
+        parts = [p.replace("~1", "/").replace("~0", "~") for p in op["path"].split("/")[1:]]
+        parent = root
+        for part in parts[:-1]:
+            parent = parent[part]
+        if op["op"] == "remove":
+            del parent[parts[-1]]
+        else:
+            parent[parts[-1]] = op["value"]
+
+class StateStoreTest(unittest.TestCase):
+    def test_merged_deltas_match_the_single_ones(self):
+        store = state_store.StateStore()
+        store.update("task/a", {"type": "task", "name": "a", "state": "idle", "data": {"x": 1}})
+        client = copy.deepcopy(store.state)
+
+        deltas = []
+        for value in [
+            {"type": "task", "name": "a", "state": "running", "data": {"x": 1, "y": [1, 2]}},
+            {"type": "task", "name": "a", "state": "running", "data": {"y": [3]}},
+            {"type": "task", "name": "a/b", "state": "done", "data": None},
+            {"type": "task", "name": "a", "state": "done", "data": {"y": [3], "z": {"w": 0}}},
+        ]:
+            base = store.revision
+            ops = store.update(state_store.state_key(value), value)
+            self.assertTrue(len(ops))
+            deltas.append(store.delta_message(base, ops))
+
+        merged = deltas[0]
+        for delta in deltas[1:]:
+            merged = state_store.merge_deltas(merged, delta)
+        self.assertEqual((merged["base"], merged["revision"]), (deltas[0]["base"], store.revision))
+        self.assertLess(len(merged["ops"]), sum(len(d["ops"]) for d in deltas))
+        apply_patch(client, merged["ops"])
+        self.assertEqual(client, store.state)
+
+        #The history the store resumes clients from is left alone
+        self.assertEqual(store.delta_since(deltas[0]["base"]), [op for d in deltas for op in d["ops"]])
+
+    def test_merge_needs_consecutive_deltas(self):
+        store = state_store.StateStore()
+        first = store.delta_message(0, store.update("Proto", {"type": "Proto", "result": 1}))
+        store.update("Proto", {"type": "Proto", "result": 2})
+        third = store.delta_message(2, store.update("Proto", {"type": "Proto", "result": 3}))
+        self.assertIsNone(state_store.merge_deltas(first, third))
+
+    def test_whole_state_is_replaced(self):
+        store = state_store.StateStore()
+        cp = {"type": "basic_signaling", "state": {"l": -12.0, "h": 9.0, "d": 0.05, "s": 2, "p": 0.0}}
+        self.assertEqual(store.update("basic_signaling", cp), [{"op": "add", "path": "/basic_signaling", "value": cp}])
+        self.assertEqual(store.update("basic_signaling", dict(cp)), [])
+        cp = {"type": "basic_signaling", "state": {"l": -12.0, "h": 6.0, "d": 0.05, "s": 3, "p": 0.0}}
+        self.assertEqual(store.update("basic_signaling", cp), [{"op": "replace", "path": "/basic_signaling", "value": cp}])
+        self.assertIs(store.state["basic_signaling"], cp)
+
+if __name__ == "__main__":
+    unittest.main()
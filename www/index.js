@@ -188,16 +188,16 @@ let hide_ui = () => {
     console.log("UI Wiped");
 };
 
-let reveal_sub_ui = () => {
-    document.getElementById("sub_alt").style.display = "none";
-    document.getElementById("sub_ui").style.display = "initial";
+let reveal_sub_ui = (panel) => {
+    panel.sub_alt.style.display = "none";
+    panel.sub_ui.style.display = "initial";
 };
 
-let hide_sub_ui = () => {
-    document.getElementById("sub_alt").style.display = "initial";
-    document.getElementById("sub_alt").innerHTML = "No internal websocket connection to server.";
-    document.getElementById("sub_ui").style.display = "none";
-    document.getElementById("sub_ui").innerHTML = ""; //Wipe
+let hide_sub_ui = (panel) => {
+    panel.sub_alt.style.display = "initial";
+    panel.sub_alt.innerHTML = "No internal websocket connection to server.";
+    panel.sub_ui.style.display = "none";
+    panel.sub_ui.innerHTML = ""; //Wipe
 };
 
 
@@ -244,7 +244,38 @@ let state_task = (ws, root_elem, tasks, data, button) => {
     };
 };
 
-let connect_ev = (mock_ws) => {
+//Mirror of the EV state store of one device, kept across reconnects so that only the changes are sent again
+let new_ev_sync = () => {
+    return {
+        epoch: undefined,
+        revision: undefined,
+        state: {}
+    };
+};
+
+let unescape_pointer = (s) => s.replace(/~1/g, "/").replace(/~0/g, "~");
+
+//Apply JSON patch style operations, returns the top level keys that changed
+let apply_patch = (root, ops) => {
+    let touched = new Set();
+    for (let op of ops) {
+        let parts = op.path.split("/").slice(1).map(unescape_pointer);
+        touched.add(parts[0]);
+        let parent = root;
+        for (let i = 0; i < parts.length - 1; i++) {
+            parent = parent[parts[i]];
+        }
+        let last = parts[parts.length - 1];
+        if (op.op === "remove") {
+            delete parent[last];
+        } else {
+            parent[last] = op.value;
+        }
+    }
+    return touched;
+};
+
+let connect_ev = (mock_ws, panel) => {
 
     let elements = {
         "waiter_start": undefined,
@@ -270,12 +301,12 @@ let connect_ev = (mock_ws) => {
 
 
     mock_ws.onopen = () => {
-        document.getElementById("sub_alt").innerText = "Connected, loading";
+        panel.sub_alt.innerText = "Connected, loading";
 
         //Create elements
 
         //Name
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             createElem("div", ["exp-ctrl"], {}, {}, "",
                 [(elements.waiter_start = waiter(mock_ws, [
                     { id: "start_all", name: "Start All" },
@@ -288,18 +319,18 @@ let connect_ev = (mock_ws) => {
         );
 
         //Connect wait
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             createElem("div", [], {}, {}, "",
                 [(elements.waiter_plug = waiter(mock_ws, [{ id: "plug", name: "Plug" }], "plug")).elem]
             ));
 
         //Basic signalling
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             elements.bs = createElem("div", ["bs"])
         );
 
         //Basic slac
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             createElem("div", ["slac"], {}, {}, "", [
                 elements.slac.state = createElem("div", []),
                 elements.slac.result = createElem("div", [])
@@ -307,33 +338,88 @@ let connect_ev = (mock_ws) => {
             ));
 
         //SDP
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             elements.sdp.result = createElem("div", ["sdp"])
         );
 
         //Proto
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             elements.proto.result = createElem("div", ["v2g"])
         );
 
         //V2G
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             elements.v2g.result = createElem("div", ["v2g"])
         );
 
         //Tasks root
-        document.getElementById("sub_ui").appendChild(
+        panel.sub_ui.appendChild(
             elements.tasks_root = createElem("div", ["tasks"])
         );
     };
 
+    //Whether the state has been shown since the UI was rebuilt, and whether a full state was requested
+    let rendered = false;
+    let resyncing = false;
+
+    let dispatch = (keys) => {
+        if (!rendered) {
+            //The UI was rebuilt empty, show everything, tasks first
+            keys = new Set(Object.keys(panel.sync.state));
+            if (panel.sync.state["init_tasks"] !== undefined) {
+                handle_state(panel.sync.state["init_tasks"]);
+            }
+            rendered = true;
+            reveal_sub_ui(panel);
+        }
+        //The task list does not change while the EV process runs
+        keys.forEach(key => {
+            if (key !== "init_tasks" && panel.sync.state[key] !== undefined) {
+                handle_state(panel.sync.state[key]);
+            }
+        });
+    };
+
     mock_ws.onmessage = (content) => {
+        switch (content.type) {
+            case "state_snapshot":
+                panel.sync = {
+                    epoch: content.epoch,
+                    revision: content.revision,
+                    state: content.state
+                };
+                resyncing = false;
+                dispatch(new Set(Object.keys(content.state)));
+                break;
+            case "state_delta":
+                if (resyncing) {
+                    break;
+                }
+                if (content.epoch !== panel.sync.epoch || content.base !== panel.sync.revision) {
+                    if (content.epoch === panel.sync.epoch && content.revision <= panel.sync.revision) {
+                        //Already applied
+                        break;
+                    }
+                    resyncing = true;
+                    mock_ws.send(JSON.stringify({ "type": "state_resync" }));
+                    break;
+                }
+                panel.sync.revision = content.revision;
+                dispatch(apply_patch(panel.sync.state, content.ops));
+                break;
+            default:
+                handle_state(content);
+        }
+    };
+
+    let handle_state = (content) => {
         switch (content.type) {
             case "init_done":
-                reveal_sub_ui();
+                reveal_sub_ui(panel);
                 break;
             case "init_tasks":
                 content.tasks.forEach(data => {
+                    panel.on_task(data);
                     elements.tasks[data.name] = state_task(mock_ws, elements.tasks_root, elements.tasks, data, elements.waiter_done.add_type({
                         id: data.name,
                         name: "Start"
@@ -343,6 +429,7 @@ let connect_ev = (mock_ws) => {
             case "task":
                 console.log(content.name);
                 elements.tasks[content.name].on_message(content);
+                panel.on_task(content);
                 break;
             case "waiter_start":
                 elements.waiter_start.on_message(content);
@@ -354,6 +441,7 @@ let connect_ev = (mock_ws) => {
                 elements.waiter_plug.on_message(content);
                 break;
             case "basic_signaling":
+                panel.on_basic(content);
                 elements.bs.innerText = BS_STATE_NAMES[content.state.s] + ": " +
                     format_float(content.state.l) + " - " + format_float(content.state.h) + " @ " + format_float(content.state.d * 100) + "%, PP: " + format_float(content.state.p);
                 break;
@@ -379,11 +467,41 @@ let connect_ev = (mock_ws) => {
 
     mock_ws.onclose = () => {
         console.log("Socket closed");
-        hide_sub_ui();
+        hide_sub_ui(panel);
     };
 };
 
-let connect_main = (resolve, reject) => {
+//Device undefined: the first one
+let upload_photo = async (file, device) => {
+    if (file === undefined) {
+        return;
+    }
+    //Sent as the raw body, the server writes it as it arrives
+    let url = '/upload?filename=' + encodeURIComponent(file.name);
+    if (device !== undefined) {
+        url += '&device=' + encodeURIComponent(device);
+    }
+    let res = await fetch(url, {
+        method: "POST", 
+        body: file
+    });
+    let data = await(res.text());
+    console.log(data);
+
+    const iframe = document.getElementById('file_upload_frame');
+    const iframeDocument = iframe.contentDocument || iframe.contentWindow.document;
+    iframeDocument.open();
+    iframeDocument.write(data);
+    iframeDocument.close();
+
+    document.getElementById('file_upload_frame').innerHTML = res;
+    document.getElementById('file_upload_frame').style.display = "initial";
+    await new Promise((resolve, reject) => setTimeout(resolve, 2000));
+    document.getElementById('file_upload_frame').style.display = "none";
+};
+
+//Controls, output and EV view of one device (EV process), and its row on the dashboard
+let device_panel = (ws, name) => {
     let elements = {
         "name": {
             "name": undefined,
@@ -391,15 +509,225 @@ let connect_main = (resolve, reject) => {
             "plug": undefined,
             "gps": undefined
         },
-        "process_state": undefined
+        "process_state": undefined,
+        "process_output": undefined,
+        "row": {
+            "info": undefined,
+            "process": undefined,
+            "basic": undefined,
+            "tasks": undefined
+        }
+    };
+
+    let panel = {
+        "name": name,
+        "elem": undefined,
+        "row": undefined,
+        "sub_ui": undefined,
+        "sub_alt": undefined,
+        "sync": new_ev_sync(),
+        "mock_ws": undefined,
+        "running": false,
+        "gps": [undefined, undefined],
+        //Last result per task name, for the dashboard
+        "tasks": {}
+    };
+
+    let send = (type, data) => {
+        ws.send(JSON.stringify({
+            "type": type,
+            "device": name,
+            "data": data
+        }));
+    };
+
+    panel.elem = createElem("div", ["device"], {}, {}, "", [
+        createElem("div", ["device-name"], {}, {}, name, []),
+        createElem("div", ["chg"], {}, {}, "", [
+            createElem("div", [], {}, {}, "", [
+                elements.name.name = createElem("input", ["chg-name"], { "placeholder": "Name" }, {
+                    "change": () => {
+                        send("info", {
+                            "type": "name",
+                            "name": elements.name.name.value
+                        });
+                    }
+                }),
+                elements.name.box = createElem("input", ["chg-name"], { "placeholder": "Box" }, {
+                    "change": () => {
+                        send("info", {
+                            "type": "box",
+                            "box": elements.name.box.value
+                        });
+                    }
+                }),
+                elements.name.plug = createElem("input", ["chg-name"], { "placeholder": "Plug" }, {
+                    "change": () => {
+                        send("info", {
+                            "type": "plug",
+                            "plug": elements.name.plug.value
+                        });
+                    }
+                }),
+            ]),
+            createElem("div", ["chg"], {}, {}, "", [
+                elements.name.gps = createElem("span", [], {}, {}, "", []),
+                createElem("button", ["chg-setpos"], {}, {
+                    "click": () => {
+                        if (global_gps !== undefined) {
+                            send("info", {
+                                "type": "gps",
+                                "gps": global_gps.position
+                            });
+                        }
+                    }
+                }, "Set position"),
+                createElem("input", ["chg-photo"], { "type": "file", "accept": "image/*", "capture": "camera" }, {
+                    "change": (e) => upload_photo(e.target.files[0], name)
+                }),
+            ])
+        ]),
+        createElem("div", ["subprocess"], {}, {}, "", [
+            createElem("button", ["subprocess-command"], {}, {
+                "click": () => send("process", { "type": "start" })
+            }, "Start"),
+            createElem("button", ["subprocess-command"], {}, {
+                "click": () => send("process", { "type": "sigint" })
+            }, "SIG INT"),
+            createElem("button", ["subprocess-command"], {}, {
+                "click": () => send("process", { "type": "sigterm" })
+            }, "SIG TERM"),
+            createElem("button", ["subprocess-command"], {}, {
+                "click": () => send("process", { "type": "sigkill" })
+            }, "SIG KILL"),
+            elements.process_state = createElem("span", ["subprocess-state"], {}, {}, "", []),
+            elements.process_output = createElem("pre", ["subprocess-output"], {}, {}, "", [])
+        ]),
+        panel.sub_ui = createElem("div", [], {"style": "display: none;"}),
+        panel.sub_alt = createElem("div", [], {"style": "display: initial;"}, {}, "")
+    ]);
+    hide_sub_ui(panel);
+
+    panel.row = createElem("tr", [], {}, {}, "", [
+        createElem("td", [], {}, {}, name, []),
+        elements.row.info = createElem("td", [], {}, {}, "", []),
+        elements.row.process = createElem("td", [], {}, {}, "", []),
+        elements.row.basic = createElem("td", [], {}, {}, "", []),
+        elements.row.tasks = createElem("td", [], {}, {}, "", [])
+    ]);
+
+    panel.update_gps = () => {
+        elements.name.gps.innerText = `${format_gps(panel.gps)} (${format_float(calc_crow(panel.gps, global_gps.position))} m away)`
+    };
+
+    panel.on_task = (content) => {
+        panel.tasks[content.name] = content.result;
+        let counts = {};
+        Object.values(panel.tasks).forEach(result => {
+            counts[result] = (counts[result] || 0) + 1;
+        });
+        elements.row.tasks.innerText = Object.keys(counts).map(result => TASK_STATE_CHARS[result] + " " + counts[result]).join(" ");
+    };
+
+    panel.on_basic = (content) => {
+        elements.row.basic.innerText = BS_STATE_NAMES[content.state.s] + " @ " + format_float(content.state.d * 100) + "%";
     };
 
-    let state_data = {
-        gps: [undefined, undefined],
-        running: false
+    //Open forwarding to the EV process once it runs, retried by the poll loop
+    panel.open_forward = () => {
+        if (!panel.running || panel.mock_ws !== undefined) {
+            return;
+        }
+        console.log("Reconnecting forward " + name);
+        let prefix = '{"type":"forward","device":' + JSON.stringify(name) + ',"data":';
+        panel.mock_ws = {
+            "onopen": undefined,
+            "onmessage": undefined,
+            "onclose": undefined,
+            //Wrapped as a string, the harness passes the payload on without parsing it
+            "send": (str) => {ws.send(prefix + str + '}')}
+        };
+        ws.send(JSON.stringify({
+            "type": "forward_open",
+            "device": name,
+            "resume": panel.sync.epoch === undefined ? null : {
+                "epoch": panel.sync.epoch,
+                "revision": panel.sync.revision
+            }
+        }));
     };
 
-    let mock_ws = undefined;
+    panel.close = () => {
+        if (panel.mock_ws != undefined) {
+            if(panel.mock_ws.onclose != undefined) {
+                panel.mock_ws.onclose();
+            }
+            panel.mock_ws = undefined;
+        }
+    };
+
+    panel.on_message = (content) => {
+        switch (content.type) {
+            case "info":
+                elements.name.name.value = content.name;
+                elements.name.box.value = content.box;
+                elements.name.plug.value = content.plug;
+                elements.row.info.innerText = [content.name, content.box, content.plug].join(" ");
+                if (content.gps != undefined) {
+                    panel.gps = content.gps;
+                    panel.update_gps();
+                }
+                break;
+            case "process":
+                panel.running = content.running;
+                if (panel.running) {
+                    elements.process_state.innerText = "EV ON";
+                } else if (content.returncode !== null && content.returncode !== undefined) {
+                    elements.process_state.innerText = `EV OFF (exit ${content.returncode})`;
+                } else {
+                    elements.process_state.innerText = "EV OFF";
+                }
+                elements.row.process.innerText = elements.process_state.innerText;
+                break;
+            case "process_output":
+                for (let [stream, line] of content.lines) {
+                    elements.process_output.appendChild(
+                        createElem("div", ["subprocess-" + stream], {}, {}, line, [])
+                    );
+                }
+                while (elements.process_output.childElementCount > 200) {
+                    elements.process_output.removeChild(elements.process_output.firstChild);
+                }
+                elements.process_output.scrollTop = elements.process_output.scrollHeight;
+                break;
+            case "forward_success":
+                if (panel.mock_ws != undefined) {
+                    (connect_ev)(panel.mock_ws, panel);
+                    panel.mock_ws.onopen();
+                }
+                break;
+            case "forward":
+                if (panel.mock_ws != undefined) {
+                    panel.mock_ws.onmessage(content.data);
+                }
+                break;
+            case "forward_fail":
+                panel.close();
+                break;
+            default:
+                console.error("Unknown message type", content.type);
+        }
+    };
+
+    return panel;
+};
+
+let connect_main = (resolve, reject) => {
+    //One panel per EV process of the harness, by device name
+    let panels = {};
+    let panel_list = [];
+    let dashboard = undefined;
+
     let poll_task_run = true;
 
     let ws = new WebSocket("wss://" + location.hostname + ":8081/");
@@ -412,140 +740,23 @@ let connect_main = (resolve, reject) => {
     ws.onopen = () => {
         document.getElementById("main_alt").innerText = "Connected, loading";
 
-        //Create elements
-
-        //Name
+        //Combined view of all devices, filled once the device list arrives
         document.getElementById("main_ui").appendChild(
-            createElem("div", ["chg"], {}, {}, "", [
-                createElem("div", [], {}, {}, "", [
-                    elements.name.name = createElem("input", ["chg-name"], { "placeholder": "Name" }, {
-                        "change": () => {
-                            ws.send(JSON.stringify({
-                                "type": "info",
-                                "data": {
-                                    "type": "name",
-                                    "name": elements.name.name.value
-                                }
-                            }));
-                        }
-                    }),
-                    elements.name.box = createElem("input", ["chg-name"], { "placeholder": "Box" }, {
-                        "change": () => {
-                            ws.send(JSON.stringify({
-                                "type": "info",
-                                "data": {
-                                    "type": "box",
-                                    "box": elements.name.box.value
-                                }
-                            }));
-                        }
-                    }),
-                    elements.name.plug = createElem("input", ["chg-name"], { "placeholder": "Plug" }, {
-                        "change": () => {
-                            ws.send(JSON.stringify({
-                                "type": "info",
-                                "data": {
-                                    "type": "plug",
-                                    "plug": elements.name.plug.value
-                                }
-                            }));
-                        }
-                    }),
-                ]),
-                createElem("div", ["chg"], {}, {}, "", [
-                    elements.name.gps = createElem("span", [], {}, {}, "", []),
-                    createElem("button", ["chg-setpos"], {}, {
-                        "click": () => {
-                            if (global_gps !== undefined) {
-                                ws.send(JSON.stringify({
-                                    "type": "info",
-                                    "data": {
-                                        "type": "gps",
-                                        "gps": global_gps.position
-                                    }
-                                }));
-                            }
-                        }
-                    }, "Set position"),
-                ])
+            dashboard = createElem("table", ["dashboard"], {}, {}, "", [
+                createElem("tr", [], {}, {}, "", ["Device", "Charger", "EV", "CP", "Tasks"].map(
+                    title => createElem("th", [], {}, {}, title, [])
+                ))
             ])
         );
-        document.getElementById("main_ui").appendChild(
-            createElem("div", ["subprocess"], {}, {}, "", [
-                createElem("button", ["subprocess-command"], {}, {
-                    "click": () => {
-                        ws.send(JSON.stringify({
-                            "type": "process",
-                            "data": {
-                                "type": "start"
-                            }
-                        }));
-                    }
-                }, "Start"),
-                createElem("button", ["subprocess-command"], {}, {
-                    "click": () => {
-                        ws.send(JSON.stringify({
-                            "type": "process",
-                            "data": {
-                                "type": "sigint"
-                            }
-                        }));
-                    }
-                }, "SIG INT"),
-                createElem("button", ["subprocess-command"], {}, {
-                    "click": () => {
-                        ws.send(JSON.stringify({
-                            "type": "process",
-                            "data": {
-                                "type": "sigterm"
-                            }
-                        }));
-                    }
-                }, "SIG TERM"),
-                createElem("button", ["subprocess-command"], {}, {
-                    "click": () => {
-                        ws.send(JSON.stringify({
-                            "type": "process",
-                            "data": {
-                                "type": "sigkill"
-                            }
-                        }));
-                    }
-                }, "SIG KILL"),
-                elements.process_state = createElem("span", ["subprocess-state"], {}, {}, "", [])
-            ])
-        );
-        document.getElementById("main_ui").appendChild(
-            createElem("div", [], {"id": "sub_ui", "style": "display: none;"})
-        );
-        document.getElementById("main_ui").appendChild(
-            createElem("div", [], {"id": "sub_alt", "style": "display: initial;"}, {}, "")
-        );
-        hide_sub_ui();
 
         global_gps.listener = () => {
-            elements.name.gps.innerText = `${format_gps(state_data.gps)} (${format_float(calc_crow(state_data.gps, global_gps.position))} m away)`
+            panel_list.forEach(panel => panel.update_gps());
         };
-        global_gps.listener(global_gps);
 
         (async () => {
             console.log("Start forward");
             while (poll_task_run) {
-                if(state_data.running && (mock_ws == undefined)) {
-                    console.log("Reconnecting forward");
-                    mock_ws = {
-                        "onopen": undefined,
-                        "onmessage": undefined,
-                        "onclose": undefined,
-                        "send": (str) => {ws.send(JSON.stringify({
-                            "type": "forward",
-                            "data": JSON.parse(str)
-                        }))}
-                    };
-                    ws.send(JSON.stringify({
-                        "type": "forward_open"
-                    }));
-                }
+                panel_list.forEach(panel => panel.open_forward());
                 await new Promise((resolve) => setTimeout(resolve, 1000));
             }
         })();
@@ -558,42 +769,27 @@ let connect_main = (resolve, reject) => {
             case "init_done":
                 reveal_ui();
                 break;
-            case "info":
-                elements.name.name.value = content.name;
-                elements.name.box.value = content.box;
-                elements.name.plug.value = content.plug;
-                if (content.gps != undefined) {
-                    state_data.gps = content.gps;
-                    if (global_gps.listener != undefined) {
-                        global_gps.listener();
-                    }
-                }
-                break;
-            case "process":
-                state_data.running = content.running;
-                elements.process_state.innerText = `EV ${state_data.running ? "ON" : "OFF"}`;
-                break;
-            case "forward_success":
-                if (mock_ws != undefined) {
-                    (connect_ev)(mock_ws);
-                    mock_ws.onopen();
-                }
-                break;
-            case "forward":
-                if (mock_ws != undefined) {
-                    mock_ws.onmessage(content.data);
-                }
-                break;
-            case "forward_fail":
-                if (mock_ws != undefined) {
-                    if(mock_ws.onclose != undefined) {
-                        mock_ws.onclose();
-                    }
-                    mock_ws = undefined;
+            case "devices":
+                content.devices.forEach(name => {
+                    let panel = device_panel(ws, name);
+                    panels[name] = panel;
+                    panel_list.push(panel);
+                    dashboard.appendChild(panel.row);
+                    document.getElementById("main_ui").appendChild(panel.elem);
+                });
+                if (panel_list.length < 2) {
+                    dashboard.style.display = "none";
                 }
+                global_gps.listener();
                 break;
             default:
-                console.error("Unknown message type", content.type);
+                //Messages without a device are for the first one
+                let panel = content.device !== undefined ? panels[content.device] : panel_list[0];
+                if (panel !== undefined) {
+                    panel.on_message(content);
+                } else {
+                    console.error("Unknown device", content.device);
+                }
         }
     };
 
@@ -601,11 +797,7 @@ let connect_main = (resolve, reject) => {
 
     ws.onclose = (e) => {
         console.log('Socket is closed. Reconnect will be attempted in 1 second.', e.reason);
-        if (mock_ws != undefined) {
-            if(mock_ws.onclose != undefined) {
-                mock_ws.onclose()
-            }
-        }
+        panel_list.forEach(panel => panel.close());
         hide_ui();
         poll_task_run = false;
         reject("Socket closed");
@@ -630,26 +822,8 @@ let main = async () => {
     };
 
     document.getElementById("photo_upload").onchange = async () => {
-        let formData = new FormData();           
-        formData.append("file", document.getElementById("photo_upload").files[0]);
-        let res = await fetch('/upload', {
-            method: "POST", 
-            body: formData
-        });
-        let data = await(res.text());
-        console.log(data);
-
-        const iframe = document.getElementById('file_upload_frame');
-        const iframeDocument = iframe.contentDocument || iframe.contentWindow.document;
-        iframeDocument.open();
-        iframeDocument.write(data);
-        iframeDocument.close();
-
-        document.getElementById('file_upload_frame').innerHTML = res;
-        document.getElementById('file_upload_frame').style.display = "initial";
-        await new Promise((resolve, reject) => setTimeout(resolve, 2000));
-        document.getElementById('file_upload_frame').style.display = "none";
-    }
+        await upload_photo(document.getElementById("photo_upload").files[0], undefined);
+    };
 
     //GPS
     if (navigator.geolocation) {